@@ -2,11 +2,18 @@ import pynetdicom
 from pydicom import Dataset
 
 import logging
-from typing import Type, Union, Callable
+import threading
+import time
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Type, Union, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 from pynetdicom import AE
-from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove, ModalityWorklistInformationFind 
+from pynetdicom.association import Association
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove, ModalityWorklistInformationFind, Verification
 from main_page.libs.status_codes import DATASET_AVAILABLE, TRANSFER_COMPLETE
 from main_page.libs.dirmanager import try_mkdir
+from main_page.libs import server_config
+from main_page.libs import move_notifier
 
 
 ae_logger = logging.getLogger('GFRLogger')
@@ -131,6 +138,291 @@ def connect(ip: str, port: Union[int, str], calling_aet: str, aet: str, context:
   return association
 
 
+# A requested context is either an abstract syntax or a tuple of an abstract
+# syntax and the transfer syntax(es) to propose for it
+RequestedContext = Union[str, Tuple[str, Union[str, Sequence[str]]]]
+PoolKey = Tuple[str, str, str, int, Tuple[Tuple[str, Tuple[str, ...]], ...]]
+
+
+class AssociationPool:
+  """
+  Process wide pool of established associations
+
+  Establishing an association costs a TCP connection and an A-ASSOCIATE
+  handshake, which dominates the time of short queries. Instead of releasing
+  an association after use, it's handed back to the pool and reused by the
+  next caller which asks for an association with the same calling AET, peer
+  AET, IP, port and presentation contexts.
+
+  Remarks:
+    Idle associations are released once they have been unused for longer than
+    idle_timeout. This must be lower than the network timeout of pynetdicom
+    (60 sec.), otherwise pynetdicom aborts them underneath the pool.
+
+    Before an idle association is reused it's probed with a C-ECHO, if the peer
+    accepted the Verification context, so dead connections are never handed out.
+
+    At most max_per_peer associations are borrowed from a peer at once, further
+    callers wait up to borrow_timeout for one to be handed back. A caller
+    needing several associations to the same peer at once, e.g. one for C-FIND
+    and one for C-MOVE, must borrow them together with borrow_several, since
+    callers holding one while waiting for the other can block each other.
+  """
+  def __init__(self, idle_timeout: float, max_per_peer: int, borrow_timeout: float):
+    """
+    Args:
+      idle_timeout: seconds an unused association is kept open
+      max_per_peer: max number of associations borrowed from, or kept idle
+                    for, a single peer
+      borrow_timeout: seconds to wait for an association to a peer, which
+                      already has max_per_peer associations borrowed
+    """
+    self.idle_timeout = idle_timeout
+    self.max_per_peer = max_per_peer
+    self.borrow_timeout = borrow_timeout
+    self._lock = threading.Lock()
+    self._idle: Dict[PoolKey, List[Tuple[Association, float]]] = { }
+    self._borrowed: Dict[Tuple[str, str, int], int] = { }
+    self._handed_back = threading.Condition(self._lock)
+
+  @staticmethod
+  def _normalize_contexts(contexts: Sequence[RequestedContext]) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    normalized = [ ]
+    for context in contexts:
+      if isinstance(context, tuple):
+        abstract_syntax, transfer_syntaxes = context
+        if isinstance(transfer_syntaxes, str):
+          transfer_syntaxes = [transfer_syntaxes]
+        normalized.append((str(abstract_syntax), tuple(str(ts) for ts in transfer_syntaxes)))
+      else:
+        normalized.append((str(context), ()))
+    return tuple(normalized)
+
+  def _acquire(self, peer: Tuple[str, str, int], count: int) -> bool:
+    """
+    Reserves count associations to a peer, all at once
+
+    Returns:
+      False if they weren't available within borrow_timeout
+    """
+    deadline = time.monotonic() + self.borrow_timeout
+    with self._handed_back:
+      while self._borrowed.get(peer, 0) + count > self.max_per_peer:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        self._handed_back.wait(remaining)
+      self._borrowed[peer] = self._borrowed.get(peer, 0) + count
+    return True
+
+  def _release(self, peer: Tuple[str, str, int], count: int) -> None:
+    with self._handed_back:
+      self._borrowed[peer] -= count
+      if not self._borrowed[peer]:
+        del self._borrowed[peer]
+      self._handed_back.notify_all()
+
+  def _idle_count(self, peer: Tuple[str, str, int]) -> int:
+    return sum(len(entries) for key, entries in self._idle.items() if key[1:4] == peer)
+
+  def _is_alive(self, assoc: Association, logger: logging.Logger) -> bool:
+    """
+    Checks if an idle association is still usable, by sending a C-ECHO if
+    the peer accepted the Verification context
+    """
+    if not assoc.is_established:
+      return False
+
+    accepted_echo = any(context.abstract_syntax == Verification for context in assoc.accepted_contexts)
+    if not accepted_echo:
+      return True
+
+    try:
+      status = assoc.send_c_echo()
+    except Exception as e:
+      logger.info(f"C-ECHO liveness probe to {assoc.acceptor.ae_title} failed with: {e}")
+      return False
+
+    return bool(status) and 'Status' in status and status.Status == 0x0000
+
+  def _take_idle(self, key: PoolKey, logger: logging.Logger) -> Optional[Association]:
+    now = time.monotonic()
+    while True:
+      with self._lock:
+        entries = self._idle.get(key, [])
+        if not entries:
+          return None
+        assoc, idle_since = entries.pop()
+
+      if now - idle_since > self.idle_timeout or not self._is_alive(assoc, logger):
+        self._discard(assoc)
+        continue
+
+      return assoc
+
+  def _create(self, key: PoolKey, logger: logging.Logger) -> Optional[Association]:
+    calling_aet, aet, ip, port, contexts = key
+    try:
+      ae = AE(ae_title=calling_aet)
+    except ValueError:
+      # If AET is empty then a ValueError is thrown by pynetdicom
+      logger.info(f"Failed to create AE with calling aet: '{calling_aet}'")
+      return None
+
+    for abstract_syntax, transfer_syntaxes in contexts:
+      if transfer_syntaxes:
+        ae.add_requested_context(abstract_syntax, transfer_syntax=list(transfer_syntaxes))
+      else:
+        ae.add_requested_context(abstract_syntax)
+    if Verification not in [abstract_syntax for abstract_syntax, _ in contexts]:
+      ae.add_requested_context(Verification)
+
+    return establish_assoc(ae, ip, port, aet, logger)
+
+  def _discard(self, assoc: Association) -> None:
+    try:
+      if assoc.is_established:
+        assoc.release()
+      else:
+        assoc.abort()
+    except Exception:
+      pass
+
+  def _give_back(self, key: PoolKey, assoc: Association) -> None:
+    if not assoc.is_established:
+      return
+
+    with self._lock:
+      if self._idle_count(key[1:4]) < self.max_per_peer:
+        self._idle.setdefault(key, []).append((assoc, time.monotonic()))
+        return
+
+    self._discard(assoc)
+
+  @contextmanager
+  def borrow(self,
+      calling_aet: str,
+      ip: str,
+      port: Union[int, str],
+      aet: str,
+      contexts: Sequence[RequestedContext],
+      logger: logging.Logger = ae_logger
+    ) -> Iterator[Optional[Association]]:
+    """
+    Borrows an established association from the pool, establishing a new one
+    if none are available. The association is handed back on exit.
+
+    Args:
+      calling_aet: your AET
+      ip: IPv4 address of AET to connect to
+      port: port to connect over
+      aet: AET to connect to
+      contexts: requested presentation contexts
+
+    Kwargs:
+      logger: logger to report connection problems to
+
+    Yields:
+      The established association, None if unable to connect, or if no
+      association to the peer was handed back within borrow_timeout
+
+    Remark:
+      If an exception escapes the with-block the association is in an unknown
+      state, so it's aborted rather than handed back to the pool.
+      Callers must not release the association themselves.
+    """
+    with self.borrow_several(calling_aet, ip, port, aet, [contexts], logger) as associations:
+      yield associations[0] if associations else None
+
+  @contextmanager
+  def borrow_several(self,
+      calling_aet: str,
+      ip: str,
+      port: Union[int, str],
+      aet: str,
+      contexts_list: Sequence[Sequence[RequestedContext]],
+      logger: logging.Logger = ae_logger
+    ) -> Iterator[Optional[List[Association]]]:
+    """
+    Borrows an association to the same peer for each set of presentation
+    contexts, reserving all of them at once, see borrow
+
+    Args:
+      calling_aet: your AET
+      ip: IPv4 address of AET to connect to
+      port: port to connect over
+      aet: AET to connect to
+      contexts_list: requested presentation contexts of each association
+
+    Kwargs:
+      logger: logger to report connection problems to
+
+    Yields:
+      The established associations in the order of contexts_list, None if
+      unable to establish any of them, or if they weren't handed back within
+      borrow_timeout
+
+    Raises:
+      ValueError: if more than max_per_peer associations are asked for
+    """
+    peer = (aet, ip, int(port))
+    count = len(contexts_list)
+    if count > self.max_per_peer:
+      raise ValueError(f"Unable to borrow {count} associations, at most {self.max_per_peer} are allowed per peer")
+
+    if not self._acquire(peer, count):
+      logger.error(f"Timed out waiting for {count} associations to {aet}, {self.max_per_peer} associations are in use")
+      yield None
+      return
+
+    try:
+      borrowed = [ ]
+      for contexts in contexts_list:
+        key = (calling_aet, aet, ip, int(port), self._normalize_contexts(contexts))
+        assoc = self._take_idle(key, logger)
+        if assoc is None:
+          assoc = self._create(key, logger)
+        if assoc is None:
+          break
+        borrowed.append((key, assoc))
+
+      if len(borrowed) < count:
+        for key, assoc in borrowed:
+          self._give_back(key, assoc)
+        yield None
+        return
+
+      try:
+        yield [assoc for _, assoc in borrowed]
+      except BaseException:
+        for _, assoc in borrowed:
+          assoc.abort()
+        raise
+
+      for key, assoc in borrowed:
+        self._give_back(key, assoc)
+    finally:
+      self._release(peer, count)
+
+  def clear(self) -> None:
+    """
+    Releases all idle associations in the pool
+    """
+    with self._lock:
+      entries = [assoc for idle in self._idle.values() for assoc, _ in idle]
+      self._idle = { }
+
+    for assoc in entries:
+      self._discard(assoc)
+
+
+association_pool = AssociationPool(
+  server_config.ASSOCIATION_POOL_IDLE_TIMEOUT,
+  server_config.ASSOCIATION_POOL_MAX_PER_PEER,
+  server_config.ASSOCIATION_POOL_BORROW_TIMEOUT
+)
+
+
 def create_find_AE_worklist(ae_title: str) -> AE:
   """
     Creates an pynetdicom.AE object with the find Context, ready to send a find
@@ -254,6 +546,61 @@ def send_find(association, query_ds, process, query_model=StudyRootQueryRetrieve
   __handle_find_resp(resp, process, *args, **kwargs)
 
 
+def iter_find(association, query_ds, query_model=StudyRootQueryRetrieveInformationModelFind, msg_id: int=1, **kwargs) -> Iterator[Dataset]:
+  """
+  Sends a C_FIND query request and yields the response identifiers as they arrive
+
+  Args:
+    association: an established association
+    query_ds: pydicom dataset containing the query parameters
+
+  Kwargs:
+    query_model: which query model to use (see DICOM standard for specifics)
+    msg_id: message ID of the C_FIND request
+    logger: logger to report failed responses to
+
+  Yields:
+    The identifier (dataset) of each pending response
+
+  Raises:
+    ValueError: if the association is None
+
+  Remark:
+    If the generator is closed before the query completes, e.g. because the
+    caller has enough results, a C_CANCEL is sent and the remaining responses
+    are read and discarded, so the association can be reused afterwards.
+  """
+  # Handle None as association
+  if not association:
+    raise ValueError("'association' cannot be NoneType object when making an iter_find call")
+
+  # Retrieve logger if given
+  if 'logger' in kwargs:
+    logger = kwargs['logger']
+  else:
+    logger = ae_logger
+
+  logger.info(f"Sending C_FIND query to {association.acceptor.ae_title} with {query_ds}")
+  resp = association.send_c_find(query_ds, query_model=query_model, msg_id=msg_id)
+
+  completed = False
+  try:
+    for status, identifier in resp:
+      if 'Status' not in status:
+        logger.error(f'Dataset does not have status attribute\n Status:\n{status}')
+      elif status.Status == DATASET_AVAILABLE:
+        yield identifier
+      elif status.Status != TRANSFER_COMPLETE:
+        logger.info(f"Failed to transfer dataset, with status: {status.Status}")
+    completed = True
+  finally:
+    if not completed and association.is_established:
+      logger.info(f"Cancelling C_FIND query to {association.acceptor.ae_title}")
+      association.send_c_cancel(msg_id, query_model=query_model)
+      for _ in resp:
+        pass
+
+
 def send_move(association, to_aet, query_ds, process: Callable, query_model=StudyRootQueryRetrieveInformationModelMove, *args, **kwargs) -> None:
   """
   Sends a C_FIND query request to an association using the supplied dataset
@@ -288,3 +635,61 @@ def send_move(association, to_aet, query_ds, process: Callable, query_model=Stud
   logger.info(f"Sending C_MOVE query to {association.acceptor.ae_title}")
   resp = association.send_c_move(query_ds, to_aet, query_model=query_model)
   __handle_move_resp(resp, process, *args, **kwargs)
+
+
+def move_and_wait(association, to_aet, query_ds, query_model=StudyRootQueryRetrieveInformationModelMove, *args, **kwargs) -> Optional[Path]:
+  """
+  Sends a C_MOVE request and waits for the store SCP to report the moved dataset
+
+  Args:
+    association: an established association
+    to_aet: AET of where to send responses, i.e. the AET of our store SCP
+    query_ds: pydicom dataset containing the query parameters, must have an AccessionNumber
+
+  Kwargs:
+    query_model: which query model to use (see DICOM standard for specifics)
+    timeout: seconds to wait for the store SCP after the move completed
+             (Default=server_config.MOVE_NOTIFY_TIMEOUT)
+
+  Returns:
+    Path to the moved dataset, None if the move failed or the dataset didn't arrive
+
+  Raises:
+    ValueError: if the association is None
+
+  Remark:
+    Each call uses its own message ID, so several moves, also of the same
+    accession number, can run at once. See move_notifier for details.
+  """
+  # Handle None as association
+  if not association:
+    raise ValueError("'association' cannot be NoneType object when making a move_and_wait call")
+
+  # Retrieve logger if given
+  if 'logger' in kwargs:
+    logger = kwargs['logger']
+  else:
+    logger = ae_logger
+
+  timeout = kwargs.get('timeout', server_config.MOVE_NOTIFY_TIMEOUT)
+
+  with move_notifier.MoveWaiter(query_ds.AccessionNumber) as waiter:
+    logger.info(f"Sending C_MOVE query to {association.acceptor.ae_title} for {query_ds.AccessionNumber}")
+    resp = association.send_c_move(query_ds, to_aet, query_model=query_model, msg_id=waiter.message_id)
+
+    transfer_complete = False
+    for status, identifier in resp:
+      if 'Status' in status:
+        if status.Status == DATASET_AVAILABLE:
+          pass
+        elif status.Status == TRANSFER_COMPLETE:
+          transfer_complete = True
+        else:
+          logger.info(f"Failed to transfer dataset, with status: {hex(status.Status)}")
+      else:
+        logger.error(f'Dataset does not have status attribute\n Status:\n{status}')
+
+    if not transfer_complete:
+      return None
+
+    return waiter.wait(timeout)
@@ -0,0 +1,163 @@
+#Python packages
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Iterable, List
+
+#Custom modules
+from . import archive
+from . import cache
+from . import dicomlib
+from . import enums
+from . import pacs_outbox
+from . import plot_jobs
+from . import server_config
+from . import study_store
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file approves controlled studies, i.e. stamps them with the BAM ID of
+  the approving user, queues them for PACS and moves them out of the study
+  store, see approve.
+
+  A study is claimed, i.e. moved from CONTROL to APPROVING, before it's
+  written, so a study approved by two requests at once is only approved by
+  one of them.
+
+  Studies approved together are sent to PACS at once over a single
+  association, instead of waiting for the PACS sender service, such that the
+  user gets the result of each study.
+"""
+
+
+@dataclass
+class ApprovalResult:
+  """
+  Result of approving a single study
+
+  Attributes:
+    accession_number: accession number of the study
+    queued: whether the study was approved and queued for PACS
+    sent: whether the study was sent to PACS, queued studies not sent are
+          sent by the PACS sender service
+    error: why the study wasn't approved or sent, empty if it was
+  """
+  accession_number: str
+  queued: bool = False
+  sent: bool = False
+  error: str = ''
+
+  def to_dict(self) -> dict:
+    return asdict(self)
+
+
+def format_bamid(bamid: str) -> str:
+  return bamid.lower().swapcase()
+
+
+def finish_study(hospital: models.Hospital, accession_number: str, dataset) -> None:
+  """
+  Moves an approved study from the study store to the search cache and archive
+
+  Args:
+    hospital: hospital of the study
+    accession_number: accession number of the study
+    dataset: the approved study
+  """
+  try:
+    study_store.archive(hospital.short_name, accession_number)
+    cache.index_study(accession_number, dataset)
+  except OSError as error:
+    logger.error(f'Could not move {accession_number} to the search cache, got exception {error}')
+
+  # Store the RIS number in the HandleExaminations table
+  models.HandledExaminations.objects.create(accession_number=accession_number)
+  archive.archive_examination(dataset, hospital=hospital)
+
+
+def release(hospital: models.Hospital, accession_number: str) -> None:
+  """
+  Returns a study claimed for approval to the control list
+  """
+  study_store.transition(hospital.short_name, accession_number, enums.StudyState.APPROVING, enums.StudyState.CONTROL)
+
+
+def approve(user: models.User, accession_numbers: Iterable[str], bamid: str, send: bool=True) -> List[ApprovalResult]:
+  """
+  Approves controlled studies and queues them for PACS
+
+  Args:
+    user: the approving user, the studies must be in the control list of the user's hospital
+    accession_numbers: accession numbers of the studies
+    bamid: BAM ID of the approving user
+
+  Kwargs:
+    send: whether to send the studies to PACS before returning, otherwise
+          the PACS sender service sends them
+
+  Returns:
+    The result of each study, in the order of accession_numbers
+  """
+  hospital = user.department.hospital
+  address = user.department.config.pacs
+  results = [ApprovalResult(accession_number) for accession_number in dict.fromkeys(accession_numbers)]
+
+  if not address:
+    for result in results:
+      result.error = "No PACS address in configuration"
+    return results
+
+  AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
+  # Studies sent below are kept from the PACS sender service while they are sent
+  delay = server_config.PACS_OUTBOX_CLAIM_TIME if send else 0
+  bamid = format_bamid(bamid)
+
+  items = [ ]
+  for result in results:
+    accession_number = result.accession_number
+    if not study_store.transition(hospital.short_name, accession_number, enums.StudyState.CONTROL, enums.StudyState.APPROVING):
+      result.error = "The study isn't awaiting approval"
+      continue
+
+    # The plot must be in the study before it's sent, see plot_jobs
+    plot_job = plot_jobs.get_latest(accession_number)
+    if plot_job and plot_job.state == enums.PlotJobState.PENDING.value:
+      result.error = "The plot is still being rendered"
+      release(hospital, accession_number)
+      continue
+    if plot_job and plot_job.state == enums.PlotJobState.FAILED.value:
+      result.error = "The plot couldn't be rendered, calculate the study again"
+      release(hospital, accession_number)
+      continue
+
+    file_path = Path(study_store.get_study_dir(hospital.short_name, accession_number), f'{accession_number}.dcm')
+    try:
+      dataset = dicomlib.dcmread_wrapper(file_path)
+      dicomlib.fill_dicom(dataset, bamid=bamid)
+      dicomlib.save_dicom(file_path, dataset)
+      item = pacs_outbox.enqueue(dataset, AE_title, address, delay=delay)
+    except Exception as e:
+      logger.error(f"Failed to approve {accession_number}, got exception {e}")
+      result.error = "Unable to save the study"
+      release(hospital, accession_number)
+      continue
+
+    finish_study(hospital, accession_number, dataset)
+    logger.info(f"User:{user.username} has approved {accession_number} for PACS")
+
+    result.queued = True
+    items.append((result, item))
+
+  if items:
+    cache.evict_to_budget(keep=[result.accession_number for result, _ in items])
+
+  if send and items:
+    peer = (AE_title, address.ip, int(address.port), address.ae_title)
+    errors = pacs_outbox.send_batch(peer, [item for _, item in items])
+    for result, item in items:
+      result.error = errors.get(item.id, 'The study was not sent')
+      result.sent = not result.error
+
+  return results
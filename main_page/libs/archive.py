@@ -0,0 +1,318 @@
+#Python packages
+import datetime
+import os
+
+from pathlib import Path
+from pydicom import Dataset
+from typing import List, Optional, Tuple
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove
+
+#Custom modules
+from . import ae_controller
+from . import dataset_creator
+from . import dicomlib
+from . import server_config
+from .clearance_math import clearance_math
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file keeps the local archive of completed examinations, see
+  models.ArchivedExamination, such that they can be searched without
+  querying PACS.
+
+  Examinations are archived when they are approved and sent to PACS. The
+  examinations from before the archive can be backfilled from the search
+  cache with backfill_from_cache, and from PACS with backfill_from_pacs:
+
+    python manage.py backfill_archive [--pacs --date-from YYYYMMDD --date-to YYYYMMDD]
+
+  Examinations found by searching PACS are archived without their clearance
+  details, see archive_search_result. Date ranges where every examination in
+  PACS is archived are recorded as models.SearchCoverage, see record_coverage,
+  so searches within them don't query PACS, see search.py.
+"""
+
+DateRange = Tuple[Optional[datetime.date], Optional[datetime.date]]
+
+
+def parse_date(date_str: Optional[str]) -> Optional[datetime.date]:
+  try:
+    return datetime.datetime.strptime(date_str, "%Y%m%d").date()
+  except (TypeError, ValueError):
+    return None
+
+
+def get_float(dataset: Dataset, keyword: str) -> Optional[float]:
+  try:
+    return float(dataset.get(keyword))
+  except (TypeError, ValueError):
+    return None
+
+
+def archive_examination(
+  dataset: Dataset,
+  hospital: Optional[models.Hospital]=None
+  ) -> models.ArchivedExamination:
+  """
+  Adds a completed examination to the archive, or updates it if it's already archived
+
+  Args:
+    dataset: the completed examination
+
+  Kwargs:
+    hospital: the hospital which performed the examination, if known
+
+  Returns:
+    The archived examination
+  """
+  height = get_float(dataset, 'PatientSize')
+  weight = get_float(dataset, 'PatientWeight')
+  bsa_method = str(dataset.get('BSAmethod', ''))
+
+  try:
+    bsa = clearance_math.surface_area(height * 100, weight, bsa_method)
+  except (TypeError, ValueError):
+    bsa = None
+
+  clear_tests = dataset.get('ClearTest')
+
+  fields = {
+    'patient_id'           : str(dataset.get('PatientID', '')),
+    'patient_name'         : str(dataset.get('PatientName', '')),
+    'patient_sex'          : str(dataset.get('PatientSex', '')),
+    'patient_birth_date'   : parse_date(dataset.get('PatientBirthDate')),
+    'patient_height'       : height,
+    'patient_weight'       : weight,
+    'study_date'           : parse_date(dicomlib.get_study_date(dataset)),
+    'method'               : str(dataset.get('GFRMethod', '')),
+    'clearance'            : get_float(dataset, 'clearance'),
+    'normalized_clearance' : get_float(dataset, 'normClear'),
+    'bsa'                  : bsa,
+    'bsa_method'           : bsa_method,
+    'thinning_factor'      : get_float(dataset, 'thiningfactor'),
+    'standard_count'       : get_float(dataset, 'stdcnt'),
+    'injection_weight'     : get_float(dataset, 'injWeight'),
+    'sample_count'         : len(clear_tests) if clear_tests else 0,
+    'sop_instance_uid'     : str(dataset.get('SOPInstanceUID', '')),
+  }
+
+  # Don't forget the hospital of an examination archived on approval, when it's backfilled later
+  if hospital is not None:
+    fields['hospital'] = hospital
+
+  examination, _ = models.ArchivedExamination.objects.update_or_create(
+    accession_number=dataset.AccessionNumber,
+    defaults=fields
+  )
+
+  return examination
+
+
+def archive_search_result(dataset: Dataset) -> None:
+  """
+  Adds an examination found by searching PACS to the archive, unless it's already archived
+
+  Args:
+    dataset: C-FIND response of the examination, see pacs.search_query_pacs
+  """
+  if not dataset.get('AccessionNumber'):
+    return
+
+  models.ArchivedExamination.objects.get_or_create(
+    accession_number=dataset.AccessionNumber,
+    defaults={
+      'patient_id'   : str(dataset.get('PatientID', '')),
+      'patient_name' : str(dataset.get('PatientName', '')),
+      'study_date'   : parse_date(dataset.get('StudyDate')),
+    }
+  )
+
+
+def get_completed_accession_numbers() -> set:
+  """
+  Returns:
+    Accession numbers of the archived examinations with clearance details
+  """
+  return set(
+    models.ArchivedExamination.objects.filter(clearance__isnull=False).values_list('accession_number', flat=True)
+  )
+
+
+def uncovered_ranges(date_from: Optional[datetime.date], date_to: Optional[datetime.date]) -> List[DateRange]:
+  """
+  Finds the parts of a date range, where PACS may have examinations which aren't archived
+
+  Args:
+    date_from: first date of the range, None for no lower bound
+    date_to: last date of the range, None for no upper bound
+
+  Returns:
+    The uncovered sub ranges, in order
+  """
+  if date_from is None or date_to is None:
+    return [(date_from, date_to)]
+
+  coverages = models.SearchCoverage.objects.filter(
+    date_from__lte=date_to,
+    date_to__gte=date_from
+  ).order_by('date_from')
+
+  uncovered = [ ]
+  current = date_from
+  for coverage in coverages:
+    if coverage.date_from > current:
+      uncovered.append((current, coverage.date_from - datetime.timedelta(days=1)))
+    current = max(current, coverage.date_to + datetime.timedelta(days=1))
+
+  if current <= date_to:
+    uncovered.append((current, date_to))
+
+  return uncovered
+
+
+def record_coverage(date_from: datetime.date, date_to: datetime.date) -> None:
+  """
+  Records that every examination in PACS within a date range is archived
+
+  Args:
+    date_from: first date of the range
+    date_to: last date of the range
+
+  Remark:
+    The last SEARCH_COVERAGE_SETTLE_DAYS are left out, since examinations
+    are still being stored to PACS for them. Overlapping and adjacent
+    coverages are merged into one.
+  """
+  last_settled = datetime.date.today() - datetime.timedelta(days=server_config.SEARCH_COVERAGE_SETTLE_DAYS)
+  date_to = min(date_to, last_settled)
+  if date_from > date_to:
+    return
+
+  day = datetime.timedelta(days=1)
+  overlapping = models.SearchCoverage.objects.filter(
+    date_from__lte=date_to + day,
+    date_to__gte=date_from - day
+  )
+  for coverage in overlapping:
+    date_from = min(date_from, coverage.date_from)
+    date_to = max(date_to, coverage.date_to)
+
+  overlapping.delete()
+  models.SearchCoverage.objects.create(date_from=date_from, date_to=date_to)
+
+
+def backfill_from_cache() -> Tuple[int, int]:
+  """
+  Archives the examinations in the search cache, which aren't archived yet
+
+  Returns:
+    The number of archived examinations and the number of examinations which couldn't be read
+  """
+  archived_accession_numbers = get_completed_accession_numbers()
+
+  archived = 0
+  failed = 0
+  for accession_number in models.SearchCacheEntry.objects.values_list('accession_number', flat=True).iterator():
+    if accession_number in archived_accession_numbers:
+      continue
+
+    filepath = Path(server_config.SEARCH_CACHE_DIR, accession_number, f"{accession_number}.dcm")
+    try:
+      archive_examination(dicomlib.dcmread_wrapper(filepath, header_only=True))
+      archived += 1
+    except Exception as e:
+      logger.error(f"Unable to archive {filepath}, got exception {e}")
+      failed += 1
+
+  logger.info(f"Archived {archived} examinations from the search cache, {failed} failed")
+
+  return archived, failed
+
+
+def backfill_from_pacs(config: models.Config, date_from: str, date_to: str) -> Tuple[int, int]:
+  """
+  Archives the examinations in PACS within a date range, which aren't archived yet
+
+  Args:
+    config: configuration of the department whose PACS is crawled
+    date_from: first study date to crawl, on the form YYYYMMDD
+    date_to: last study date to crawl, on the form YYYYMMDD
+
+  Returns:
+    The number of archived examinations and the number of examinations which couldn't be retrieved
+
+  Remark:
+    Every examination not yet archived is moved from PACS, this is slow and
+    meant to be run once, outside of working hours.
+  """
+  if not config.storage:
+    raise ValueError("No PACS address in configuration")
+
+  AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
+
+  found = [ ]
+  def process_incoming_dataset(dataset, *args, **kwargs):
+    if str(dataset.get('SeriesDescription', '')).startswith('Clearance') and dataset.get('AccessionNumber'):
+      found.append(dataset)
+
+  with ae_controller.association_pool.borrow(
+      AE_title,
+      config.storage.ip,
+      config.storage.port,
+      config.storage.ae_title,
+      [StudyRootQueryRetrieveInformationModelFind],
+      logger
+    ) as find_association:
+    if not find_association:
+      raise ValueError("Unable to associate with PACS")
+
+    ae_controller.send_find(
+      find_association,
+      dataset_creator.create_search_dataset('', '', date_from, date_to, ''),
+      process_incoming_dataset,
+      logger=logger
+    )
+
+  archived_accession_numbers = get_completed_accession_numbers()
+
+  archived = 0
+  failed = 0
+  with ae_controller.association_pool.borrow(
+      AE_title,
+      config.storage.ip,
+      config.storage.port,
+      config.storage.ae_title,
+      [StudyRootQueryRetrieveInformationModelMove],
+      logger
+    ) as move_association:
+    if not move_association:
+      raise ValueError("Unable to associate with PACS")
+
+    for query_dataset in found:
+      if query_dataset.AccessionNumber in archived_accession_numbers:
+        continue
+
+      target_file = ae_controller.move_and_wait(move_association, AE_title, query_dataset, logger=logger)
+      if target_file is None:
+        failed += 1
+        continue
+
+      try:
+        archive_examination(dicomlib.dcmread_wrapper(target_file, header_only=True))
+        archived += 1
+      except Exception as e:
+        logger.error(f"Unable to archive {query_dataset.AccessionNumber}, got exception {e}")
+        failed += 1
+      finally:
+        os.unlink(target_file)
+
+  coverage_from, coverage_to = parse_date(date_from), parse_date(date_to)
+  if not failed and coverage_from and coverage_to:
+    record_coverage(coverage_from, coverage_to)
+
+  logger.info(f"Archived {archived} examinations from PACS, {failed} failed")
+
+  return archived, failed
@@ -1,10 +1,12 @@
 #Python packages
 import datetime
-import glob
 import shutil
+import pydicom
 
-from typing import Union, Type, List
+from typing import Union, Type, List, Optional, Tuple, Iterable
 from pathlib import Path
+from django.db.models import F, Q, Sum
+from django.utils import timezone
 
 #Custom modules
 from . import dicomlib
@@ -12,6 +14,7 @@ from . import server_config
 from .query_wrappers import pacs_query_wrapper
 
 from main_page import log_util
+from main_page import models
 
 logger = log_util.get_logger(__name__)
 """
@@ -25,6 +28,17 @@ logger = log_util.get_logger(__name__)
 
   Historic Studies are not gathered when the server retrieves an old study
 
+  Every study in the cache have a models.SearchCacheEntry row with its study
+  date and size, such that the cache can be cleaned and searched without
+  reading any dicom files. Studies must therefore be moved in and out of the
+  cache through this file, or be indexed with index_study afterwards.
+  The index can be rebuilt from disk with rebuild_index, which is run by the
+  rebuild_cache_index management command.
+
+  Besides the GDPR life time enforced by clean_cache, the cache is kept within
+  server_config.SEARCH_CACHE_MAX_BYTES by evicting the least recently
+  retrieved studies. Hits, misses, evictions and expirations are counted in
+  models.SearchCacheStatistics, see get_statistics.
 """
 
 def move_file_to_cache(filepath, accession_number: str, overwrite=True):
@@ -64,6 +78,9 @@ def move_file_to_cache(filepath, accession_number: str, overwrite=True):
     target_dir.mkdir()
     shutil.move(str(filepath), str(target))
 
+  index_study(accession_number)
+  evict_to_budget(keep=[accession_number])
+
   return True
 
 
@@ -83,8 +100,12 @@ def retrieve_file_from_cache(user,accession_number: str, ask_pacs=True):
   target = Path(server_config.SEARCH_CACHE_DIR, accession_number, f'{accession_number}.dcm')
 
   if target.exists():
+    touch_study(accession_number)
+    count_statistics(hits=1)
     return dicomlib.dcmread_wrapper(target)
-  elif not(ask_pacs):
+
+  count_statistics(misses=1)
+  if not(ask_pacs):
     return None
 
   dataset, path_to_dataset = pacs_query_wrapper.get_study(user, accession_number)
@@ -96,11 +117,86 @@ def retrieve_file_from_cache(user,accession_number: str, ask_pacs=True):
   return dataset
 
 
-def get_all_cache_studies():
-  studies_dirs = glob.glob(f'{server_config.SEARCH_CACHE_DIR}/*')
-  accession_numbers = [ study_dir.split('/')[-1] for study_dir in studies_dirs]
-  # Just be happy i didn't put a list comprehention in my list comprehention
-  return [ dicomlib.dcmread_wrapper(Path(server_config.SEARCH_CACHE_DIR, accession_number, f'{accession_number}.dcm')) for accession_number in accession_numbers]
+def get_study_dir_size(study_dir: Path) -> int:
+  # History files are links into the history store, and aren't counted
+  return sum(path.stat().st_size for path in study_dir.rglob('*') if path.is_file() and not path.is_symlink())
+
+
+def read_study_date(accession_number: str, dataset: Optional[pydicom.Dataset]=None) -> Optional[datetime.date]:
+  """
+    Finds the study date of a study in the cache
+
+    Args:
+      accession_number: The accession of the study
+    Kwargs:
+      dataset: The dataset of the study, if the caller already have it read
+    Returns:
+      The study date or None if it could not be determined
+  """
+  if dataset is None:
+    target = Path(server_config.SEARCH_CACHE_DIR, accession_number, f'{accession_number}.dcm')
+    try:
+      # The study date is in the header, so there's no need to read the pixel data
+      dataset = dicomlib.dcmread_wrapper(target, header_only=True)
+    except (OSError, pydicom.errors.InvalidDicomError) as e:
+      logger.error(f'Could not read study date of {target}, got exception {e}')
+      return None
+
+  study_date_str = dicomlib.get_study_date(dataset)
+  if not study_date_str:
+    return None
+
+  try:
+    return datetime.datetime.strptime(study_date_str, "%Y%m%d").date()
+  except ValueError:
+    return None
+
+
+def index_study(accession_number: str, dataset: Optional[pydicom.Dataset]=None) -> None:
+  """
+    Adds or updates a study in the cache index, an updated study keeps the
+    time it was inserted into the cache
+
+    Args:
+      accession_number: The accession of the study, the study must be in the cache
+    Kwargs:
+      dataset: The dataset of the study, saves reading it if the caller have it
+  """
+  study_dir = Path(server_config.SEARCH_CACHE_DIR, accession_number)
+  models.SearchCacheEntry.objects.update_or_create(
+    accession_number=accession_number,
+    defaults={
+      'study_date' : read_study_date(accession_number, dataset),
+      'size'       : get_study_dir_size(study_dir),
+    }
+  )
+
+
+def unindex_study(accession_number: str) -> None:
+  models.SearchCacheEntry.objects.filter(accession_number=accession_number).delete()
+
+
+def rebuild_index(reindex_all: bool=False) -> Tuple[int, int]:
+  """
+    Brings the cache index up to date with the studies on disk
+
+    Kwargs:
+      reindex_all: if True every study is indexed again, otherwise only the studies missing from the index
+    Returns:
+      The number of indexed studies and the number of removed index entries
+  """
+  cache_dir = Path(server_config.SEARCH_CACHE_DIR)
+  cached = { study_dir.name for study_dir in cache_dir.iterdir() if study_dir.is_dir() } if cache_dir.exists() else set()
+  indexed = set(models.SearchCacheEntry.objects.values_list('accession_number', flat=True))
+
+  stale = indexed - cached
+  models.SearchCacheEntry.objects.filter(accession_number__in=stale).delete()
+
+  missing = cached if reindex_all else cached - indexed
+  for accession_number in missing:
+    index_study(accession_number)
+
+  return len(missing), len(stale)
 
 
 def clean_cache(life_time: int):
@@ -109,16 +205,102 @@ def clean_cache(life_time: int):
 
       Args:
         life-time - The amount of days that studies may life in the cache
+
+      Remark:
+        The study dates are read from the cache index, studies put in the cache
+        without being indexed are only cleaned once indexed, see the
+        rebuild_cache_index management command.
     """
-    now = datetime.datetime.now()
-    studies = get_all_cache_studies()
-    for study in studies:
-      study_datetime = datetime.datetime.strptime(dicomlib.get_study_date(study), "%Y%m%d")
-      time_diff = now - study_datetime
-      if time_diff.days > life_time:
-        #This study is too old and should be deleted!
-        target_path = Path(server_config.SEARCH_CACHE_DIR, study.AccessionNumber)
-        shutil.rmtree(target_path)
+    cutoff = timezone.now() - datetime.timedelta(days=life_time)
+    # Studies without a study date are kept for life_time days after entering the cache
+    expired = models.SearchCacheEntry.objects.filter(
+      Q(study_date__lt=cutoff.date()) | Q(study_date__isnull=True, inserted__lt=cutoff)
+    )
+    expired_accession_numbers = list(expired.values_list('accession_number', flat=True))
+    for accession_number in expired_accession_numbers:
+      #This study is too old and should be deleted!
+      target_path = Path(server_config.SEARCH_CACHE_DIR, accession_number)
+      shutil.rmtree(target_path, ignore_errors=True)
+    models.SearchCacheEntry.objects.filter(accession_number__in=expired_accession_numbers).delete()
+    count_statistics(expirations=len(expired_accession_numbers))
+
+    evict_to_budget()
+
+def count_statistics(**counters: int) -> None:
+  """
+    Adds to the cache counters
+
+    Kwargs:
+      hits, misses, evictions and/or expirations to add
+  """
+  counters = { counter: value for counter, value in counters.items() if value }
+  if not counters:
+    return
+
+  models.SearchCacheStatistics.objects.get_or_create(id=1)
+  models.SearchCacheStatistics.objects.filter(id=1).update(
+    **{ counter: F(counter) + value for counter, value in counters.items() }
+  )
+
+
+def touch_study(accession_number: str) -> None:
+  models.SearchCacheEntry.objects.filter(accession_number=accession_number).update(last_accessed=timezone.now())
+
+
+def evict_to_budget(max_bytes: Optional[int]=None, keep: Iterable[str]=()) -> int:
+  """
+    Deletes the least recently retrieved studies until the cache fits within the byte budget
+
+    Kwargs:
+      max_bytes: The budget, defaults to server_config.SEARCH_CACHE_MAX_BYTES
+      keep: Accession numbers of studies which shouldn't be evicted, e.g. the studies just added
+    Returns:
+      The number of evicted studies
+  """
+  if max_bytes is None:
+    max_bytes = server_config.SEARCH_CACHE_MAX_BYTES
+
+  total_size = models.SearchCacheEntry.objects.aggregate(total=Sum('size'))['total'] or 0
+  if total_size <= max_bytes:
+    return 0
+
+  evicted = []
+  candidates = models.SearchCacheEntry.objects.exclude(accession_number__in=list(keep)).order_by('last_accessed')
+  for accession_number, size in candidates.values_list('accession_number', 'size').iterator():
+    if total_size <= max_bytes:
+      break
+    shutil.rmtree(Path(server_config.SEARCH_CACHE_DIR, accession_number), ignore_errors=True)
+    evicted.append(accession_number)
+    total_size -= size
+
+  models.SearchCacheEntry.objects.filter(accession_number__in=evicted).delete()
+  count_statistics(evictions=len(evicted))
+  logger.info(f'Evicted {len(evicted)} studies from the search cache, {total_size} bytes in use')
+
+  return len(evicted)
+
+
+def get_statistics() -> dict:
+  """
+    Returns:
+      The cache counters together with the current size and budget of the cache
+  """
+  statistics, _ = models.SearchCacheStatistics.objects.get_or_create(id=1)
+  usage = models.SearchCacheEntry.objects.aggregate(size=Sum('size'))
+
+  requests = statistics.hits + statistics.misses
+  return {
+    'hits'        : statistics.hits,
+    'misses'      : statistics.misses,
+    'hit_rate'    : statistics.hits / requests if requests else None,
+    'evictions'   : statistics.evictions,
+    'expirations' : statistics.expirations,
+    'since'       : statistics.since.isoformat(),
+    'studies'     : models.SearchCacheEntry.objects.count(),
+    'size'        : usage['size'] or 0,
+    'max_size'    : server_config.SEARCH_CACHE_MAX_BYTES,
+  }
+
 
 def move_file_from_cache_active_studies(accession_number : str, target_path, move_dir=True ):
   """
@@ -153,6 +335,8 @@ def move_file_from_cache_active_studies(accession_number : str, target_path, mov
     shutil.move(str(study_path), str(target_path))
     shutil.rmtree(str(study_dir))
 
+  unindex_study(accession_number)
+
 
 def file_in_cache(accession_number):
-  return Path(server_config.SEARCH_CACHE_DIR, accession_number).exists()
+  return models.SearchCacheEntry.objects.filter(accession_number=accession_number).exists()
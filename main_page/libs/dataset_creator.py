@@ -144,16 +144,28 @@ def get_blank(
   return ds
 
 
-def generate_ris_query_dataset(ris_calling: str='') -> Type[Dataset]:
+def generate_ris_query_dataset(ris_calling: str='', date_from: date=None, date_to: date=None) -> Type[Dataset]:
   """
   Generates a dataset for quering RIS
 
   Args:
     ris_calling: AET for RIS station to retreive studies from, e.g. RH_EDTA, EDTA_GLO, etc.
 
+  Kwargs:
+    date_from: first scheduled procedure step start date to query, open ended if None
+    date_to: last scheduled procedure step start date to query, today if None
+
   Returns:
     Generated dataset used to query rigs
+
+  Remark:
+    If neither date is given, every study scheduled up to today is queried.
   """
+  if date_to is None:
+    date_to = date.today()
+
+  date_range = f"{date_from.strftime('%Y%m%d') if date_from else ''}-{date_to.strftime('%Y%m%d')}"
+
   # Create new dataset
   ds = Dataset()
   
@@ -177,7 +189,7 @@ def generate_ris_query_dataset(ris_calling: str='') -> Type[Dataset]:
   
   Sequenceset.add_new(0x00080060, 'CS', '')           # Modality
   Sequenceset.add_new(0x00400001, 'AE', ris_calling) # ScheduledStationAETitle
-  Sequenceset.add_new(0x00400002, 'DA', '-' +date.today().strftime("%Y%m%d"))           # ScheduledProcedureStepStartDate
+  Sequenceset.add_new(0x00400002, 'DA', date_range)   # ScheduledProcedureStepStartDate
   Sequenceset.add_new(0x00400003, 'TM', '')           # ScheduledProcedureStepStartTime
   Sequenceset.add_new(0x00400007, 'LO', '')           # ScheduledProcedureStepDescription
   Sequenceset.add_new(0x00400009, 'SH', '')           # ScheduledProcedureStepID
@@ -1,12 +1,10 @@
-import pathlib
 import datetime
-import glob
-import shutil
 
 from pydicom import Dataset, Sequence
 from typing import List
 
 from main_page.libs import dicomlib
+from main_page.libs import history_store
 from main_page.libs import server_config
 from main_page import log_util
 
@@ -49,16 +47,11 @@ def get_history(dataset: Dataset, active_hospital):
 
   birthday = datetime.datetime.strptime(dataset.PatientBirthDate,'%Y%m%d') 
 
-  #Get all file paths for the Accession number
-  curr_dicom_path = f"{server_config.FIND_RESPONS_DIR}{active_hospital}/{dataset.AccessionNumber}/{dataset.AccessionNumber}.dcm"
-  dicom_filepaths = glob.glob(f'{server_config.FIND_RESPONS_DIR}{active_hospital}/{dataset.AccessionNumber}/*.dcm')
-  #Filter the already opened dataset out
-  history_filepaths = filter(lambda x: x != curr_dicom_path, dicom_filepaths)
+  #Get the summarised history of the study, see history_store.write_history_summary
+  study_dir = f"{server_config.FIND_RESPONS_DIR}{active_hospital}/{dataset.AccessionNumber}"
 
   #Iterate through the datasets
-  for history_filepath in history_filepaths:
-    #Open the dataset
-    history_dataset = dicomlib.dcmread_wrapper(history_filepath)
+  for history_dataset in history_store.read_history_summary(study_dir):
     #Create History dataset for history datasets
     try:
       date_of_examination = datetime.datetime.strptime(history_dataset.StudyDate,'%Y%m%d')
@@ -81,41 +74,9 @@ def get_history(dataset: Dataset, active_hospital):
       sequence_dataset.injTime          = history_dataset.injTime
       history_sequence.append(sequence_dataset)
     except AttributeError as E:
-      logger.error(f'Sequence dataset {history_filepath} has invalid format with {E}')
+      logger.error(f'Sequence dataset {history_dataset.get("AccessionNumber")} has invalid format with {E}')
 
   if len(history_sequence):
     dataset.add_new(0x0023103F, 'SQ', Sequence(history_sequence))
 
   return date_list, age_list, clearence_norm_list
-
-
-def get_studies(directory: str) -> List[Dataset]:
-  """
-  Get the list of studies from a directory
-
-  Programmer Remarks:
-    This is not specific enough to be in ris_query_wrapper and should be moved to an
-    appropriate folder
-
-  Args:
-    directory: path to directory containing studies
-
-  Returns:
-    List of pydicom datasets of all studies currently in the
-    datasets_dir directory
-  """
-  datasets = [ ]
-
-  for dataset_dir in pathlib.Path(directory).glob('*'):
-    accession_number = dataset_dir.name
-    dataset_dir = f"{directory}/{accession_number}"
-    dataset_filepath = f"{dataset_dir}/{accession_number}.dcm"
-
-    try:
-      datasets.append(dicomlib.dcmread_wrapper(dataset_filepath))
-    except FileNotFoundError:
-      # The sub file doesn't exist, delete the directory
-      logger.info(f"Deleting directory, due to missing dicom file in dataset directory: \"{dataset_dir}\"")
-      shutil.rmtree(dataset_dir)
-
-  return datasets
\ No newline at end of file
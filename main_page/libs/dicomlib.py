@@ -3,13 +3,23 @@ from pydicom.values import convert_SQ, convert_string
 from pydicom.dataset import Dataset
 from pydicom.sequence import Sequence
 from pydicom.datadict import DicomDictionary, keyword_dict
+from pydicom.pixel_data_handlers.util import apply_color_lut
 from pydicom import uid
+from PIL import Image
 
 from pathlib import Path
+from io import BytesIO
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, replace
 import numpy as np
+import copy
 import datetime
+import json
+import os
+import threading
+import zlib
 
-from typing import Type, Tuple, List, IO, Any, Union, Optional
+from typing import Type, Tuple, List, IO, Any, Union, Optional, Iterable
 
 from main_page import models
 from main_page.libs import enums
@@ -21,45 +31,94 @@ from main_page import log_util
 logger = log_util.get_logger("GFRLogger")
 
 
+_private_tags_registered = False
+
 def update_private_tags() -> None:
+  global _private_tags_registered
+  if _private_tags_registered:
+    return
+
   # Update DicomDictionary to include our private tags
   DicomDictionary.update(new_dict_items)
 
   new_names_dirc = dict([(val[4], tag) for tag, val in new_dict_items.items()])
   keyword_dict.update(new_names_dirc)
+  _private_tags_registered = True
 
 
-def get_recovered_date(
-  accession_number: str,
-  hospital_shortname: str,
-  active_studies_dir: str=server_config.FIND_RESPONS_DIR,
-  recovered_filename: str=server_config.RECOVERED_FILENAME
-  ) -> str:
+class DatasetCache():
   """
-  Attempts to get the recovery date of a study
+  In process LRU cache of read datasets
 
-  Args:
-    accession_number: accession number of study to get recovery date from
-
-  Kwargs:
-    active_studies_dir: directory containing currently active studies
-    recovered_filename: filename of the recovery file
+  Entries are keyed by the absolute path of the file and whether only the
+  header was read, and only used while the
+  modification time and size of the file are unchanged, so a file rewritten
+  by another process is read again. The size of a cached dataset is estimated
+  by the size of its file.
 
-  Returns:
-    string contaning the recovery date of the study, None otherwise
+  Remarks:
+    Datasets are deep copied when they are put in or taken out of the cache,
+    so callers are free to modify the datasets they get.
   """
-  recover_filepath = Path(
-    active_studies_dir,
-    hospital_shortname,
-    accession_number,
-    recovered_filename
-  )
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._entries: 'OrderedDict[Tuple[str, bool], Tuple[int, int, Dataset]]' = OrderedDict()
+    self._size = 0
+
+  @staticmethod
+  def _key(filepath: Union[str, Path], header_only: bool) -> Tuple[str, bool]:
+    return os.path.abspath(str(filepath)), header_only
+
+  def get(self, filepath: Union[str, Path], stat: os.stat_result, header_only: bool=False) -> Optional[Dataset]:
+    key = self._key(filepath, header_only)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
 
-  try:
-    with open(recover_filepath, 'r') as fp:
-      return fp.readline()
-  except FileNotFoundError:
-    return None
+      mtime, size, dataset = entry
+      if mtime != stat.st_mtime_ns or size != stat.st_size:
+        del self._entries[key]
+        self._size -= size
+        return None
+
+      self._entries.move_to_end(key)
+
+    return copy.deepcopy(dataset)
+
+  def put(self, filepath: Union[str, Path], stat: os.stat_result, dataset: Dataset, header_only: bool=False) -> None:
+    if stat.st_size > self.max_bytes:
+      return
+
+    key = self._key(filepath, header_only)
+    dataset = copy.deepcopy(dataset)
+    with self._lock:
+      old_entry = self._entries.pop(key, None)
+      if old_entry is not None:
+        self._size -= old_entry[1]
+
+      self._entries[key] = (stat.st_mtime_ns, stat.st_size, dataset)
+      self._size += stat.st_size
+
+      while self._size > self.max_bytes:
+        _, (_, size, _) = self._entries.popitem(last=False)
+        self._size -= size
+
+  def invalidate(self, filepath: Union[str, Path]) -> None:
+    with self._lock:
+      for header_only in (False, True):
+        entry = self._entries.pop(self._key(filepath, header_only), None)
+        if entry is not None:
+          self._size -= entry[1]
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+
+dataset_cache = DatasetCache(server_config.DATASET_CACHE_MAX_BYTES)
 
 
 def get_study_date(dataset: Dataset) -> Optional[str]:
@@ -90,7 +149,105 @@ def get_study_date(dataset: Dataset) -> Optional[str]:
   return study_date_str
 
 
-def dcmread_wrapper(filepath: Union[str, Path], is_little_endian: bool=True, is_implicit_VR: bool=True) -> Dataset:
+@dataclass
+class StudySummary:
+  """
+  The information about a study needed by the study lists, stored as a json
+  sidecar next to the dicom file of the study:
+
+    {study_dir}/{AccessionNumber}.summary.json
+
+  The fields are named after the dicom keywords they are taken from, such that
+  a summary can be used in place of a dataset by e.g. get_study_date.
+  StudyDate holds the date found by get_study_date.
+  """
+  AccessionNumber: str
+  PatientID: str
+  PatientName: str
+  StudyDate: Optional[str]
+  StudyDescription: str
+  ScheduledProcedureStepDescription: str
+  ExamStatus: int
+  RecoveredDate: Optional[str] = None
+
+  @classmethod
+  def from_dataset(cls, dataset: Dataset, recovered_date: Optional[str]=None) -> 'StudySummary':
+    try:
+      sps_description = dataset.ScheduledProcedureStepSequence[0].ScheduledProcedureStepDescription
+    except (AttributeError, IndexError):
+      sps_description = ''
+
+    return cls(
+      AccessionNumber=dataset.AccessionNumber,
+      PatientID=str(dataset.get('PatientID', '')),
+      PatientName=str(dataset.get('PatientName', '')),
+      StudyDate=get_study_date(dataset),
+      StudyDescription=str(dataset.get('StudyDescription', '')),
+      ScheduledProcedureStepDescription=str(sps_description),
+      ExamStatus=int(dataset.get('ExamStatus', 0) or 0),
+      RecoveredDate=recovered_date
+    )
+
+
+def get_summary_filepath(study_dir: Union[str, Path], accession_number: str) -> Path:
+  return Path(study_dir, f"{accession_number}.summary.json")
+
+
+def write_study_summary(study_dir: Union[str, Path], summary: StudySummary) -> None:
+  filepath = get_summary_filepath(study_dir, summary.AccessionNumber)
+  # Write to a temporary file first, so the lists never read a partially written summary
+  tmp_filepath = Path(f"{filepath}.tmp")
+  with open(tmp_filepath, 'w') as fp:
+    json.dump(asdict(summary), fp)
+  os.replace(tmp_filepath, filepath)
+
+
+def read_study_summary(study_dir: Union[str, Path], accession_number: str) -> StudySummary:
+  """
+  Reads the summary of a study, creating it from the dicom file if it's missing
+
+  Args:
+    study_dir: directory of the study
+    accession_number: accession number of the study
+
+  Returns:
+    The summary of the study
+
+  Raises:
+    FileNotFoundError: if neither the summary nor the dicom file of the study exists
+  """
+  try:
+    with open(get_summary_filepath(study_dir, accession_number), 'r') as fp:
+      return StudySummary(**json.load(fp))
+  except (FileNotFoundError, ValueError, TypeError):
+    pass
+
+  # Studies saved before the summaries were introduced
+  dataset = dcmread_wrapper(Path(study_dir, f"{accession_number}.dcm"), header_only=True)
+  try:
+    with open(Path(study_dir, server_config.RECOVERED_FILENAME), 'r') as fp:
+      recovered_date = fp.readline()
+  except FileNotFoundError:
+    recovered_date = None
+
+  summary = StudySummary.from_dataset(dataset, recovered_date)
+  write_study_summary(study_dir, summary)
+  return summary
+
+
+def update_study_summary(study_dir: Union[str, Path], accession_number: str, **changes) -> StudySummary:
+  """
+  Changes fields of the summary of a study, e.g. RecoveredDate
+
+  Raises:
+    FileNotFoundError: if neither the summary nor the dicom file of the study exists
+  """
+  summary = replace(read_study_summary(study_dir, accession_number), **changes)
+  write_study_summary(study_dir, summary)
+  return summary
+
+
+def dcmread_wrapper(filepath: Union[str, Path], is_little_endian: bool=True, is_implicit_VR: bool=True, use_cache: bool=False, header_only: bool=False) -> Dataset:
   """
   Takes a file path and reads it, update the private tags accordingly
 
@@ -99,20 +256,75 @@ def dcmread_wrapper(filepath: Union[str, Path], is_little_endian: bool=True, is_
     is_little_endian: whether or not the obj should be in little endian form
     is_implicit_VR: whether or not the obj should is implicit VR
 
+  Kwargs:
+    use_cache: if True the dataset is taken from, or put into, dataset_cache
+    header_only: if True reading stops before the PixelData, and other large
+                 values are first read from the file when accessed
+
   Returns:
     The read dicom object with corrected private tags
+
+  Remark:
+    A dataset read with header_only must not be saved over the file it was
+    read from, as that would drop the PixelData.
   """
   if isinstance(filepath, Path):
     filepath = str(filepath) # Convert to string, so pydicom can work with it
 
+  if use_cache:
+    stat = os.stat(filepath)
+    obj = dataset_cache.get(filepath, stat, header_only)
+    if obj is not None:
+      return obj
+
   update_private_tags()
 
-  obj = pydicom.dcmread(filepath)
+  if header_only:
+    obj = pydicom.dcmread(filepath, stop_before_pixels=True, defer_size=server_config.HEADER_ONLY_DEFER_SIZE)
+  else:
+    obj = pydicom.dcmread(filepath)
   obj = update_tags(obj, is_little_endian, is_implicit_VR)
 
+  if use_cache:
+    dataset_cache.put(filepath, stat, obj, header_only)
+
   return obj
 
 
+def peek_tags(encoded_dataset: bytes, transfer_syntax: str, tags: Iterable[int]) -> Dataset:
+  """
+  Reads a few top level tags from an encoded dataset, without decoding the rest
+
+  Args:
+    encoded_dataset: the dataset encoded in transfer_syntax, without preamble or file meta
+    transfer_syntax: UID of the transfer syntax the dataset is encoded in
+    tags: tags to read
+
+  Returns:
+    Dataset containing the found tags
+
+  Remarks:
+    Reading stops at the first element after the largest requested tag, so
+    elements after it, e.g. the PixelData, are never read. So the
+    encapsulated PixelData of compressed transfer syntaxes isn't decoded.
+    Deflated datasets must be inflated first, costing a decompression.
+  """
+  tags = [pydicom.tag.Tag(tag) for tag in tags]
+  last_tag = max(tags)
+  transfer_syntax = uid.UID(transfer_syntax)
+
+  if transfer_syntax == uid.DeflatedExplicitVRLittleEndian:
+    encoded_dataset = zlib.decompress(encoded_dataset, -zlib.MAX_WBITS)
+
+  return pydicom.filereader.read_dataset(
+    BytesIO(encoded_dataset),
+    transfer_syntax.is_implicit_VR,
+    transfer_syntax.is_little_endian,
+    stop_when=lambda tag, VR, length: tag > last_tag,
+    specific_tags=tags
+  )
+
+
 def update_tags(obj: Dataset, is_little_endian: bool=True, is_implicit_VR: bool=True) -> Dataset:
   """
   Resolves unknown private tags
@@ -172,7 +384,8 @@ def save_dicom(filepath: Union[str, Path], ds: Dataset) -> None:
   if isinstance(filepath, Path):
     filepath = str(filepath) # Convert to string, to allow pydicom to work with it
 
-  ds.is_implicit_VR = True
+  # Compressed pixel data, see try_add_pixeldata, must be saved in explicit VR
+  ds.is_implicit_VR = not is_compressed(ds)
   ds.is_little_endian = True
 
   if not filepath:
@@ -188,6 +401,23 @@ def save_dicom(filepath: Union[str, Path], ds: Dataset) -> None:
   ds.fix_meta_info()
   logger.info(f'Saving Dicom file at: {filepath}')
   ds.save_as(filepath, write_like_original=False)
+  dataset_cache.invalidate(filepath)
+
+  # Keep the summary of the study up to date, if this is the main file of a
+  # study directory, i.e. {study_dir}/{AccessionNumber}/{AccessionNumber}.dcm
+  if not isinstance(filepath, str): # File-like objects have no study directory
+    return
+
+  study_dir, filename = os.path.split(filepath)
+  accession_number = ds.get('AccessionNumber')
+  if accession_number and filename == f"{accession_number}.dcm" and os.path.basename(study_dir) == accession_number:
+    summary_filepath = get_summary_filepath(study_dir, accession_number)
+    try:
+      with open(summary_filepath, 'r') as fp:
+        recovered_date = json.load(fp).get('RecoveredDate')
+    except (FileNotFoundError, ValueError):
+      recovered_date = None
+    write_study_summary(study_dir, StudySummary.from_dataset(ds, recovered_date))
 
 
 def try_add_new(ds: Dataset, tag: int, VR: str, value, check_val: bool=True) -> None:
@@ -395,7 +625,126 @@ def try_add_dicom_history(ds: Dataset, dicom_history):
     ds.clearancehistory = Sequence(dicom_history)
 
 
-def try_add_pixeldata(ds: Dataset, pixel_bytes: Optional[bytes]) -> None:
+PALETTE_ELEMENTS = [
+  'RedPaletteColorLookupTableDescriptor',
+  'GreenPaletteColorLookupTableDescriptor',
+  'BluePaletteColorLookupTableDescriptor',
+  'RedPaletteColorLookupTableData',
+  'GreenPaletteColorLookupTableData',
+  'BluePaletteColorLookupTableData',
+]
+
+
+def is_compressed(ds: Dataset) -> bool:
+  """
+  Returns:
+    Whether the pixel data of the dataset is compressed, i.e. encapsulated
+  """
+  file_meta = getattr(ds, 'file_meta', None)
+  transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+
+  return transfer_syntax is not None and uid.UID(transfer_syntax).is_compressed
+
+
+def is_decoder_available(transfer_syntax: str) -> bool:
+  """
+  Returns:
+    Whether pydicom is able to decompress pixel data in the transfer syntax,
+    True for uncompressed transfer syntaxes
+  """
+  if not uid.UID(transfer_syntax).is_compressed:
+    return True
+
+  try:
+    from pydicom.pixels import get_decoder # pydicom 3
+  except ImportError:
+    return any(
+      handler.is_available() and handler.supports_transfer_syntax(transfer_syntax)
+      for handler in pydicom.config.pixel_data_handlers
+    )
+
+  try:
+    return get_decoder(transfer_syntax).is_available
+  except (NotImplementedError, ValueError):
+    return False
+
+
+def compress_dataset(ds: Dataset, transfer_syntax: str, pixels: Optional[np.ndarray]=None) -> None:
+  """
+  Compresses the pixel data of a dataset
+
+  Args:
+    ds: dataset to compress
+    transfer_syntax: UID of the compressed transfer syntax
+
+  Kwargs:
+    pixels: uncompressed pixel data to compress, instead of the pixel data of ds
+
+  Remark:
+    The SOP Instance UID is kept, as pydicom 3 would otherwise generate a new
+    one, such that sending the study again would duplicate it in PACS.
+  """
+  sop_instance_uid = ds.get('SOPInstanceUID')
+  ds.compress(transfer_syntax, pixels)
+
+  if sop_instance_uid is None:
+    if 'SOPInstanceUID' in ds:
+      del ds.SOPInstanceUID
+  else:
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+
+
+def decompress_dataset(ds: Dataset) -> None:
+  """
+  Decompresses the pixel data of a dataset to Explicit VR Little Endian
+
+  Remark:
+    Dataset.decompress isn't used, as pydicom 2 only replaces the PixelData
+    when the dataset is written to a file, i.e. not when it's sent, and
+    pydicom 3 generates a new SOP Instance UID.
+  """
+  pixels = ds.pixel_array
+
+  del ds.PixelData
+  ds.add_new(0x7FE00010, 'OB', pixels.tobytes()) # Plots are 8 bit, see try_add_pixeldata
+  if ds.get('SamplesPerPixel', 1) > 1:
+    ds.PlanarConfiguration = 0
+  ds.file_meta.TransferSyntaxUID = uid.ExplicitVRLittleEndian
+
+
+def get_palette_indices(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """
+  Converts an RGB image to palette indices
+
+  Args:
+    pixels: (rows, columns, 3) array of 8 bit RGB
+
+  Returns:
+    The palette as a (colours, 3) array of 8 bit RGB, and the (rows, columns)
+    array of 8 bit indices into it
+
+  Remark:
+    The conversion is exact for images with at most 256 colours, otherwise
+    the colours are quantised with median cut.
+  """
+  rows, columns, _ = pixels.shape
+  packed = pixels.reshape(-1, 3).astype(np.uint32)
+  packed = (packed[:, 0] << 16) | (packed[:, 1] << 8) | packed[:, 2]
+  colours, indices = np.unique(packed, return_inverse=True)
+
+  if len(colours) <= 256:
+    palette = np.stack([colours >> 16, (colours >> 8) & 0xFF, colours & 0xFF], axis=1).astype(np.uint8)
+    return palette, indices.astype(np.uint8).reshape(rows, columns)
+
+  logger.info(f"Quantising plot of {len(colours)} colours to 256")
+  image = Image.fromarray(pixels, mode="RGB").quantize(colors=256, method=0, dither=0) # Median cut, no dithering
+  palette = np.array(image.getpalette()[:256 * 3], dtype=np.uint8).reshape(-1, 3)
+
+  return palette, np.array(image, dtype=np.uint8)
+
+
+def try_add_pixeldata(ds: Dataset, pixel_bytes: Optional[bytes], encoding: Optional[enums.PlotEncoding]=None) -> None:
   """
   Attempts to add the pixeldata to the dataset
 
@@ -403,6 +752,9 @@ def try_add_pixeldata(ds: Dataset, pixel_bytes: Optional[bytes]) -> None:
     ds: dataset to add to
     pixeldata: pixeldata to add if present
 
+  Kwargs:
+    encoding: how to store the pixeldata, defaults to PLOT_PIXEL_ENCODING
+
   Remark:
     This function assumes the pixeldata was generated through generate_gfr_plot
     function from clearance_math.py
@@ -413,24 +765,94 @@ def try_add_pixeldata(ds: Dataset, pixel_bytes: Optional[bytes]) -> None:
     During development of previous versions we've found that when TransferSyntax
     is set to Little Endian Implicit, that the pixeldata gets distorted with a
     blue/greenish tint when uploaded to PACS.
+
+    The plot is decoded again by get_plot_pixels, whichever the encoding.
   """
   if pixel_bytes is not None:
+    if encoding is None:
+      encoding = enums.PlotEncoding[server_config.PLOT_PIXEL_ENCODING]
+
     # Save in DICOM pixel data encoding format
     pixeldata = np.frombuffer(pixel_bytes, dtype=np.uint8) # Reads byte array to 1D numpy array
-    pixeldata = np.reshape(pixeldata, (1920, 1080, 3))   # Reshapes to DICOM conformat pixel data encoding (for more details see: https://dicom.innolitics.com/ciods/segmentation/image-pixel/7fe00010)
+    pixeldata = np.reshape(pixeldata, (1080, 1920, 3))   # Reshapes to DICOM conformat pixel data encoding (for more details see: https://dicom.innolitics.com/ciods/segmentation/image-pixel/7fe00010)
+
+    # Drop the encoding of any previous plot
+    for keyword in PALETTE_ELEMENTS + ['PixelData']:
+      if keyword in ds:
+        delattr(ds, keyword)
+    if is_compressed(ds):
+      ds.file_meta.TransferSyntaxUID = uid.ImplicitVRLittleEndian
 
     # Set additional meta data about the image
-    ds.SamplesPerPixel = 3
-    ds.PhotometricInterpretation = 'RGB'
-    ds.PlanarConfiguration = 0
     ds.Rows = 1080
     ds.Columns = 1920
     ds.BitsAllocated = 8
     ds.BitsStored = 8
     ds.HighBit = 7
     ds.PixelRepresentation = 0
+
+    if encoding == enums.PlotEncoding.PALETTE:
+      palette, indices = get_palette_indices(pixeldata)
+      # 16 bit entries, as 8 bit entries are poorly supported by viewers
+      lut_descriptor = [len(palette), 0, 16]
+      lut_data = palette.astype('<u2') * 257
+
+      ds.SamplesPerPixel = 1
+      ds.PhotometricInterpretation = 'PALETTE COLOR'
+      if 'PlanarConfiguration' in ds:
+        del ds.PlanarConfiguration
+      ds.add_new(0x00281101, 'US', lut_descriptor) # Red, the VR is ambiguous by default
+      ds.add_new(0x00281102, 'US', lut_descriptor) # Green
+      ds.add_new(0x00281103, 'US', lut_descriptor) # Blue
+      ds.RedPaletteColorLookupTableData = lut_data[:, 0].tobytes()
+      ds.GreenPaletteColorLookupTableData = lut_data[:, 1].tobytes()
+      ds.BluePaletteColorLookupTableData = lut_data[:, 2].tobytes()
+      ds.PixelData = indices.tobytes()
+      return
+
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = 'RGB'
+    ds.PlanarConfiguration = 0
     ds.PixelData = pixeldata.tobytes()
 
+    if encoding == enums.PlotEncoding.RLE:
+      compress_dataset(ds, uid.RLELossless, pixeldata)
+
+
+def get_plot_pixels(ds: Dataset) -> Optional[np.ndarray]:
+  """
+  Decodes the plot of a study, see try_add_pixeldata
+
+  Args:
+    ds: dataset to decode the plot of
+
+  Returns:
+    The plot as a (rows, columns, 3) array of 8 bit RGB, None if the dataset has no plot
+  """
+  if 'PixelData' not in ds or not ds.PixelData:
+    return None
+
+  rows = ds.get('Rows', 1080)
+  columns = ds.get('Columns', 1920)
+  samples_per_pixel = ds.get('SamplesPerPixel', 3)
+
+  if is_compressed(ds):
+    pixels = ds.pixel_array
+  else:
+    # Plots are never stored with planar configuration 1, so the bytes are read directly
+    pixels = np.frombuffer(ds.PixelData, dtype=np.uint8)
+    if samples_per_pixel == 1:
+      pixels = np.reshape(pixels, (rows, columns))
+    else:
+      pixels = np.reshape(pixels, (rows, columns, samples_per_pixel))
+
+  if ds.get('PhotometricInterpretation') == 'PALETTE COLOR':
+    pixels = apply_color_lut(pixels, ds)
+    if pixels.dtype != np.uint8: # 16 bit palette entries
+      pixels = (pixels >> 8).astype(np.uint8)
+
+  return pixels
+
 
 def fill_dicom(ds,
     age                 = None,
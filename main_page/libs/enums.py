@@ -23,4 +23,24 @@ STUDY_TYPE_NAMES = [
 class ExamStatus(Enum):
   NO_CHANGES = 0      # The study has not been edited yet
   SAVED_CHANGES = 1   # Study was edited
-  READY = 2           # Study and is ready for review
\ No newline at end of file
+  READY = 2           # Study and is ready for review
+
+class StudyState(Enum):
+  REGISTERED = 0  # Shown in list_studies, being filled out
+  CONTROL = 1     # Shown in control_list_studies, awaiting approval
+  DELETED = 2     # Shown in deleted_studies, i.e. the trashcan
+  APPROVING = 3   # Claimed by a user approving it, see approval.approve
+
+class PlotEncoding(Enum):
+  RGB = 0      # Raw 8 bit RGB, 6.2 MB per plot
+  PALETTE = 1  # PALETTE COLOR with 8 bit indices, 2.1 MB, colours are quantised beyond 256
+  RLE = 2      # 8 bit RGB compressed with RLE Lossless
+
+class OutboxState(Enum):
+  PENDING = 0  # Waiting to be sent to PACS, see libs/pacs_outbox.py
+  SENT = 1     # Stored in PACS
+
+class PlotJobState(Enum):
+  PENDING = 0  # Waiting to be rendered, see libs/plot_jobs.py
+  DONE = 1     # The plot is in the PixelData of the study
+  FAILED = 2   # Rendering failed, see PlotJob.error
@@ -0,0 +1,302 @@
+#Python packages
+import glob
+import hashlib
+import json
+import os
+import time
+
+from pathlib import Path
+from pydicom import Dataset
+from typing import Iterable, Iterator, List, Tuple, Union
+
+#Custom modules
+from . import dicomlib
+from . import server_config
+
+from main_page import log_util
+
+logger = log_util.get_logger(__name__)
+"""
+  This file stores the historic studies of patients, which are shown in the
+  history plots of their new studies.
+
+  A historic study is stored once, reduced to HISTORY_TAGS, at:
+
+    HISTORY_STORE_DIR/{key[:2]}/{key}.dcm
+
+  where key is the sha256 of the patient ID and accession number of the
+  historic study. The study directories needing it hold a symlink to the
+  stored file, named as the copies were before:
+
+    FIND_RESPONS_DIR/{hospital}/{Accession_number_1}/{Accession_number_2}.dcm -> HISTORY_STORE_DIR/...
+
+  so the history is still found by globbing the study directory. Storing a
+  newer version of a historic study updates every study linking to it.
+
+  Stored studies no study links to are removed by collect_garbage.
+
+  The history of a study is also summarised in a json file in the study
+  directory, see write_history_summary, such that the history plot is made
+  without reading any of the historic studies. A summary older than one of
+  the historic studies it summarises is written again when read, see
+  read_history_summary.
+"""
+
+# The tags read from historic studies, see dicomio.get_history
+HISTORY_TAGS = (
+  0x00080016, # SOPClassUID
+  0x00080018, # SOPInstanceUID
+  0x00080020, # StudyDate
+  0x00080050, # AccessionNumber
+  0x00100020, # PatientID
+  0x00101020, # PatientSize
+  0x00101030, # PatientWeight
+  0x00230010, # Private creator
+  0x00231012, # clearance
+  0x00231014, # normClear
+  0x00231018, # injTime
+  0x00231020, # ClearTest
+)
+
+
+def get_key(patient_id: str, accession_number: str) -> str:
+  return hashlib.sha256(f"{patient_id}/{accession_number}".encode()).hexdigest()
+
+
+def get_path(patient_id: str, accession_number: str) -> Path:
+  key = get_key(patient_id, accession_number)
+  return Path(server_config.HISTORY_STORE_DIR, key[:2], f"{key}.dcm")
+
+
+def strip_dataset(dataset: Dataset) -> Dataset:
+  """
+  Returns:
+    A copy of the dataset with only the HISTORY_TAGS
+  """
+  stripped = Dataset()
+  for tag in HISTORY_TAGS:
+    if tag in dataset:
+      stripped[tag] = dataset[tag]
+
+  return stripped
+
+
+def ingest(source: Union[str, Path], keep_source: bool=False) -> Path:
+  """
+  Stores a retrieved historic study, replacing the stored version if any
+
+  Args:
+    source: the dicom file of the historic study
+
+  Kwargs:
+    keep_source: whether to keep the source file, it's deleted by default
+
+  Returns:
+    Path to the stored file
+
+  Raises:
+    ValueError: if the study has no AccessionNumber
+  """
+  dataset = dicomlib.dcmread_wrapper(source, header_only=True)
+  if 'AccessionNumber' not in dataset:
+    raise ValueError(f"Historic study {source} has no AccessionNumber")
+
+  store_path = get_path(dataset.get('PatientID', ''), dataset.AccessionNumber)
+  store_path.parent.mkdir(parents=True, exist_ok=True)
+
+  # Write to a temporary file first, so studies never read a partially written file
+  tmp_path = Path(f"{store_path}.tmp")
+  dicomlib.save_dicom(tmp_path, strip_dataset(dataset))
+  os.replace(tmp_path, store_path)
+  dicomlib.dataset_cache.invalidate(store_path)
+
+  if not keep_source:
+    os.unlink(source)
+
+  return store_path
+
+
+def link(store_path: Path, study_dirs: Iterable[Path], filename: str) -> int:
+  """
+  Places a symlink to a stored historic study in every study directory needing it
+
+  Args:
+    store_path: the stored historic study, see ingest
+    study_dirs: study directories to link the historic study into
+    filename: name of the links, i.e. {AccessionNumber}.dcm of the historic study
+
+  Returns:
+    The number of created links
+  """
+  linked = 0
+  for study_dir in study_dirs:
+    if not study_dir.exists():
+      # The study have been handled or deleted since it was polled
+      continue
+
+    destination = Path(study_dir, filename)
+    tmp_destination = Path(study_dir, f"{filename}.tmp")
+    if tmp_destination.is_symlink():
+      tmp_destination.unlink()
+    os.symlink(store_path, tmp_destination)
+    os.replace(tmp_destination, destination)
+    linked += 1
+
+  return linked
+
+
+def iter_history_files() -> Iterator[Path]:
+  """
+  Yields the history files of every study on the server, i.e. the files
+  in the study store and the search cache which aren't the study itself
+  """
+  patterns = [
+    f"{server_config.FIND_RESPONS_DIR}*/*/*.dcm",
+    f"{server_config.SEARCH_CACHE_DIR}*/*.dcm",
+  ]
+
+  for pattern in patterns:
+    for filepath in map(Path, glob.glob(pattern)):
+      if filepath.stem != filepath.parent.name:
+        yield filepath
+
+
+def deduplicate() -> Tuple[int, int]:
+  """
+  Replaces the historic studies copied into study directories, from before
+  the history store, by links into the store
+
+  Returns:
+    The number of replaced copies and the number of copies which couldn't be read
+  """
+  replaced = 0
+  failed = 0
+  for filepath in iter_history_files():
+    if filepath.is_symlink():
+      continue
+
+    try:
+      store_path = ingest(filepath)
+    except Exception as e:
+      logger.error(f"Unable to move {filepath} into the history store, got exception {e}")
+      failed += 1
+      continue
+
+    link(store_path, [filepath.parent], filepath.name)
+    replaced += 1
+
+  logger.info(f"Replaced {replaced} historic studies by links into the history store, {failed} failed")
+
+  return replaced, failed
+
+
+def collect_garbage(min_age: int=24 * 60 * 60) -> int:
+  """
+  Removes stored historic studies which no study links to
+
+  Kwargs:
+    min_age: seconds a stored study is kept after it was last written,
+             such that newly ingested studies are not removed before they are linked
+
+  Returns:
+    The number of removed studies
+  """
+  store_dir = Path(server_config.HISTORY_STORE_DIR)
+  if not store_dir.exists():
+    return 0
+
+  referenced = set()
+  for filepath in iter_history_files():
+    if filepath.is_symlink():
+      referenced.add(os.readlink(filepath))
+
+  removed = 0
+  cutoff = time.time() - min_age
+  for store_path in store_dir.glob('*/*.dcm'):
+    if str(store_path) in referenced or store_path.stat().st_mtime > cutoff:
+      continue
+
+    store_path.unlink()
+    removed += 1
+
+  logger.info(f"Removed {removed} historic studies from the history store")
+
+  return removed
+
+
+def get_history_files(study_dir: Path) -> List[Path]:
+  """
+  Returns:
+    The historic studies in a study directory, i.e. the files which aren't the study itself
+  """
+  return [filepath for filepath in sorted(study_dir.glob('*.dcm')) if filepath.stem != study_dir.name]
+
+
+def is_summary_outdated(study_dir: Path, summary_path: Path) -> bool:
+  """
+  Checks if a historic study of a study was stored after its history was
+  summarised, e.g. a newer version of it was ingested
+  """
+  summarised = summary_path.stat().st_mtime_ns
+  for filepath in get_history_files(study_dir):
+    try:
+      # Follows the link to the stored file, so a newer version is noticed
+      if os.stat(filepath).st_mtime_ns >= summarised:
+        return True
+    except FileNotFoundError: # Dangling link, left out of the summary anyway
+      continue
+
+  return False
+
+
+def write_history_summary(study_dir: Union[str, Path]) -> List[Dataset]:
+  """
+  Summarises the historic studies in a study directory, call it whenever the
+  history of the study changes
+
+  Args:
+    study_dir: directory of the study
+
+  Returns:
+    The historic studies reduced to HISTORY_TAGS, see read_history_summary
+  """
+  study_dir = Path(study_dir)
+  history = [ ]
+  for filepath in get_history_files(study_dir):
+    try:
+      history.append(strip_dataset(dicomlib.dcmread_wrapper(filepath, use_cache=True)))
+    except Exception as e:
+      logger.error(f"Unable to read historic study {filepath}, got exception {e}")
+
+  summary_path = Path(study_dir, server_config.HISTORY_SUMMARY_FILENAME)
+  tmp_path = Path(f"{summary_path}.tmp")
+  with open(tmp_path, 'w') as fp:
+    json.dump([historic_dataset.to_json_dict() for historic_dataset in history], fp)
+  os.replace(tmp_path, summary_path)
+
+  return history
+
+
+def read_history_summary(study_dir: Union[str, Path]) -> List[Dataset]:
+  """
+  Reads the history of a study, summarising it if it hasn't been yet, or if
+  it's outdated
+
+  Args:
+    study_dir: directory of the study
+
+  Returns:
+    The historic studies of the study, reduced to HISTORY_TAGS
+  """
+  dicomlib.update_private_tags()
+
+  study_dir = Path(study_dir)
+  summary_path = Path(study_dir, server_config.HISTORY_SUMMARY_FILENAME)
+  try:
+    if is_summary_outdated(study_dir, summary_path):
+      return write_history_summary(study_dir)
+
+    with open(summary_path, 'r') as fp:
+      return [Dataset.from_json(historic_json) for historic_json in json.load(fp)]
+  except (FileNotFoundError, ValueError):
+    return write_history_summary(study_dir)
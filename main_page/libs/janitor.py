@@ -0,0 +1,148 @@
+import time
+
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from . import enums
+from . import server_config
+from . import study_store
+
+from main_page import log_util
+
+logger = log_util.get_logger(__name__)
+"""
+  This file moves studies through their retention states, outside of the
+  request path:
+
+    REGISTERED  - for ACTIVE_STUDY_DAYS
+    DELETED     - for DELETED_STUDY_DAYS
+    permanently deleted
+
+  Studies left claimed for approval, e.g. by a crashed request, are returned
+  to the control list after APPROVAL_CLAIM_TIMEOUT seconds.
+
+  The days are counted from the retention date of a study, i.e. its recovery
+  date if it has been recovered, otherwise its study date. The expired
+  studies are found with an indexed query, see study_store.expired.
+
+  The janitor is run by ris_thread after every poll, and can be run by hand
+  with: python manage.py run_janitor
+"""
+
+
+@dataclass
+class JanitorReport:
+  """
+  The outcome of a janitor run, logged at the end of the run
+  """
+  moved: int = 0        # Studies moved from active to deleted
+  purged: int = 0       # Deleted studies permanently deleted
+  released: int = 0     # Studies claimed for approval returned to the control list
+  failed: List[str] = field(default_factory=list) # Accession numbers of studies which couldn't be processed
+  deferred: int = 0     # Expired studies left for the next run due to the batch size
+  duration: float = 0.0 # Seconds
+
+  def __str__(self) -> str:
+    return (f"moved {self.moved}, purged {self.purged}, released {self.released}, failed {len(self.failed)}, "
+            f"deferred {self.deferred} studies in {self.duration:.2f} sec.")
+
+
+def expire_studies(
+  hospital_shortname: Optional[str],
+  state: enums.StudyState,
+  process: Callable[[str, str], bool],
+  days: int,
+  batch_size: int,
+  report: JanitorReport
+  ) -> int:
+  """
+  Applies process to the studies which have been in a state for too long,
+  oldest first
+
+  Args:
+    hospital_shortname: abbreviation for hospital name, None for all hospitals
+    state: state of the studies
+    process: function called with the hospital short name and accession
+             number of the study, returning True if it succeeded
+    days: number of days a study is allowed to stay in the state
+    batch_size: max number of studies to process
+    report: report to add failed and deferred studies to
+
+  Returns:
+    The number of processed studies
+  """
+  expired = study_store.expired(hospital_shortname, state, days)
+  report.deferred += max(expired.count() - batch_size, 0)
+
+  processed = 0
+  batch = expired.values_list('hospital__short_name', 'accession_number')[:batch_size]
+  for study_hospital, accession_number in batch:
+    if process(study_hospital, accession_number):
+      processed += 1
+    else:
+      report.failed.append(accession_number)
+
+  return processed
+
+
+def move_to_deleted(hospital_shortname: str, accession_number: str) -> bool:
+  return study_store.transition(
+    hospital_shortname,
+    accession_number,
+    enums.StudyState.REGISTERED,
+    enums.StudyState.DELETED
+  )
+
+
+def permanent_delete(hospital_shortname: str, accession_number: str) -> bool:
+  return study_store.remove(hospital_shortname, accession_number, enums.StudyState.DELETED)
+
+
+def run(
+  hospital_shortname: Optional[str]=None,
+  batch_size: Optional[int]=None
+  ) -> JanitorReport:
+  """
+  Moves old studies to the deleted studies and permanently deletes old deleted studies
+
+  Kwargs:
+    hospital_shortname: hospital to clean up, defaults to all hospitals
+    batch_size: max number of studies moved, respectively deleted, in the run
+                defaults to server_config.JANITOR_BATCH_SIZE
+
+  Returns:
+    Report of the run
+  """
+  if batch_size is None:
+    batch_size = server_config.JANITOR_BATCH_SIZE
+
+  report = JanitorReport()
+  start = time.monotonic()
+
+  report.moved = expire_studies(
+    hospital_shortname,
+    enums.StudyState.REGISTERED,
+    move_to_deleted,
+    server_config.ACTIVE_STUDY_DAYS,
+    batch_size,
+    report
+  )
+
+  report.purged = expire_studies(
+    hospital_shortname,
+    enums.StudyState.DELETED,
+    permanent_delete,
+    server_config.DELETED_STUDY_DAYS,
+    batch_size,
+    report
+  )
+
+  report.released = study_store.release_approvals(hospital_shortname, server_config.APPROVAL_CLAIM_TIMEOUT)
+
+  report.duration = time.monotonic() - start
+
+  logger.info(f"Janitor {report}")
+  if report.failed:
+    logger.error(f"Janitor failed to handle studies with accession numbers: {', '.join(report.failed)}")
+
+  return report
@@ -0,0 +1,191 @@
+import errno
+import os
+import random
+import socket
+from pathlib import Path
+from typing import Optional, Union
+
+from . import server_config
+from main_page import log_util
+
+logger = log_util.get_logger(__name__)
+"""
+  This file correlates C-MOVE requests with the C-STORE sub-operations they
+  cause at the store SCP (storeSCPserver.py), which runs in another process.
+
+  The requester picks a message ID for the C-MOVE, and binds a unix datagram
+  socket named after the accession number and the message ID:
+
+    {MOVE_NOTIFY_DIR}{accession_number}.{message_id}.sock
+
+  The moving node copies the message ID into the MoveOriginatorMessageID of
+  every C-STORE, so the store SCP saves the dataset to a file unique to the
+  move and sends the path of it to the socket. Binding the socket path is
+  atomic, so it also reserves the message ID across processes, making it safe
+  to run several moves of the same accession number at once.
+
+  If the store SCP fails to save the dataset, it sends a failure notification
+  instead, i.e. FAILURE_MARKER followed by the reason, so the requester stops
+  waiting at once. Paths never contain a NUL byte, so the two can't be confused.
+
+  Datasets stored without a MoveOriginatorMessageID are saved to the old
+  location, SEARCH_DIR/{accession_number}.dcm, and no one is notified.
+"""
+
+MAX_MESSAGE_ID = 0xFFFF # Message ID's are unsigned shorts
+MAX_BIND_ATTEMPTS = 32
+MAX_NOTIFICATION_SIZE = 4096
+FAILURE_MARKER = b'\x00'
+
+
+def socket_path(accession_number: str, message_id: int) -> Path:
+  return Path(server_config.MOVE_NOTIFY_DIR, f"{accession_number}.{message_id}.sock")
+
+
+def stored_file_path(accession_number: str, message_id: Optional[int]=None) -> Path:
+  """
+  Gets the path the store SCP saves a moved dataset to
+
+  Args:
+    accession_number: Accession number of the stored dataset
+
+  Kwargs:
+    message_id: MoveOriginatorMessageID of the C-STORE, if any
+
+  Returns:
+    Path to the file in SEARCH_DIR
+  """
+  if message_id is None:
+    return Path(f"{server_config.SEARCH_DIR}{accession_number}.dcm")
+
+  return Path(f"{server_config.SEARCH_DIR}{accession_number}.{message_id}.dcm")
+
+
+def notify(accession_number: str, message_id: int, filepath: Union[str, Path]) -> bool:
+  """
+  Tells the requester of a C-MOVE, that the moved dataset have been stored
+
+  Args:
+    accession_number: Accession number of the stored dataset
+    message_id: MoveOriginatorMessageID of the C-STORE
+    filepath: Where the dataset was stored
+
+  Returns:
+    True if the requester was notified, False if no one was waiting for it
+  """
+  return _send(accession_number, message_id, str(filepath).encode())
+
+
+def notify_failure(accession_number: str, message_id: int, reason: str) -> bool:
+  """
+  Tells the requester of a C-MOVE, that the moved dataset couldn't be stored
+
+  Args:
+    accession_number: Accession number of the dataset
+    message_id: MoveOriginatorMessageID of the C-STORE
+    reason: Why the dataset couldn't be stored
+
+  Returns:
+    True if the requester was notified, False if no one was waiting for it
+  """
+  message = FAILURE_MARKER + reason.encode()
+  return _send(accession_number, message_id, message[:MAX_NOTIFICATION_SIZE])
+
+
+def _send(accession_number: str, message_id: int, message: bytes) -> bool:
+  target = socket_path(accession_number, message_id)
+  if not target.exists():
+    return False
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+    try:
+      sock.sendto(message, str(target))
+    except OSError as e:
+      logger.info(f"Failed to notify {target}, got exception {e}")
+      return False
+
+  return True
+
+
+class MoveWaiter():
+  """
+  Waits for the store SCP to report a dataset moved by a single C-MOVE
+
+  Usage:
+    with MoveWaiter(accession_number) as waiter:
+      association.send_c_move(dataset, aet, query_model, msg_id=waiter.message_id)
+      ...
+      filepath = waiter.wait(timeout)
+
+  Remark:
+    The socket is bound before the C-MOVE is sent, so a notification which
+    arrives before the C-MOVE response is buffered until wait is called.
+  """
+  def __init__(self, accession_number: str):
+    self.accession_number = accession_number
+    self.message_id: Optional[int] = None
+    self._socket: Optional[socket.socket] = None
+    self._socket_path: Optional[Path] = None
+
+  def __enter__(self) -> 'MoveWaiter':
+    Path(server_config.MOVE_NOTIFY_DIR).mkdir(parents=True, exist_ok=True)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for _ in range(MAX_BIND_ATTEMPTS):
+      message_id = random.randint(1, MAX_MESSAGE_ID)
+      path = socket_path(self.accession_number, message_id)
+      try:
+        sock.bind(str(path))
+      except OSError as e:
+        if e.errno == errno.EADDRINUSE: # Message ID is in use by another move
+          continue
+        sock.close()
+        raise
+
+      self.message_id = message_id
+      self._socket = sock
+      self._socket_path = path
+      return self
+
+    sock.close()
+    raise RuntimeError(f"Unable to reserve a message ID for moving {self.accession_number}")
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+
+    if self._socket_path is not None:
+      try:
+        os.unlink(self._socket_path)
+      except FileNotFoundError:
+        pass
+      self._socket_path = None
+
+  def wait(self, timeout: float) -> Optional[Path]:
+    """
+    Waits for the store SCP to report the moved dataset
+
+    Args:
+      timeout: seconds to wait for the notification
+
+    Returns:
+      Path to the stored dataset, None if it didn't arrive within the timeout
+      or the store SCP failed to store it
+    """
+    if self._socket is None:
+      raise RuntimeError("MoveWaiter.wait must be called inside of the with-block")
+
+    self._socket.settimeout(timeout)
+    try:
+      data = self._socket.recv(MAX_NOTIFICATION_SIZE)
+    except socket.timeout:
+      logger.error(f"Timed out waiting for {self.accession_number} with message ID {self.message_id}")
+      return None
+
+    if data.startswith(FAILURE_MARKER):
+      reason = data[len(FAILURE_MARKER):].decode(errors='replace')
+      logger.error(f"The store SCP failed to store {self.accession_number} with message ID {self.message_id}: {reason}")
+      return None
+
+    return Path(data.decode())
@@ -0,0 +1,564 @@
+#Python packages
+import copy
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydicom import Dataset, uid
+from typing import Dict, List, Optional, Tuple
+
+from django.db import connection
+from django.db.models import Count, Min, QuerySet
+from django.utils import timezone
+
+#Custom modules
+from . import ae_controller
+from . import dicomlib
+from . import enums
+from . import query_cache
+from . import server_config
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file is the outbox of studies approved for PACS, see
+  models.PacsOutboxItem. A study is queued by saving its dicom file to
+  PACS_QUEUE_DIR and adding a row with the PACS address, after which it
+  survives restarts of the web server.
+
+  The outbox is drained by the PACS sender service, pacsSenderThread.py,
+  calling run. The due studies are grouped by PACS peer, and each batch is
+  sent over a single association, with up to PACS_OUTBOX_WORKERS peers at a
+  time. A failed study is retried with exponential backoff and jitter, see
+  get_backoff, and is never given up on.
+
+  Studies queued by the old file queue, i.e. {accession_number}.dcm and
+  {accession_number}.json files in PACS_QUEUE_DIR, are added by import_file_queue.
+
+  Studies are sent compressed when PACS accepts it, see
+  PACS_STORE_TRANSFER_SYNTAXES. Each transfer syntax is proposed in its own
+  presentation context, so PACS accepts every syntax it supports, and a study
+  is sent in the most preferred of them. A syntax which PACS accepted, but
+  then failed to store, is not used for that peer again until the PACS sender
+  service is restarted, see send_c_store.
+"""
+
+# Calling AET, IP, port and AET of PACS
+PeerKey = Tuple[str, str, int, str]
+
+# Studies are sent as secondary captures
+SECONDARY_CAPTURE = '1.2.840.10008.5.1.4.1.1.7'
+
+
+def is_encoder_available(transfer_syntax: str) -> bool:
+  """
+  Returns:
+    Whether pydicom is able to compress pixel data in the transfer syntax
+  """
+  try:
+    from pydicom.pixels import get_encoder # pydicom 3
+  except ImportError:
+    try:
+      from pydicom.encoders import get_encoder
+    except ImportError: # Older than pydicom 2.2
+      return False
+
+  try:
+    return get_encoder(transfer_syntax).is_available
+  except (NotImplementedError, ValueError):
+    return False
+
+
+def get_store_syntaxes() -> List[str]:
+  """
+  Returns:
+    The transfer syntaxes to propose for studies, by preference, ending with
+    Explicit VR Little Endian, which every PACS accepts
+  """
+  syntaxes = [
+    transfer_syntax for transfer_syntax in server_config.PACS_STORE_TRANSFER_SYNTAXES
+    if not uid.UID(transfer_syntax).is_compressed or is_encoder_available(transfer_syntax)
+  ]
+  if uid.ExplicitVRLittleEndian not in syntaxes:
+    syntaxes.append(uid.ExplicitVRLittleEndian)
+
+  return syntaxes
+
+
+STORE_SYNTAXES = get_store_syntaxes()
+STORE_CONTEXTS = [(SECONDARY_CAPTURE, transfer_syntax) for transfer_syntax in STORE_SYNTAXES]
+
+# Transfer syntaxes each peer accepted, but failed to store studies in
+_rejected_syntaxes: Dict[PeerKey, set] = { }
+_rejected_lock = threading.Lock()
+
+
+def get_queue_path(accession_number: str) -> Path:
+  return Path(server_config.PACS_QUEUE_DIR, f"{accession_number}.dcm")
+
+
+def pending() -> QuerySet:
+  return models.PacsOutboxItem.objects.filter(state=enums.OutboxState.PENDING.value)
+
+
+def enqueue(dataset: Dataset, calling_aet: str, address: models.Address, delay: float=0) -> models.PacsOutboxItem:
+  """
+  Queues a study for PACS
+
+  Args:
+    dataset: the study to send
+    calling_aet: AET of this server
+    address: address of PACS
+
+  Kwargs:
+    delay: seconds before the PACS sender service may send the study, such
+           that the caller can send it with send_batch itself
+
+  Returns:
+    The row of the study in the outbox
+
+  Remark:
+    If the study is already queued, its file is replaced and it's sent as
+    soon as possible to the given address.
+  """
+  accession_number = dataset.AccessionNumber
+  queue_path = get_queue_path(accession_number)
+  queue_path.parent.mkdir(parents=True, exist_ok=True)
+
+  # Write to a temporary file first, so the sender never reads a partially written file
+  tmp_path = Path(f"{queue_path}.tmp")
+  dicomlib.save_dicom(tmp_path, dataset)
+  os.replace(tmp_path, queue_path)
+
+  now = timezone.now()
+  fields = {
+    'patient_id'   : str(dataset.get('PatientID', '')),
+    'path'         : str(queue_path),
+    'calling_aet'  : calling_aet,
+    'ip'           : address.ip,
+    'port'         : int(address.port),
+    'ae_title'     : address.ae_title,
+    'queued'       : now,
+    'attempts'     : 0,
+    'next_attempt' : now + datetime.timedelta(seconds=delay),
+    'last_error'   : '',
+  }
+
+  item = pending().filter(accession_number=accession_number).first()
+  if item is None:
+    item = models.PacsOutboxItem.objects.create(
+      accession_number=accession_number,
+      state=enums.OutboxState.PENDING.value,
+      **fields
+    )
+  else:
+    for field, value in fields.items():
+      setattr(item, field, value)
+    item.save()
+
+  logger.info(f"Queued {accession_number} for {address.ae_title}")
+
+  return item
+
+
+def get_backoff(attempts: int) -> float:
+  """
+  Args:
+    attempts: number of failed attempts to send the study
+
+  Returns:
+    Seconds to wait before the next attempt
+
+  Remark:
+    The delay doubles with each attempt up to PACS_OUTBOX_BACKOFF_MAX, and
+    a random half of it is jittered, such that studies which failed together
+    aren't all retried at the same moment.
+  """
+  delay = min(server_config.PACS_OUTBOX_BACKOFF_MAX, server_config.PACS_OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+  return delay / 2 + random.uniform(0, delay / 2)
+
+
+def record_success(item: models.PacsOutboxItem) -> None:
+  # The study is still pending, if its file was replaced while it was being sent
+  updated = pending().filter(id=item.id, queued=item.queued).update(
+    state=enums.OutboxState.SENT.value,
+    sent=timezone.now(),
+    last_error=''
+  )
+
+  if updated:
+    try:
+      os.unlink(item.path)
+    except FileNotFoundError:
+      pass
+    logger.info(f"Sent {item.accession_number} to {item.ae_title}")
+
+  # Searches may now find the study, see pacs_query_wrapper.search_query_pacs
+  query_cache.invalidate_patient(item.patient_id)
+
+
+def record_failure(item: models.PacsOutboxItem, error: str) -> None:
+  attempts = item.attempts + 1
+  delay = get_backoff(attempts)
+
+  pending().filter(id=item.id, queued=item.queued).update(
+    attempts=attempts,
+    next_attempt=timezone.now() + datetime.timedelta(seconds=delay),
+    last_error=error[:255]
+  )
+  logger.error(f"Failed to send {item.accession_number} to {item.ae_title} (attempt {attempts}), retrying in {delay:.0f} sec.: {error}")
+
+
+def get_due_batches(batch_size: int, max_batches: int) -> Dict[PeerKey, List[models.PacsOutboxItem]]:
+  """
+  Args:
+    batch_size: max number of studies per peer
+    max_batches: max number of peers
+
+  Returns:
+    The studies due to be sent, grouped by PACS peer, oldest first
+  """
+  batches: Dict[PeerKey, List[models.PacsOutboxItem]] = { }
+  due = pending().filter(next_attempt__lte=timezone.now()).order_by('next_attempt')
+
+  for item in due.iterator():
+    peer = (item.calling_aet, item.ip, item.port, item.ae_title)
+    batch = batches.get(peer)
+    if batch is None:
+      if len(batches) >= max_batches:
+        continue
+      batch = batches[peer] = [ ]
+
+    if len(batch) < batch_size:
+      batch.append(item)
+
+  return batches
+
+
+def get_peer_syntaxes(peer: PeerKey, association) -> List[str]:
+  """
+  Args:
+    peer: the PACS peer
+    association: association with the peer
+
+  Returns:
+    The transfer syntaxes to send studies to the peer in, by preference
+  """
+  accepted = {
+    str(context.transfer_syntax[0]) for context in association.accepted_contexts
+    if context.abstract_syntax == SECONDARY_CAPTURE and context.transfer_syntax
+  }
+
+  with _rejected_lock:
+    rejected = _rejected_syntaxes.get(peer, set())
+    return [
+      transfer_syntax for transfer_syntax in STORE_SYNTAXES
+      if transfer_syntax in accepted and transfer_syntax not in rejected
+    ]
+
+
+def reject_syntax(peer: PeerKey, transfer_syntax: str) -> None:
+  with _rejected_lock:
+    _rejected_syntaxes.setdefault(peer, set()).add(transfer_syntax)
+
+  logger.error(f"{peer[3]} failed to store a study in {uid.UID(transfer_syntax).name}, falling back")
+
+
+def encode_dataset(dataset: Dataset, transfer_syntax: str) -> Dataset:
+  """
+  Args:
+    dataset: the study to send
+    transfer_syntax: UID of the transfer syntax to send the study in
+
+  Returns:
+    A copy of the study, with its pixel data compressed if the syntax is compressed
+
+  Remark:
+    Uncompressed syntaxes, including the deflated, are encoded by pynetdicom
+    when the study is sent. Studies stored compressed, see
+    dicomlib.try_add_pixeldata, are sent as they are, when the syntax matches.
+  """
+  transfer_syntax = uid.UID(transfer_syntax)
+  encoded = copy.deepcopy(dataset)
+
+  if dicomlib.is_compressed(encoded):
+    if encoded.file_meta.TransferSyntaxUID == transfer_syntax:
+      return encoded
+    dicomlib.decompress_dataset(encoded)
+
+  if transfer_syntax.is_compressed and 'PixelData' in encoded:
+    dicomlib.compress_dataset(encoded, transfer_syntax)
+  else:
+    encoded.file_meta.TransferSyntaxUID = transfer_syntax
+    encoded.is_implicit_VR = transfer_syntax.is_implicit_VR
+    encoded.is_little_endian = transfer_syntax.is_little_endian
+
+  return encoded
+
+
+def is_syntax_failure(status: int) -> bool:
+  """
+  Returns:
+    Whether a failed C-STORE status may be caused by the transfer syntax,
+    i.e. "Data Set does not match SOP Class" or "Cannot understand"
+  """
+  return 0xA900 <= status <= 0xA9FF or 0xC000 <= status <= 0xCFFF
+
+
+def send_c_store(peer: PeerKey, association, dataset: Dataset, syntaxes: List[str]) -> str:
+  """
+  Sends a study in the most preferred transfer syntax, falling back to the
+  next one if PACS fails to store it in that syntax
+
+  Args:
+    peer: the PACS peer
+    association: association with the peer
+    dataset: the study to send
+    syntaxes: transfer syntaxes accepted by the peer, see get_peer_syntaxes
+
+  Returns:
+    Why the study wasn't stored, empty if it was
+  """
+  error = f"{peer[3]} accepted none of the proposed transfer syntaxes"
+  for transfer_syntax in list(syntaxes):
+    try:
+      encoded = encode_dataset(dataset, transfer_syntax)
+    except Exception as e:
+      logger.error(f"Unable to encode {dataset.get('AccessionNumber')} in {uid.UID(transfer_syntax).name}, got exception {e}")
+      continue
+
+    try:
+      status = association.send_c_store(encoded)
+    except Exception as e:
+      return f"C-STORE failed with exception: {e}"
+
+    if 'Status' in status and status.Status == 0x0000:
+      return ''
+
+    error = f"C-STORE failed with status: {status.get('Status')}"
+    if 'Status' not in status or not is_syntax_failure(status.Status):
+      return error
+
+    # Explicit VR Little Endian is the fall back, so the study itself must be at fault
+    if transfer_syntax == uid.ExplicitVRLittleEndian:
+      return error
+
+    # Don't try the syntax again for the rest of the batch either
+    reject_syntax(peer, transfer_syntax)
+    syntaxes.remove(transfer_syntax)
+
+  return error
+
+
+def send_batch(peer: PeerKey, items: List[models.PacsOutboxItem]) -> Dict[int, str]:
+  """
+  Sends a batch of studies to a PACS peer over a single association
+
+  Args:
+    peer: the PACS peer
+    items: the studies to send
+
+  Returns:
+    The error of each study by its id, empty if the study was sent
+  """
+  calling_aet, ip, port, ae_title = peer
+
+  errors = { }
+  with ae_controller.association_pool.borrow(calling_aet, ip, port, ae_title, STORE_CONTEXTS, logger) as association:
+    syntaxes = get_peer_syntaxes(peer, association) if association else [ ]
+    for item in items:
+      if not association or not association.is_established:
+        errors[item.id] = f"Unable to associate with {ae_title} at {ip}:{port}"
+        record_failure(item, errors[item.id])
+        continue
+
+      try:
+        dataset = dicomlib.dcmread_wrapper(item.path)
+      except FileNotFoundError:
+        errors[item.id] = f"The file {item.path} is missing"
+        logger.error(f"Removing {item.accession_number} from the outbox, its file {item.path} is missing")
+        pending().filter(id=item.id, queued=item.queued).delete()
+        continue
+
+      errors[item.id] = send_c_store(peer, association, dataset, syntaxes)
+      if errors[item.id]:
+        record_failure(item, errors[item.id])
+      else:
+        record_success(item)
+
+  return errors
+
+
+def send_batch_worker(peer: PeerKey, items: List[models.PacsOutboxItem]) -> int:
+  """
+  Runs send_batch inside a worker thread, failures are contained to the peer
+
+  Returns:
+    The number of sent studies
+  """
+  try:
+    errors = send_batch(peer, items)
+    return sum(1 for error in errors.values() if not error)
+  except Exception as e:
+    logger.error(f"Failed to send to {peer[3]}, got exception {e}")
+    return 0
+  finally:
+    # Django opens a database connection per thread, which must be closed by the thread
+    connection.close()
+
+
+def drain(executor: ThreadPoolExecutor, workers: int, batch_size: int) -> Tuple[int, int]:
+  """
+  Sends a batch of the due studies to each PACS peer
+
+  Args:
+    executor: thread pool to send in
+    workers: max number of peers sent to at once
+    batch_size: max number of studies sent to a peer
+
+  Returns:
+    The number of attempted and sent studies
+  """
+  batches = get_due_batches(batch_size, workers)
+  futures = [executor.submit(send_batch_worker, peer, items) for peer, items in batches.items()]
+  sent = sum(future.result() for future in futures)
+
+  return sum(len(items) for items in batches.values()), sent
+
+
+def purge_sent(days: int) -> int:
+  """
+  Removes the studies sent more than days ago from the outbox
+
+  Returns:
+    The number of removed studies
+  """
+  cutoff = timezone.now() - datetime.timedelta(days=days)
+  removed, _ = models.PacsOutboxItem.objects.filter(
+    state=enums.OutboxState.SENT.value,
+    sent__lt=cutoff
+  ).delete()
+
+  return removed
+
+
+def import_file_queue() -> int:
+  """
+  Adds the studies queued by the old file queue to the outbox
+
+  Returns:
+    The number of added studies
+  """
+  queue_dir = Path(server_config.PACS_QUEUE_DIR)
+  if not queue_dir.is_dir():
+    return 0
+
+  imported = 0
+  for conf_path in queue_dir.glob('*.json'):
+    accession_number = conf_path.stem
+    queue_path = get_queue_path(accession_number)
+
+    if queue_path.exists() and not pending().filter(accession_number=accession_number).exists():
+      try:
+        with open(conf_path, 'r') as fp:
+          conf = json.load(fp)
+        patient_id = dicomlib.dcmread_wrapper(queue_path, header_only=True).get('PatientID', '')
+
+        models.PacsOutboxItem.objects.create(
+          accession_number=accession_number,
+          patient_id=str(patient_id),
+          path=str(queue_path),
+          calling_aet=conf['pacs_calling'],
+          ip=conf['pacs_ip'],
+          port=int(conf['pacs_port']),
+          ae_title=conf['pacs_aet'],
+          state=enums.OutboxState.PENDING.value,
+        )
+        imported += 1
+      except Exception as e:
+        logger.error(f"Unable to import {conf_path} into the outbox, got exception {e}")
+        continue
+
+    conf_path.unlink()
+
+  logger.info(f"Imported {imported} studies from the old PACS queue")
+
+  return imported
+
+
+def get_status() -> dict:
+  """
+  Returns:
+    The depth and age of the outbox, in total and for each PACS peer
+  """
+  now = timezone.now()
+
+  def get_age(queued: Optional[datetime.datetime]) -> Optional[float]:
+    return (now - queued).total_seconds() if queued else None
+
+  pending_items = pending()
+  oldest = pending_items.aggregate(oldest=Min('queued'))['oldest']
+
+  peers = [ ]
+  for peer in pending_items.values('ae_title', 'ip', 'port').annotate(depth=Count('id'), oldest=Min('queued')).order_by('ae_title'):
+    peers.append({
+      'ae_title' : peer['ae_title'],
+      'ip'       : peer['ip'],
+      'port'     : peer['port'],
+      'depth'    : peer['depth'],
+      'age'      : get_age(peer['oldest']),
+    })
+
+  return {
+    'depth'        : pending_items.count(),
+    'age'          : get_age(oldest),
+    'failing'      : pending_items.filter(attempts__gt=0).count(),
+    'sent_last_day': models.PacsOutboxItem.objects.filter(
+      state=enums.OutboxState.SENT.value,
+      sent__gte=now - datetime.timedelta(days=1)
+    ).count(),
+    'peers'        : peers,
+  }
+
+
+def run(
+  workers: int=server_config.PACS_OUTBOX_WORKERS,
+  batch_size: int=server_config.PACS_OUTBOX_BATCH_SIZE,
+  poll_interval: float=server_config.PACS_OUTBOX_POLL_INTERVAL
+  ) -> None:
+  """
+  Drains the outbox forever, see pacsSenderThread.py
+
+  Kwargs:
+    workers: max number of peers sent to at once
+    batch_size: max number of studies sent to a peer at once
+    poll_interval: seconds to sleep when no studies are due
+  """
+  import_file_queue()
+
+  last_purge = None
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="PacsSender") as executor:
+    while True:
+      try:
+        attempted, sent = drain(executor, workers, batch_size)
+        if attempted:
+          logger.info(f"Sent {sent} of {attempted} due studies to PACS")
+
+        today = datetime.date.today()
+        if today != last_purge:
+          purge_sent(server_config.PACS_OUTBOX_SENT_DAYS)
+          last_purge = today
+      except Exception as e:
+        logger.error(f"Failed to drain the PACS outbox, got exception {e}")
+        attempted = 0
+
+      # Keep sending while studies are due, e.g. more than a batch was queued
+      if not attempted:
+        time.sleep(poll_interval)
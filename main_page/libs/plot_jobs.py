@@ -0,0 +1,259 @@
+#Python packages
+import datetime
+import os
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils import timezone
+
+#Custom modules
+from . import dicomlib
+from . import enums
+from . import server_config
+from .clearance_math import plotting
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file renders the plots of studies outside of the web server, see
+  models.PlotJob. Rendering the 1920x1080 plot takes about a second, so
+  FillStudyView queues a job when a study is calculated and returns at once,
+  while the present page polls the job, see api.PlotJobEndpoint.
+
+  Jobs are run by the plot renderer service, plotRendererThread.py, calling
+  run. Plots are rendered in a pool of PLOT_RENDER_WORKERS processes, such
+  that rendering scales with the number of cores. A plot is rendered from the
+  study as it's saved, and is only written back if the study wasn't saved
+  again while it was rendered, otherwise it's rendered again, see write_plot.
+"""
+
+
+def pending() -> QuerySet:
+  return models.PlotJob.objects.filter(state=enums.PlotJobState.PENDING.value)
+
+
+def get_latest(accession_number: str) -> Optional[models.PlotJob]:
+  """
+  Returns:
+    The last job of a study, None if the study has no jobs
+  """
+  return models.PlotJob.objects.filter(accession_number=accession_number).order_by('-id').first()
+
+
+def enqueue(accession_number: str, path: Union[str, Path]) -> models.PlotJob:
+  """
+  Queues the plot of a study for rendering
+
+  Args:
+    accession_number: accession number of the study
+    path: dicom file of the study, saved with the values to plot
+
+  Returns:
+    The job of the study
+
+  Remark:
+    If the plot is already queued, the job is requested again, such that
+    the plot is rendered from the study as it's saved now.
+  """
+  job = pending().filter(accession_number=accession_number).first()
+  if job is None:
+    job = models.PlotJob.objects.create(
+      accession_number=accession_number,
+      path=str(path),
+      state=enums.PlotJobState.PENDING.value
+    )
+  else:
+    job.path = str(path)
+    job.requested = timezone.now()
+    job.save()
+
+  logger.info(f"Queued plot of {accession_number} for rendering")
+
+  return job
+
+
+def render(path: str) -> Tuple[int, bytes]:
+  """
+  Renders the plot of a study, runs in a worker process
+
+  Args:
+    path: dicom file of the study
+
+  Returns:
+    The modification time in ns of the file rendered from, and the plot as
+    raw RGB bytes, see plotting.generate_plot_from_dataset
+  """
+  modified = os.stat(path).st_mtime_ns
+  dataset = dicomlib.dcmread_wrapper(path, header_only=True)
+
+  return modified, plotting.generate_plot_from_dataset(dataset)
+
+
+def write_plot(job: models.PlotJob, modified: int, pixel_bytes: bytes) -> bool:
+  """
+  Writes a rendered plot into the PixelData of its study
+
+  Args:
+    job: the job of the plot
+    modified: the modification time in ns of the file rendered from
+    pixel_bytes: the rendered plot
+
+  Returns:
+    True if the plot was written, False if the study was saved again while
+    it was rendered, i.e. the plot may be out of date
+
+  Remark:
+    The study is written to a temporary file, which replaces the study once
+    it's checked again that the study wasn't saved meanwhile. This way a save
+    while the plot is written isn't overwritten, except for the instant
+    between the check and the replace.
+  """
+  if os.stat(job.path).st_mtime_ns != modified:
+    return False
+
+  dataset = dicomlib.dcmread_wrapper(job.path)
+  dicomlib.try_add_pixeldata(dataset, pixel_bytes)
+
+  tmp_path = f"{job.path}.plot.tmp"
+  try:
+    dicomlib.save_dicom(tmp_path, dataset)
+    if os.stat(job.path).st_mtime_ns != modified:
+      return False
+    os.replace(tmp_path, job.path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.unlink(tmp_path)
+
+  dicomlib.dataset_cache.invalidate(job.path)
+
+  return True
+
+
+def record_success(job: models.PlotJob) -> None:
+  # The job is still pending, if it was requested again while it was rendered
+  updated = pending().filter(id=job.id, requested=job.requested).update(
+    state=enums.PlotJobState.DONE.value,
+    finished=timezone.now(),
+    error=''
+  )
+
+  if updated:
+    logger.info(f"Rendered plot of {job.accession_number}")
+
+
+def record_failure(job: models.PlotJob, error: str) -> None:
+  pending().filter(id=job.id, requested=job.requested).update(
+    state=enums.PlotJobState.FAILED.value,
+    finished=timezone.now(),
+    error=error[:255]
+  )
+  logger.error(f"Failed to render plot of {job.accession_number}: {error}")
+
+
+def finish(job: models.PlotJob, future: Future) -> None:
+  """
+  Records the result of rendering a plot
+  """
+  try:
+    modified, pixel_bytes = future.result()
+  except FileNotFoundError:
+    record_failure(job, f"The study {job.path} no longer exists")
+    return
+  except BrokenProcessPool:
+    raise
+  except Exception as e:
+    record_failure(job, f"Rendering failed with exception: {e}")
+    return
+
+  try:
+    written = write_plot(job, modified, pixel_bytes)
+  except Exception as e:
+    record_failure(job, f"Unable to save the plot, got exception {e}")
+    return
+
+  if written:
+    record_success(job)
+  else:
+    logger.info(f"{job.accession_number} was saved while its plot was rendered, rendering it again")
+
+
+def purge_finished(days: int) -> int:
+  """
+  Removes the jobs finished more than days ago
+
+  Returns:
+    The number of removed jobs
+  """
+  cutoff = timezone.now() - datetime.timedelta(days=days)
+  removed, _ = models.PlotJob.objects.exclude(
+    state=enums.PlotJobState.PENDING.value
+  ).filter(finished__lt=cutoff).delete()
+
+  return removed
+
+
+def create_executor(workers: int) -> ProcessPoolExecutor:
+  """
+  Starts the worker processes rendering plots
+
+  Remark:
+    The workers are forked, so the database connection is closed first, such
+    that they don't share it with this process.
+  """
+  connection.close()
+  executor = ProcessPoolExecutor(max_workers=workers)
+  executor.submit(int).result() # Forks the workers before the database is used again
+
+  return executor
+
+
+def run(
+  workers: int=server_config.PLOT_RENDER_WORKERS,
+  poll_interval: float=server_config.PLOT_RENDER_POLL_INTERVAL
+  ) -> None:
+  """
+  Renders the queued plots forever, see plotRendererThread.py
+
+  Kwargs:
+    workers: number of processes rendering plots
+    poll_interval: seconds to wait for new jobs
+  """
+  executor = create_executor(workers)
+  rendering: Dict[Future, models.PlotJob] = { }
+  last_purge = None
+
+  while True:
+    try:
+      # Keep the workers busy, without queueing jobs which may be requested again
+      busy = [job.id for job in rendering.values()]
+      for job in pending().exclude(id__in=busy).order_by('requested')[:workers - len(rendering)]:
+        rendering[executor.submit(render, job.path)] = job
+
+      if not rendering:
+        time.sleep(poll_interval)
+      else:
+        done, _ = wait(rendering, timeout=poll_interval, return_when=FIRST_COMPLETED)
+        for future in done:
+          finish(rendering.pop(future), future)
+
+      today = datetime.date.today()
+      if today != last_purge:
+        purge_finished(server_config.PLOT_JOB_DAYS)
+        last_purge = today
+    except BrokenProcessPool:
+      # A worker died, e.g. killed for memory, the jobs being rendered are rendered again
+      logger.error("A plot rendering process died, restarting the workers")
+      executor.shutdown(wait=False)
+      rendering.clear()
+      executor = create_executor(workers)
+    except Exception as e:
+      logger.error(f"Failed to render the queued plots, got exception {e}")
+      time.sleep(poll_interval)
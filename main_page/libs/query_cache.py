@@ -0,0 +1,165 @@
+#Python packages
+import datetime
+import hashlib
+import json
+import threading
+
+from typing import Any, Callable, Dict, Hashable
+
+from django.utils import timezone
+
+#Custom modules
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file holds a short lived cache of query results, such that identical
+  queries to PACS from several users are only sent once.
+
+  The results are stored in the database, see models.QueryCacheEntry, so
+  every uwsgi worker shares them, and the PACS sender service can invalidate
+  the results of a patient, once it has stored a study of the patient, see
+  invalidate_patient.
+
+  Concurrent identical queries within a process are coalesced, i.e. the first
+  caller sends the query while the others wait for its result, see
+  QueryResultCache.get.
+"""
+
+
+class _Flight():
+  """
+  A query being sent, which callers with the same key wait for
+  """
+  def __init__(self):
+    self.done = threading.Event()
+    self.result: Any = None
+
+
+class QueryResultCache():
+  """
+  TTL cache of query results in the database, with single-flight coalescing
+
+  Entries are keyed by a hashable key, e.g. the normalised query parameters,
+  and are used for ttl seconds after the query was answered. Failed queries,
+  i.e. queries returning None, are not cached.
+
+  Remarks:
+    Results are stored as json, so callers get their own copy of a result,
+    and results must be json serializable, e.g. lists of dicts of strings.
+    A query answered by PACS before, but cached after, a study of its patient
+    was stored, is cached with the study missing, until it expires.
+  """
+  def __init__(self, name: str, ttl: float, max_entries: int):
+    """
+    Args:
+      name: name of the cache, distinguishing its entries from other caches
+      ttl: seconds a result is used for
+      max_entries: max number of results kept, the first to expire are removed
+    """
+    self.name = name
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._flights: Dict[Hashable, _Flight] = { }
+
+  @staticmethod
+  def _hash_key(key: Hashable) -> str:
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+  def _load(self, key: Hashable) -> Any:
+    result = models.QueryCacheEntry.objects.filter(
+      name=self.name,
+      key=self._hash_key(key),
+      expires__gt=timezone.now()
+    ).values_list('result', flat=True).first()
+
+    return None if result is None else json.loads(result)
+
+  def _store(self, key: Hashable, result: Any, patient_id: str) -> None:
+    now = timezone.now()
+    models.QueryCacheEntry.objects.update_or_create(
+      name=self.name,
+      key=self._hash_key(key),
+      defaults={
+        'patient_id' : patient_id,
+        'result'     : json.dumps(result),
+        'expires'    : now + datetime.timedelta(seconds=self.ttl),
+      }
+    )
+
+    entries = models.QueryCacheEntry.objects.filter(name=self.name)
+    entries.filter(expires__lte=now).delete()
+    surplus = entries.order_by('-expires').values_list('id', flat=True)[self.max_entries:]
+    models.QueryCacheEntry.objects.filter(id__in=list(surplus)).delete()
+
+  def get(self, key: Hashable, query: Callable[[], Any], patient_id: str='') -> Any:
+    """
+    Gets the result of a query, sending it unless it's cached or already being sent
+
+    Args:
+      key: key identifying the query
+      query: sends the query and returns the result, None on failure
+
+    Kwargs:
+      patient_id: the patient the query is restricted to, empty if the query
+                  may find studies of any patient, see invalidate_patient
+
+    Returns:
+      The result of the query
+    """
+    try:
+      result = self._load(key)
+    except Exception as e:
+      logger.error(f"Unable to read the {self.name} cache, got exception {e}")
+      result = None
+
+    if result is not None:
+      return result
+
+    with self._lock:
+      flight = self._flights.get(key)
+      is_leader = flight is None
+      if is_leader:
+        flight = _Flight()
+        self._flights[key] = flight
+
+    if not is_leader:
+      flight.done.wait()
+      return json.loads(json.dumps(flight.result))
+
+    try:
+      flight.result = query()
+      if flight.result is not None:
+        try:
+          self._store(key, flight.result, patient_id)
+        except Exception as e:
+          logger.error(f"Unable to write to the {self.name} cache, got exception {e}")
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.done.set()
+
+    return json.loads(json.dumps(flight.result))
+
+  def clear(self) -> None:
+    models.QueryCacheEntry.objects.filter(name=self.name).delete()
+
+
+def invalidate_patient(patient_id: str) -> int:
+  """
+  Removes the cached results which may contain studies of a patient, i.e. of
+  the queries on the patient and of the queries on any patient, call it when
+  a study of the patient is stored in PACS
+
+  Args:
+    patient_id: cpr number of the patient
+
+  Returns:
+    The number of removed results
+  """
+  patient_id = patient_id.replace('-', '')
+  removed, _ = models.QueryCacheEntry.objects.filter(patient_id__in=('', patient_id)).delete()
+
+  return removed
@@ -4,13 +4,8 @@ from pydicom.sequence import Sequence
 from pydicom.datadict import DicomDictionary, keyword_dict
 from pynetdicom import AE, StoragePresentationContexts, evt
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove
-import os
 import shutil
-import glob
 import datetime
-import threading
-import time
-import json
 
 
 from main_page import log_util
@@ -20,25 +15,20 @@ from main_page.libs import ae_controller
 from main_page.libs import dicomlib, dataset_creator
 from main_page.libs import server_config
 from main_page.libs import formatting
+from main_page.libs import query_cache
+from main_page.libs import pacs_outbox
 
 from main_page.libs.clearance_math import clearance_math
 from main_page.libs.dirmanager import try_mkdir
 
 logger = log_util.get_logger("")
 
-def move_study_from_search_cache(dataset, *args, **kwargs):
-  """
-    This is the hanlder
-
-  """
-  accession_number = kwargs['accession_number']
-
-  target_file = f'{server_config.SEARCH_DIR}/{accession_number}.dcm'
-
-  if not(os.path.exists(target_file)):
-    logger.error(f'Could not find the file {accession_number} from pacs')
-  else:
-    logger.info(f'Recieved File successfully for study {accession_number}')
+# Responses of recent searches, see search_query_pacs
+search_result_cache = query_cache.QueryResultCache(
+  'search',
+  server_config.SEARCH_RESULT_CACHE_TTL,
+  server_config.SEARCH_RESULT_CACHE_MAX_ENTRIES
+)
 
 def move_and_store(dataset, *args, **kwargs):
   """
@@ -50,23 +40,30 @@ def move_and_store(dataset, *args, **kwargs):
       C-Find retrun dataset dataset
       required KW:
         move_assoc: An connected and active Pynetdicom.Association object
+        moved_files: dict the path of the moved dataset is stored in, by accession number
 
   """
-  if 'move_assoc' and 'AE_title' in kwargs:
+  if 'move_assoc' in kwargs and 'AE_title' in kwargs and 'moved_files' in kwargs:
     move_assoc = kwargs['move_assoc']
     AE_title     = kwargs['AE_title']
+    moved_files  = kwargs['moved_files']
   else:
     logger.info('config or move_assoc doesn\'t exsists')
-    raise AttributeError("move_assoc and config is a required keyword")
+    raise AttributeError("move_assoc, AE_title and moved_files are required keywords")
 
-  ae_controller.send_move(
+  target_file = ae_controller.move_and_wait(
     move_assoc,
     AE_title,
     dataset,
-    move_study_from_search_cache,
-    accession_number=dataset.AccessionNumber
+    logger=logger
     )
 
+  if target_file is None:
+    logger.error(f'Could not find the file {dataset.AccessionNumber} from pacs')
+  else:
+    logger.info(f'Recieved File successfully for study {dataset.AccessionNumber}')
+    moved_files[dataset.AccessionNumber] = target_file
+
 def get_study(user, accession_number):
   """
     This function retrieves a completed study with the accession number given.
@@ -88,42 +85,34 @@ def get_study(user, accession_number):
 
   AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
 
-  storage_find_ae = ae_controller.create_find_AE_study(AE_title)
-  storage_move_ae = ae_controller.create_move_AE(AE_title)
-
-  storage_find_assoc = ae_controller.establish_assoc(
-    storage_find_ae,
-    config.storage.ip,
-    config.storage.port,
-    config.storage.ae_title,
-    logger
-  )
-  if not storage_find_assoc:
-    return None, "Error"
-
-  storage_move_assoc = ae_controller.establish_assoc(
-    storage_move_ae,
-    config.storage.ip,
-    config.storage.port,
-    config.storage.ae_title,
-    logger)
-
-  if not storage_move_assoc:
-    storage_find_assoc.release()
-    logger.error('Could not etablish with pacs find assoc!')
-    return None, "Error"
-
   find_dataset = dataset_creator.create_search_dataset('', '', '', '', accession_number )
-  ae_controller.send_find(
-    storage_find_assoc,
-    find_dataset,
-    move_and_store,
-    move_assoc=storage_move_assoc,
-    AE_title=AE_title)
+  moved_files = { }
+
+  # The find and move associations are borrowed together, see AssociationPool
+  with ae_controller.association_pool.borrow_several(
+      AE_title,
+      config.storage.ip,
+      config.storage.port,
+      config.storage.ae_title,
+      [[StudyRootQueryRetrieveInformationModelFind], [StudyRootQueryRetrieveInformationModelMove]],
+      logger
+    ) as storage_assocs:
+    if not storage_assocs:
+      logger.error('Could not etablish the pacs find and move assocs!')
+      return None, "Error"
+
+    storage_find_assoc, storage_move_assoc = storage_assocs
+    ae_controller.send_find(
+      storage_find_assoc,
+      find_dataset,
+      move_and_store,
+      move_assoc=storage_move_assoc,
+      AE_title=AE_title,
+      moved_files=moved_files)
 
-  target_file = f'{server_config.SEARCH_DIR}/{accession_number}.dcm'
+  target_file = moved_files.get(accession_number)
 
-  if os.path.exists(target_file):
+  if target_file is not None and target_file.exists():
     return dicomlib.dcmread_wrapper(target_file), target_file
   else:
     logger.error(f'Could not find request study {accession_number}')
@@ -131,8 +120,8 @@ def get_study(user, accession_number):
 
 def store_dicom_pacs(dicom_object, user, ensure_standart=True):
   """
-  Stores a dicom object in the user defined pacs (user.department.config)
-  It uses a C-store message
+  Queues a dicom object for the user defined pacs (user.department.config),
+  the PACS sender service sends it with a C-store message, see pacs_outbox
 
   Args:
     dicom_object : pydicom dataset, the dataset to be stored
@@ -141,128 +130,21 @@ def store_dicom_pacs(dicom_object, user, ensure_standart=True):
   KWargs:
     ensure_standart : Bool, if true the function preforms checks, that the given dicom object contains the nessesary tags for a successful
   Returns:
-    Success : Bool, returns true on a success full storage, false on failed storage
+    Success : Bool, returns true on a successful queueing, false if it couldn't be queued
     Failure Message : String, A user friendly message of what went wrong. Empty on success.
   Raises
     Value error: If the dicom set doesn't contain required information to send
   """
-  accession_number = dicom_object.AccessionNumber
-  AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
-  #AE_title = user.department.config.ris_calling
-  # Save the dicom file to be sent to PACS
-  try_mkdir(server_config.PACS_QUEUE_DIR, mk_parents=True)
-  store_file = f"{server_config.PACS_QUEUE_DIR}{accession_number}.dcm"
-
-  dicomlib.save_dicom(store_file, dicom_object)
-
   if not user.department.config.pacs:
     return False, "Error: No PACS address in configuration."
 
-  # Write file with connection configurations
-  # hey hey hey, I present the newest programming invention:
-  # MULTIPLE FUNCTIONAL ARGUMENTS, no more writing a file, and opening it up
-  with open(f"{server_config.PACS_QUEUE_DIR}{accession_number}.json", "w") as fp:
-    fp.write(json.dumps({
-      "pacs_calling": AE_title,
-      "pacs_ip":    user.department.config.pacs.ip,
-      "pacs_port":  user.department.config.pacs.port,
-      "pacs_aet":   user.department.config.pacs.ae_title,
-    }))
-
-  # Spawn background thread to send study
-  store_thread = threading.Thread(
-    daemon=True,
-    target=thread_store,
-    args=(
-      accession_number,
-      server_config.PACS_QUEUE_WAIT_TIME
-    )
-  )
-  store_thread.start()
+  AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
+  #AE_title = user.department.config.ris_calling
+  pacs_outbox.enqueue(dicom_object, AE_title, user.department.config.pacs)
 
   return True, ""
 
 
-def thread_store(accession_number, wait_time, max_attempts=5):
-  """
-  Send a study to PACS
-
-  Args:
-    accession_number: accession number of study to send
-    wait_time: time to wait before attempting to send again if failed
-
-  Kwargs:
-    max_attempts: max number of attempts to try and send to PACS
-
-  TODO: Implement the max cap for attempts
-  NOTE: Adding a cap on the number of attempts might be a bad idea,
-        think if PACS is down for the whole day and the cap runs out.
-        Then a lot of studies are going to get stuck in the queue folder,
-        and aren't sent to PACS until the entire server is reset.
-  """
-  # Load study and connection configuration - if the files cannot be found don't send
-  ds_file = f"{server_config.PACS_QUEUE_DIR}{accession_number}.dcm"
-  conf_file = f"{server_config.PACS_QUEUE_DIR}{accession_number}.json"
-
-  if not os.path.exists(ds_file) or not os.path.exists(conf_file):
-    return
-
-  with open(conf_file, "r") as fp:
-    conf = json.loads(fp.read())
-
-  ds = dicomlib.dcmread_wrapper(ds_file)
-
-  # Send study to PACS
-  is_sent = False
-
-  while not is_sent:
-    ae = AE(ae_title=conf["pacs_calling"])
-    ae.add_requested_context('1.2.840.10008.5.1.4.1.1.7', transfer_syntax='1.2.840.10008.1.2.1')
-    assoc = ae.associate(
-      conf["pacs_ip"],
-      int(conf["pacs_port"]),
-      ae_title=conf["pacs_aet"]
-    )
-
-    if assoc.is_established:
-      status = assoc.send_c_store(ds)
-      if status.Status == 0x0000:
-        is_sent = True
-
-    if not is_sent:
-      logger.error(f"Failed to send study to PACS: {ds_file}, with parmeters: {conf['pacs_ip']} - {conf['pacs_port']} aet: {conf['pacs_aet']} aec: {conf['pacs_calling']}")
-      time.sleep(wait_time)
-
-  # Clean up or report if failed to send to PACS
-  if is_sent:
-    os.remove(ds_file)
-    os.remove(conf_file)
-  else:
-    logger.error(f"Failed to send study to PACS: {ds_file}.")
-
-
-def send_queue_to_PACS():
-  """
-  Spawn threads for sending all studies in the queue folder to PACS
-  This should be called on start up of the server, so the missing
-  studies can be correctly send to PACS.
-  """
-  for dcm_file in glob.glob(f"{server_config.PACS_QUEUE_DIR}*.dcm"):
-    accession_number = dcm_file.split(".")[-2].split("/")[-1]
-
-    # print(f"Spawning PACS send thread for: {accession_number}")
-
-    store_thread = threading.Thread(
-      target=thread_store,
-      daemon=True,
-      args=(
-        accession_number,
-        server_config.PACS_QUEUE_WAIT_TIME
-      )
-    )
-    store_thread.start()
-
-
 def start_scp_server(ae_title):
   """
   Problems:
@@ -424,12 +306,130 @@ def start_scp_server(ae_title):
 
   return server_instance
 
-def search_query_pacs(config, logger, name="", cpr="", accession_number="", date_from="", date_to=""):
+def get_search_key(config, name="", cpr="", accession_number="", date_from="", date_to=""):
+  """
+  Normalises the parameters of a search, such that searches returning the same
+  responses get the same key in search_result_cache
+
+  Returns:
+    Tuple of the storage AE and the normalised parameters, the cpr number is at index 4
+  """
+  return (
+    config.storage.ae_title,
+    config.storage.ip,
+    str(config.storage.port),
+    " ".join(name.split()).lower(),
+    cpr.replace('-', '').strip(),
+    accession_number.strip(),
+    date_from.replace('-', ''),
+    date_to.replace('-', ''),
+  )
+
+
+def search_query_pacs(config, logger, name="", cpr="", accession_number="", date_from="", date_to="", process=None):
   """
+  Return list of responses, None if PACS connection failed
+
+  Kwargs:
+    process: called with every response dataset, e.g. to archive it
+
+  Remark:
+    Responses are cached for SEARCH_RESULT_CACHE_TTL seconds, and identical
+    searches sent at the same time share a single query, see search_result_cache.
+    The cached responses are invalidated once the PACS sender service stores a
+    study of the searched patient, see pacs_outbox.record_success.
+    process is only called for the searches actually sent to PACS.
+  """
+  # Don't query if no PACS address
+  if not config.pacs:
+    logger.warning(f"Unable to execute search query. No PACS address in configuration: {config}.")
+    return None
+
+  key = get_search_key(config, name, cpr, accession_number, date_from, date_to)
+  return search_result_cache.get(
+    key,
+    lambda: send_search_query(config, logger, name, cpr, accession_number, date_from, date_to, process),
+    patient_id=key[4]
+  )
+
+
+def stream_search_query_pacs(config, logger, name="", cpr="", accession_number="", date_from="", date_to="", process=None):
+  """
+  Sends a search to PACS, yielding the responses as they arrive
+
+  Kwargs:
+    process: called with every response dataset, e.g. to archive it
+
+  Yields:
+    Search results, on the form of search_query_pacs
+
+  Raises:
+    ValueError: if there's no PACS address in the configuration or PACS can't be reached
+
+  Remark:
+    Closing the generator before it's exhausted cancels the query, so callers
+    having enough results should close it, e.g. with contextlib.closing.
+    Streamed searches aren't cached, see search_query_pacs.
+  """
+  if not config.pacs:
+    raise ValueError(f"No PACS address in configuration: {config}")
+
+  AE_title = models.ServerConfiguration.objects.get(id=1).AE_title
+  search_dataset = dataset_creator.create_search_dataset(
+    name,
+    cpr,
+    date_from,
+    date_to,
+    accession_number
+  )
+
+  with ae_controller.association_pool.borrow(
+      AE_title,
+      config.storage.ip,
+      config.storage.port,
+      config.storage.ae_title,
+      [StudyRootQueryRetrieveInformationModelFind],
+      logger
+    ) as association:
+    if not association:
+      raise ValueError(f"Failed to establish association to PACS: {config.storage.ae_title}")
+
+    responses = ae_controller.iter_find(association, search_dataset, logger=logger)
+    try:
+      for dataset in responses:
+        try:
+          if process:
+            process(dataset)
+
+          result = {
+            'accession_number': dataset.AccessionNumber,
+            'name'            : formatting.person_name_to_name(str(dataset.PatientName)),
+            'cpr'             : formatting.format_cpr(dataset.PatientID),
+            'date'            : formatting.format_date(dataset.StudyDate)
+          }
+        except Exception as e:
+          logger.info(f"Failed to process incoming search dataset, got exception {e}")
+          continue
+
+        yield result
+    except GeneratorExit:
+      # Closed by the caller, the query is cancelled below and the association handed back
+      pass
+    finally:
+      responses.close()
+
+
+def send_search_query(config, logger, name, cpr, accession_number, date_from, date_to, process):
+  """
+  Sends a search to PACS, see search_query_pacs
+
   Return list of responses, None if PACS connection failed
   """
   def process_incoming_dataset(dataset, *args, **kwargs):
     try:
+      if process:
+        process(dataset)
+
       response_list.append({
         'accession_number': dataset.AccessionNumber,
         'name'            : formatting.person_name_to_name(str(dataset.PatientName)),
@@ -451,36 +451,29 @@ def search_query_pacs(config, logger, name="", cpr="", accession_number="", date
     accession_number
   )
 
-  # Don't query if no PACS address
-  if not config.pacs:
-    logger.warning(f"Unable to execute search query. No PACS address in configuration: {config}.")
-    return None
-
-  # Establish association to PACS
-  association = ae_controller.connect(
-    config.storage.ip,
-    int(config.storage.port),
-    AE_title,
-    config.storage.ae_title,
-    StudyRootQueryRetrieveInformationModelFind,
-    logger=logger
-  )
-  logger.info(f"Got Association: {association}")
-  # Send find query and process successful responses
+  # Borrow association to PACS
   response_list = [ ]
 
-  try:
-    ae_controller.send_find(
-      association,
-      search_dataset,
-      process_incoming_dataset,
-      logger=logger,
-    )
-  except ValueError:
-    logger.error(f"Failed to establish association to PACS with parameters:\npacs_ip: {config.pacs.ip}, pacs_port: {config.pacs.port}, pacs_calling: {AE_title}, pacs_aet: {config.pacs.ae_title}")
-    return None
-
-  association.release()
+  with ae_controller.association_pool.borrow(
+      AE_title,
+      config.storage.ip,
+      config.storage.port,
+      config.storage.ae_title,
+      [StudyRootQueryRetrieveInformationModelFind],
+      logger
+    ) as association:
+    logger.info(f"Got Association: {association}")
+    # Send find query and process successful responses
+    try:
+      ae_controller.send_find(
+        association,
+        search_dataset,
+        process_incoming_dataset,
+        logger=logger,
+      )
+    except ValueError:
+      logger.error(f"Failed to establish association to PACS with parameters:\npacs_ip: {config.pacs.ip}, pacs_port: {config.pacs.port}, pacs_calling: {AE_title}, pacs_aet: {config.pacs.ae_title}")
+      return None
 
   logger.info(f'Returning search list of {len(response_list)}')
 
@@ -0,0 +1,244 @@
+#Python packages
+import datetime
+
+from contextlib import closing
+from pydicom.valuerep import PersonName
+from typing import Dict, Iterator, List, Optional, Tuple
+
+#Custom modules
+from . import archive
+from . import formatting
+from .query_wrappers import pacs_query_wrapper as pacs
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file answers the searches of the search page, see api.SearchEndpoint.
+
+  Searches are answered from the archive of examinations, see archive.py,
+  which holds every examination approved on this server. PACS is only
+  queried for the parts of the date range which the archive doesn't cover,
+  and only when asked to, such that the local results are shown at once
+  while PACS is queried by a second request.
+
+  Examinations found in PACS are archived, and a date range searched in PACS
+  without any patient criteria is recorded as covered, so it's answered
+  locally from then on.
+
+  stream_search answers the same searches, but yields the results as they
+  arrive from PACS, see api.SearchStreamEndpoint.
+"""
+
+SearchResult = Dict[str, str]
+
+
+def parse_date(date_str: str) -> Optional[datetime.date]:
+  """
+  Args:
+    date_str: date on the form YYYY-MM-DD or YYYYMMDD, may be empty
+
+  Returns:
+    The date, None if it's empty or invalid
+  """
+  try:
+    return datetime.datetime.strptime(date_str.replace('-', ''), "%Y%m%d").date()
+  except (AttributeError, ValueError):
+    return None
+
+
+def to_search_result(examination: models.ArchivedExamination) -> SearchResult:
+  """
+  Formats an archived examination like the search results from PACS, see pacs.search_query_pacs
+  """
+  return {
+    'accession_number': examination.accession_number,
+    'name'            : formatting.person_name_to_name(PersonName(examination.patient_name)),
+    'cpr'             : formatting.format_cpr(examination.patient_id),
+    'date'            : formatting.format_date(examination.study_date.strftime('%Y%m%d')),
+  }
+
+
+def search_local(
+  name: str='',
+  cpr: str='',
+  accession_number: str='',
+  date_from: Optional[datetime.date]=None,
+  date_to: Optional[datetime.date]=None
+  ) -> List[SearchResult]:
+  """
+  Searches the archive
+
+  Kwargs:
+    name: part of the patient name, every word must match
+    cpr: cpr number of the patient, with or without dash
+    accession_number: accession number of the examination
+    date_from: first study date to include
+    date_to: last study date to include
+
+  Returns:
+    The matching examinations by descending study date
+  """
+  query = models.ArchivedExamination.objects.all()
+
+  for name_part in name.split():
+    query = query.filter(patient_name__icontains=name_part)
+  if cpr:
+    query = query.filter(patient_id=cpr.replace('-', ''))
+  if accession_number:
+    query = query.filter(accession_number=accession_number)
+  if date_from:
+    query = query.filter(study_date__gte=date_from)
+  if date_to:
+    query = query.filter(study_date__lte=date_to)
+
+  results = [ ]
+  for examination in query.order_by('-study_date'):
+    try:
+      results.append(to_search_result(examination))
+    except Exception as e:
+      logger.info(f"Failed to format archived examination {examination.accession_number}, got exception {e}")
+
+  return results
+
+
+def search(
+  config: models.Config,
+  name: str='',
+  cpr: str='',
+  accession_number: str='',
+  date_from: str='',
+  date_to: str='',
+  query_pacs: bool=False
+  ) -> Optional[Tuple[List[SearchResult], bool]]:
+  """
+  Searches the archive, and PACS for the date ranges not covered by it
+
+  Args:
+    config: configuration of the department searching
+
+  Kwargs:
+    name: name of the patient
+    cpr: cpr number of the patient
+    accession_number: accession number of the examination
+    date_from: first study date, on the form YYYY-MM-DD
+    date_to: last study date, on the form YYYY-MM-DD
+    query_pacs: whether to query PACS for the uncovered date ranges
+
+  Returns:
+    The search results, deduplicated by accession number, and whether PACS
+    may have more results, i.e. if query_pacs wasn't set and PACS should be
+    queried. None if the PACS query failed
+  """
+  from_date = parse_date(date_from)
+  to_date = parse_date(date_to)
+
+  local_results = search_local(name, cpr, accession_number, from_date, to_date)
+  if accession_number and local_results:
+    return local_results, False
+
+  uncovered = archive.uncovered_ranges(from_date, to_date)
+  if not uncovered:
+    return local_results, False
+
+  if not query_pacs:
+    return local_results, True
+
+  results = { result['accession_number']: result for result in local_results }
+  for range_from, range_to in uncovered:
+    pacs_results = pacs.search_query_pacs(
+      config,
+      logger,
+      name=name,
+      cpr=cpr,
+      accession_number=accession_number,
+      date_from=range_from.strftime('%Y%m%d') if range_from else '',
+      date_to=range_to.strftime('%Y%m%d') if range_to else '',
+      process=archive.archive_search_result
+    )
+
+    if pacs_results is None:
+      return None
+
+    for result in pacs_results:
+      results.setdefault(result['accession_number'], result)
+
+    # Only a search without patient criteria finds every examination in the range
+    if range_from and range_to and not (name or cpr or accession_number):
+      archive.record_coverage(range_from, range_to)
+
+  return list(results.values()), False
+
+
+def stream_search(
+  config: models.Config,
+  name: str='',
+  cpr: str='',
+  accession_number: str='',
+  date_from: str='',
+  date_to: str='',
+  limit: Optional[int]=None
+  ) -> Iterator[SearchResult]:
+  """
+  Searches the archive, then PACS for the date ranges not covered by it,
+  yielding the results as they are found
+
+  Args:
+    config: configuration of the department searching
+
+  Kwargs:
+    name: name of the patient
+    cpr: cpr number of the patient
+    accession_number: accession number of the examination
+    date_from: first study date, on the form YYYY-MM-DD
+    date_to: last study date, on the form YYYY-MM-DD
+    limit: max number of results, the PACS query is cancelled once it's reached
+
+  Yields:
+    The search results, deduplicated by accession number
+
+  Raises:
+    ValueError: if PACS can't be queried
+  """
+  from_date = parse_date(date_from)
+  to_date = parse_date(date_to)
+
+  seen = set()
+  for result in search_local(name, cpr, accession_number, from_date, to_date)[:limit]:
+    seen.add(result['accession_number'])
+    yield result
+
+  if limit is not None and len(seen) >= limit:
+    return
+
+  if accession_number and seen:
+    return
+
+  for range_from, range_to in archive.uncovered_ranges(from_date, to_date):
+    pacs_results = pacs.stream_search_query_pacs(
+      config,
+      logger,
+      name=name,
+      cpr=cpr,
+      accession_number=accession_number,
+      date_from=range_from.strftime('%Y%m%d') if range_from else '',
+      date_to=range_to.strftime('%Y%m%d') if range_to else '',
+      process=archive.archive_search_result
+    )
+
+    # Closing cancels the PACS query, when the limit is reached or the client is gone
+    with closing(pacs_results):
+      for result in pacs_results:
+        if result['accession_number'] in seen:
+          continue
+
+        seen.add(result['accession_number'])
+        yield result
+
+        if limit is not None and len(seen) >= limit:
+          return
+
+    # Only a search without patient criteria finds every examination in the range
+    if range_from and range_to and not (name or cpr or accession_number):
+      archive.record_coverage(range_from, range_to)
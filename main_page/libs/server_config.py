@@ -16,19 +16,26 @@ ENV_VAR_SEARCH_CACHE_PATH    = "GFR_SEARCH_CACHE_PATH"
 ENV_VAR_SEARCH_DIR_PATH      = "GFR_SEARCH_PATH"
 ENV_VAR_STATIC_DIR_PATH      = "GFR_STATIC_PATH"
 ENV_VAR_PACS_QUEUE_DIR       = "GFR_PACS_QUEUE_DIR"
+ENV_VAR_HISTORY_STORE_PATH   = "GFR_HISTORY_STORE_PATH"
 
 # NOTE: All directories MUST end in a '/'
 DAYS_THRESHOLD = 30                                # How long dicom files should be kept stored on the server
 
-CONTROL_STUDIES_DIR = env(ENV_VAR_CONTROL_STUDIES_PATH)
-DELETED_STUDIES_DIR = env(ENV_VAR_DELETE_PATH)            # Directory for temporarily storing deleted studies (i.e. the trashcan)
+CONTROL_STUDIES_DIR = env(ENV_VAR_CONTROL_STUDIES_PATH)    # Old location of studies awaiting control, only read by study_store.rebuild_index
+DELETED_STUDIES_DIR = env(ENV_VAR_DELETE_PATH)            # Old location of deleted studies (i.e. the trashcan), only read by study_store.rebuild_index
 SEARCH_DIR          = env(ENV_VAR_SEARCH_DIR_PATH)                # Directory for temporarily storing search responses
-FIND_RESPONS_DIR    = env(ENV_VAR_FIND_RESPONSE_PATH)      # Directory for temporarily storing find responses ### This name is very bad and should be changed
+FIND_RESPONS_DIR    = env(ENV_VAR_FIND_RESPONSE_PATH)      # Directory of the studies in the study store, see study_store.py ### This name is very bad and should be changed
 SEARCH_CACHE_DIR    = env(ENV_VAR_SEARCH_CACHE_PATH)
 PACS_QUEUE_DIR      = env(ENV_VAR_PACS_QUEUE_DIR)
+HISTORY_STORE_DIR   = env(ENV_VAR_HISTORY_STORE_PATH)      # Directory of the historic studies linked into study directories, see history_store.py
+MOVE_NOTIFY_DIR     = f"{SEARCH_DIR}move_notify/"           # Directory for the sockets the store SCP reports moved datasets to
 
-PACS_QUEUE_WAIT_TIME = 60 * 5 # Number of seconds to wait before attempting to send a file to PACS if failed
+HEADER_ONLY_DEFER_SIZE = '4 KB' # Values larger than this are first read when accessed, in datasets read with only the header
+DATASET_CACHE_MAX_BYTES = 256 * 1024 ** 2 # Memory budget of the in process cache of read datasets, see dicomlib.DatasetCache
+SEARCH_CACHE_MAX_BYTES = 10 * 1024 ** 3 # Byte budget of the search cache, the least recently used studies are evicted beyond it
+MOVE_NOTIFY_TIMEOUT = 10 # Number of seconds to wait for the store SCP to report a dataset after the C-MOVE completed
 RECOVERED_FILENAME = "recovered" # Filename of recovery file containing timestamp of when a study was recovered
+HISTORY_SUMMARY_FILENAME = "history_summary.json" # Filename of the history of a study, see history_store.write_history_summary
 
 STATIC_DIR = f"{settings.STATIC_ROOT}/main_page/"
 IMG_RESPONS_DIR = f"{STATIC_DIR}images/"
@@ -68,6 +75,20 @@ AXIS_FONT_SIZE = 18
 TEXT_FONT_SIZE = 18
 LEGEND_SIZE = 18
 
+# How the plot is stored in the PixelData of a study, see enums.PlotEncoding
+PLOT_PIXEL_ENCODING = 'RLE'
+
+# --- Plot renderer --- #
+# Whether plots are rendered by the plot renderer service, plotRendererThread.py,
+# instead of by the request calculating the study
+PLOT_RENDER_ASYNC = True
+# Number of processes rendering plots
+PLOT_RENDER_WORKERS = os.cpu_count() or 1
+# Seconds the plot renderer service waits for new jobs
+PLOT_RENDER_POLL_INTERVAL = 1
+# Number of days finished plot jobs are kept
+PLOT_JOB_DAYS = 7
+
 
 # --- Samba Share --- #
 
@@ -96,7 +117,78 @@ SERVER_NAME    = 'GFRCalc'
 SERVER_VERSION = 'v1.4'
 
 
+# --- storeSCPserver --- #
+# Number of threads writing received datasets to disk
+STORE_SCP_WRITERS = 4
+# Max number of received datasets waiting to be written, C-STOREs are refused if it stays full
+STORE_SCP_QUEUE_SIZE = 64
+# Seconds a C-STORE waits for room in the queue before it's refused
+STORE_SCP_QUEUE_TIMEOUT = 30
+# Seconds between reports of the queue depth and write times
+STORE_SCP_REPORT_INTERVAL = 60
+
+
+# --- Association pool --- #
+# Seconds an unused association is kept open, must be lower than the network timeout of pynetdicom (60 sec.)
+ASSOCIATION_POOL_IDLE_TIMEOUT = 30
+# Max number of associations borrowed from, or kept idle for, a single peer
+ASSOCIATION_POOL_MAX_PER_PEER = 8
+# Seconds to wait for an association to a peer with ASSOCIATION_POOL_MAX_PER_PEER associations in use
+ASSOCIATION_POOL_BORROW_TIMEOUT = 30
+
+
 # --- ris_thread --- #
 # Minimum and maximum number of minutes to sleep ris_thread for
 SLEEP_DELAY_MIN = 10
 SLEEP_DELAY_MAX = 20
+
+# Number of departments polled concurrently by ris_thread, each worker holds its own associations,
+# i.e. two to PACS, so at most ASSOCIATION_POOL_MAX_PER_PEER // 2 workers are used
+RIS_FETCHER_WORKERS = 4
+
+# Number of days before the last successful poll ris_thread queries RIS for, catches studies booked late
+RIS_LOOKBACK_DAYS = 2
+
+# --- janitor --- #
+# Number of days a study stays in the study list before it's moved to the deleted studies
+ACTIVE_STUDY_DAYS = 7
+# Number of days a deleted study is kept before it's permanently deleted
+DELETED_STUDY_DAYS = 21
+# Max number of studies moved or deleted per directory in a single janitor run, the rest waits for the next run
+JANITOR_BATCH_SIZE = 100
+# Seconds a study may be claimed for approval before the janitor returns it to the control list
+APPROVAL_CLAIM_TIMEOUT = 10 * 60
+
+# --- search --- #
+# Number of days, counting today, which are never marked as covered by the archive, since studies are still being stored to PACS for them
+SEARCH_COVERAGE_SETTLE_DAYS = 1
+# Seconds the responses of a PACS search are reused for identical searches
+SEARCH_RESULT_CACHE_TTL = 60
+# Max number of searches whose responses are cached
+SEARCH_RESULT_CACHE_MAX_ENTRIES = 256
+# Max number of results of a streamed search, the PACS query is cancelled once it's reached
+SEARCH_STREAM_MAX_RESULTS = 500
+
+# --- PACS outbox --- #
+# Number of PACS peers sent to concurrently by the PACS sender service
+PACS_OUTBOX_WORKERS = 4
+# Max number of studies sent over a single association in one batch
+PACS_OUTBOX_BATCH_SIZE = 50
+# Seconds the PACS sender service sleeps, when no studies are due
+PACS_OUTBOX_POLL_INTERVAL = 5
+# Seconds before the first retry of a failed study, doubled on each further failure
+PACS_OUTBOX_BACKOFF_BASE = 30
+# Max seconds between retries of a failed study
+PACS_OUTBOX_BACKOFF_MAX = 60 * 30
+# Number of days sent studies are kept in the outbox, for the status api
+PACS_OUTBOX_SENT_DAYS = 7
+# Seconds the PACS sender service leaves studies alone, while the approving request sends them itself
+PACS_OUTBOX_CLAIM_TIME = 60 * 5
+# Transfer syntaxes proposed when sending studies to PACS, by preference. Compressed
+# syntaxes without an available encoder are left out, see pacs_outbox.get_store_syntaxes
+PACS_STORE_TRANSFER_SYNTAXES = [
+  '1.2.840.10008.1.2.4.80', # JPEG-LS Lossless, needs an encoder plugin for pydicom
+  '1.2.840.10008.1.2.5',    # RLE Lossless
+  '1.2.840.10008.1.2.1.99', # Deflated Explicit VR Little Endian
+  '1.2.840.10008.1.2.1',    # Explicit VR Little Endian
+]
@@ -0,0 +1,369 @@
+#Python packages
+import datetime
+import shutil
+
+from pathlib import Path
+from typing import List, Optional, Tuple
+from django.db.models import QuerySet
+from django.utils import timezone
+
+#Custom modules
+from . import dicomlib
+from . import server_config
+from . import enums
+
+from main_page import log_util
+from main_page import models
+
+logger = log_util.get_logger(__name__)
+"""
+  This file is responsible for the studies being worked on, from they are
+  registered until they are approved and sent to PACS.
+
+  A study is stored in a directory which doesn't change during its life time:
+
+    FIND_RESPONS_DIR/{hospital}/{Accession_number_1}/{Accession_number_1}.dcm
+    Historic studies to {Accession_number_1} are stored as:
+    FIND_RESPONS_DIR/{hospital}/{Accession_number_1}/{Accession_number_2}.dcm
+
+  Every study has a models.Study row with its workflow state, see
+  enums.StudyState, such that changing the state is a single update, and the
+  study lists and expiry are queries on the index. Once approved a study
+  leaves the store for the search cache, see archive.
+
+  Studies from before the index are imported with rebuild_index, which also
+  moves studies out of the old CONTROL_STUDIES_DIR and DELETED_STUDIES_DIR.
+"""
+
+
+def get_study_dir(hospital_shortname: str, accession_number: str) -> Path:
+  return Path(server_config.FIND_RESPONS_DIR, hospital_shortname, accession_number)
+
+
+def parse_date(date_str: Optional[str]) -> Optional[datetime.date]:
+  try:
+    return datetime.datetime.strptime(date_str, "%Y%m%d").date()
+  except (TypeError, ValueError):
+    return None
+
+
+def studies(
+  hospital_shortname: str,
+  state: Optional[enums.StudyState]=None,
+  accession_number: Optional[str]=None
+  ) -> QuerySet:
+  """
+  Args:
+    hospital_shortname: abbreviation for hospital name
+
+  Kwargs:
+    state: only include studies in this state
+    accession_number: only include the study with this accession number
+
+  Returns:
+    Query set of the matching models.Study rows
+  """
+  query = models.Study.objects.filter(hospital__short_name=hospital_shortname)
+  if state is not None:
+    query = query.filter(state=state.value)
+  if accession_number is not None:
+    query = query.filter(accession_number=accession_number)
+
+  return query
+
+
+def register(
+  hospital_shortname: str,
+  accession_number: str,
+  state: enums.StudyState=enums.StudyState.REGISTERED
+  ) -> models.Study:
+  """
+  Adds a study to the index, or resets it if it's already indexed
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    accession_number: accession number of the study, the dicom file must
+                      have been saved to get_study_dir first
+
+  Kwargs:
+    state: state of the study
+
+  Returns:
+    The row of the study
+
+  Raises:
+    FileNotFoundError: if the study has no dicom file
+    models.Hospital.DoesNotExist: if the hospital is unknown
+  """
+  study_dir = get_study_dir(hospital_shortname, accession_number)
+  summary = dicomlib.read_study_summary(study_dir, accession_number)
+  study_date = parse_date(summary.StudyDate)
+  # Studies without a study date are kept from the day they are registered
+  retention_date = parse_date(summary.RecoveredDate) or study_date or datetime.date.today()
+
+  study, _ = models.Study.objects.update_or_create(
+    hospital=models.Hospital.objects.get(short_name=hospital_shortname),
+    accession_number=accession_number,
+    defaults={
+      'state'          : state.value,
+      'study_date'     : study_date,
+      'retention_date' : retention_date,
+      'patient_id'     : summary.PatientID,
+      'path'           : str(study_dir),
+      'state_changed'  : timezone.now(),
+    }
+  )
+
+  return study
+
+
+def transition(
+  hospital_shortname: str,
+  accession_number: str,
+  from_state: enums.StudyState,
+  to_state: enums.StudyState,
+  **fields
+  ) -> bool:
+  """
+  Changes the state of a study
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    accession_number: accession number of the study
+    from_state: the state the study must be in
+    to_state: the new state of the study
+
+  Kwargs:
+    other fields of models.Study to update, e.g. retention_date
+
+  Returns:
+    True if the study was changed, False if it isn't in from_state
+
+  Remark:
+    The state is checked and changed in a single update, so two requests
+    can't both move the same study.
+  """
+  updated = studies(hospital_shortname, from_state, accession_number).update(
+    state=to_state.value,
+    state_changed=timezone.now(),
+    **fields
+  )
+
+  if updated:
+    logger.info(f"Moved study {accession_number} from {from_state.name} to {to_state.name}")
+  else:
+    logger.error(f"Unable to find study {accession_number} in {from_state.name}")
+
+  return bool(updated)
+
+
+def recover(hospital_shortname: str, accession_number: str) -> bool:
+  """
+  Moves a study out of the trashcan
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    accession_number: accession number of the study
+
+  Returns:
+    True if the study was recovered, False if it isn't deleted
+
+  Remark:
+    The days a study is kept are counted from the recovery date, such that
+    recovered studies aren't instantly deleted again if their study date has
+    already passed the threshold.
+  """
+  today = datetime.date.today()
+  if not transition(hospital_shortname, accession_number, enums.StudyState.DELETED, enums.StudyState.REGISTERED, retention_date=today):
+    return False
+
+  study_dir = get_study_dir(hospital_shortname, accession_number)
+  recovered_date = today.strftime('%Y%m%d')
+  with open(Path(study_dir, server_config.RECOVERED_FILENAME), 'w') as fp:
+    fp.write(recovered_date)
+
+  try:
+    dicomlib.update_study_summary(study_dir, accession_number, RecoveredDate=recovered_date)
+  except FileNotFoundError:
+    logger.error(f"Recovered study {accession_number} has no dicom file")
+
+  return True
+
+
+def remove(hospital_shortname: str, accession_number: str, state: Optional[enums.StudyState]=None) -> bool:
+  """
+  Permanently deletes a study from the server's system
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    accession_number: accession number of the study
+
+  Kwargs:
+    state: only delete the study if it's in this state
+
+  Returns:
+    True if the study was deleted, False if it isn't in the index
+  """
+  study = studies(hospital_shortname, state, accession_number).first()
+  if study is None:
+    return False
+
+  shutil.rmtree(study.path, ignore_errors=True)
+  study.delete()
+
+  return True
+
+
+def archive(hospital_shortname: str, accession_number: str) -> Path:
+  """
+  Moves an approved study out of the store and into the search cache
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    accession_number: accession number of the study
+
+  Returns:
+    Directory of the study in the search cache
+
+  Remark:
+    The study must be indexed in the search cache afterwards, see cache.index_study
+  """
+  study_dir = get_study_dir(hospital_shortname, accession_number)
+  cache_dir = Path(server_config.SEARCH_CACHE_DIR, accession_number)
+
+  shutil.move(str(study_dir), str(cache_dir))
+  studies(hospital_shortname, accession_number=accession_number).delete()
+
+  return cache_dir
+
+
+def release_approvals(hospital_shortname: Optional[str], seconds: int) -> int:
+  """
+  Moves studies claimed for approval more than seconds ago back to the
+  control list, i.e. studies whose approval never finished
+
+  Args:
+    hospital_shortname: abbreviation for hospital name, None for all hospitals
+    seconds: seconds a study may be claimed for approval
+
+  Returns:
+    The number of released studies
+  """
+  if hospital_shortname is None:
+    query = models.Study.objects.filter(state=enums.StudyState.APPROVING.value)
+  else:
+    query = studies(hospital_shortname, enums.StudyState.APPROVING)
+
+  cutoff = timezone.now() - datetime.timedelta(seconds=seconds)
+  return query.filter(state_changed__lt=cutoff).update(
+    state=enums.StudyState.CONTROL.value,
+    state_changed=timezone.now()
+  )
+
+
+def expired(hospital_shortname: Optional[str], state: enums.StudyState, days: int) -> QuerySet:
+  """
+  Args:
+    hospital_shortname: abbreviation for hospital name, None for all hospitals
+    state: state of the studies
+    days: number of days a study is allowed to stay in the state
+
+  Returns:
+    Query set of the studies whose retention date is more than days ago, oldest first
+  """
+  if hospital_shortname is None:
+    query = models.Study.objects.filter(state=state.value)
+  else:
+    query = studies(hospital_shortname, state)
+
+  cutoff = datetime.date.today() - datetime.timedelta(days=days)
+  return query.filter(retention_date__lt=cutoff).order_by('retention_date')
+
+
+def list_studies(hospital_shortname: str, state: enums.StudyState) -> List[dicomlib.StudySummary]:
+  """
+  Gets the studies to display in a study list
+
+  Args:
+    hospital_shortname: abbreviation for hospital name
+    state: state of the studies to list
+
+  Returns:
+    Summaries of the studies in the state, by descending study date
+
+  Remark:
+    Studies whose files have gone missing are removed from the index
+  """
+  summaries = [ ]
+  missing = [ ]
+
+  query = studies(hospital_shortname, state).order_by('-study_date')
+  for study_id, accession_number, path in query.values_list('id', 'accession_number', 'path'):
+    try:
+      summaries.append(dicomlib.read_study_summary(path, accession_number))
+    except FileNotFoundError:
+      logger.info(f"Removing study from index, due to missing dicom file in: \"{path}\"")
+      shutil.rmtree(path, ignore_errors=True)
+      missing.append(study_id)
+
+  if missing:
+    models.Study.objects.filter(id__in=missing).delete()
+
+  return summaries
+
+
+def rebuild_index() -> Tuple[int, int]:
+  """
+  Indexes the studies which are missing from the index, and removes rows of
+  studies which no longer exist
+
+  Studies in the old CONTROL_STUDIES_DIR and DELETED_STUDIES_DIR are moved
+  into the store and indexed in the matching state.
+
+  Returns:
+    The number of indexed studies and removed rows
+  """
+  indexed = 0
+  old_dirs = (
+    (enums.StudyState.REGISTERED, server_config.FIND_RESPONS_DIR),
+    (enums.StudyState.CONTROL, server_config.CONTROL_STUDIES_DIR),
+    (enums.StudyState.DELETED, server_config.DELETED_STUDIES_DIR),
+  )
+
+  for hospital in models.Hospital.objects.exclude(short_name=None):
+    for state, directory in old_dirs:
+      hospital_dir = Path(directory, hospital.short_name)
+      if not hospital_dir.is_dir():
+        continue
+
+      for old_study_dir in hospital_dir.iterdir():
+        if not old_study_dir.is_dir():
+          continue
+
+        accession_number = old_study_dir.name
+        if studies(hospital.short_name, accession_number=accession_number).exists():
+          continue
+
+        study_dir = get_study_dir(hospital.short_name, accession_number)
+        if old_study_dir != study_dir:
+          if study_dir.exists():
+            logger.error(f"Unable to move {old_study_dir} into the store, {study_dir} already exists")
+            continue
+          study_dir.parent.mkdir(parents=True, exist_ok=True)
+          shutil.move(str(old_study_dir), str(study_dir))
+
+        try:
+          register(hospital.short_name, accession_number, state)
+          indexed += 1
+        except FileNotFoundError:
+          logger.error(f"Unable to index {study_dir}, it has no dicom file")
+
+  removed = 0
+  for study_id, path in models.Study.objects.values_list('id', 'path'):
+    if not Path(path).exists():
+      models.Study.objects.filter(id=study_id).delete()
+      removed += 1
+
+  logger.info(f"Indexed {indexed} studies, removed {removed} rows of missing studies")
+
+  return indexed, removed
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main_page.libs import archive
+from main_page import models
+
+
+class Command(BaseCommand):
+  help = 'Archives the examinations in the search cache, and optionally in PACS, which are not archived yet'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--pacs',
+      action='store_true',
+      help='Also archive the examinations in PACS, requires --date-from and --date-to'
+    )
+    parser.add_argument(
+      '--config',
+      type=int,
+      default=1,
+      help='Id of the configuration whose PACS is crawled'
+    )
+    parser.add_argument('--date-from', help='First study date to crawl, on the form YYYYMMDD')
+    parser.add_argument('--date-to', help='Last study date to crawl, on the form YYYYMMDD')
+
+  def handle(self, *args, **options):
+    archived, failed = archive.backfill_from_cache()
+    self.stdout.write(f'Archived {archived} examinations from the search cache, {failed} failed')
+
+    if not options['pacs']:
+      return
+
+    if not options['date_from'] or not options['date_to']:
+      raise CommandError('--pacs requires --date-from and --date-to')
+
+    try:
+      config = models.Config.objects.get(id=options['config'])
+      archived, failed = archive.backfill_from_pacs(config, options['date_from'], options['date_to'])
+    except (models.Config.DoesNotExist, ValueError) as e:
+      raise CommandError(str(e))
+
+    self.stdout.write(f'Archived {archived} examinations from PACS, {failed} failed')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from main_page.libs import history_store
+
+
+class Command(BaseCommand):
+  help = 'Replaces historic studies copied into study directories by links into the history store'
+
+  def handle(self, *args, **options):
+    replaced, failed = history_store.deduplicate()
+    removed = history_store.collect_garbage()
+    self.stdout.write(f'Replaced {replaced} historic studies, {failed} failed, removed {removed} unused stored studies')
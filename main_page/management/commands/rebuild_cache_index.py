@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main_page.libs import cache
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the search cache index from the studies in SEARCH_CACHE_DIR'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--all',
+      action='store_true',
+      help='Reindex every study, not only the studies missing from the index'
+    )
+
+  def handle(self, *args, **options):
+    indexed, removed = cache.rebuild_index(reindex_all=options['all'])
+    self.stdout.write(f'Indexed {indexed} studies, removed {removed} stale index entries')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main_page.libs import study_store
+
+
+class Command(BaseCommand):
+  help = 'Indexes the studies missing from the study index, moving studies out of CONTROL_STUDIES_DIR and DELETED_STUDIES_DIR'
+
+  def handle(self, *args, **options):
+    indexed, removed = study_store.rebuild_index()
+    self.stdout.write(f'Indexed {indexed} studies, removed {removed} rows of missing studies')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from main_page.libs import janitor
+
+
+class Command(BaseCommand):
+  help = 'Moves old studies to the deleted studies and permanently deletes old deleted studies'
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--hospital',
+      help='Short name of the hospital to clean up. Defaults to all hospitals'
+    )
+    parser.add_argument(
+      '--batch-size',
+      type=int,
+      help='Max number of studies moved, respectively deleted'
+    )
+
+  def handle(self, *args, **options):
+    report = janitor.run(
+      hospital_shortname=options['hospital'],
+      batch_size=options['batch_size']
+    )
+    self.stdout.write(f'Janitor {report}')
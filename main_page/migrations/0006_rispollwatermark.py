@@ -0,0 +1,19 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0005_address_serverconfiguration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RisPollWatermark',
+            fields=[
+                ('department', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='main_page.Department')),
+                ('last_poll', models.DateField()),
+            ],
+        ),
+    ]
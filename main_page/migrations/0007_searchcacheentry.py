@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0006_rispollwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchCacheEntry',
+            fields=[
+                ('accession_number', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('study_date', models.DateField(db_index=True, null=True)),
+                ('inserted', models.DateTimeField(default=django.utils.timezone.now)),
+                ('size', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0007_searchcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchcacheentry',
+            name='last_accessed',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.CreateModel(
+            name='SearchCacheStatistics',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('hits', models.BigIntegerField(default=0)),
+                ('misses', models.BigIntegerField(default=0)),
+                ('evictions', models.BigIntegerField(default=0)),
+                ('expirations', models.BigIntegerField(default=0)),
+                ('since', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0008_searchcache_lru'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Study',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('accession_number', models.CharField(max_length=20)),
+                ('state', models.IntegerField(choices=[(0, 'REGISTERED'), (1, 'CONTROL'), (2, 'DELETED')])),
+                ('study_date', models.DateField(null=True)),
+                ('retention_date', models.DateField(null=True)),
+                ('patient_id', models.CharField(db_index=True, default='', max_length=20)),
+                ('path', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('state_changed', models.DateTimeField(default=django.utils.timezone.now)),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main_page.Hospital')),
+            ],
+            options={
+                'unique_together': {('hospital', 'accession_number')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='study',
+            index=models.Index(fields=['hospital', 'state', 'study_date'], name='study_hospital_state_date'),
+        ),
+        migrations.AddIndex(
+            model_name='study',
+            index=models.Index(fields=['state', 'retention_date'], name='study_state_retention'),
+        ),
+    ]
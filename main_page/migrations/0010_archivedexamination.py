@@ -0,0 +1,38 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0009_study'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedExamination',
+            fields=[
+                ('accession_number', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('patient_id', models.CharField(db_index=True, max_length=20)),
+                ('patient_name', models.CharField(default='', max_length=200)),
+                ('patient_sex', models.CharField(default='', max_length=1)),
+                ('patient_birth_date', models.DateField(null=True)),
+                ('patient_height', models.FloatField(null=True)),
+                ('patient_weight', models.FloatField(null=True)),
+                ('study_date', models.DateField(db_index=True, null=True)),
+                ('method', models.CharField(default='', max_length=200)),
+                ('clearance', models.FloatField(null=True)),
+                ('normalized_clearance', models.FloatField(null=True)),
+                ('bsa', models.FloatField(null=True)),
+                ('bsa_method', models.CharField(default='', max_length=200)),
+                ('thinning_factor', models.FloatField(null=True)),
+                ('standard_count', models.FloatField(null=True)),
+                ('injection_weight', models.FloatField(null=True)),
+                ('sample_count', models.IntegerField(default=0)),
+                ('sop_instance_uid', models.CharField(default='', max_length=64)),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+                ('hospital', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='main_page.Hospital')),
+            ],
+        ),
+    ]
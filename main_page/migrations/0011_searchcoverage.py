@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0010_archivedexamination'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchCoverage',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('date_from', models.DateField()),
+                ('date_to', models.DateField()),
+                ('synced', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0011_searchcoverage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PacsOutboxItem',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('accession_number', models.CharField(max_length=20)),
+                ('patient_id', models.CharField(default='', max_length=20)),
+                ('path', models.CharField(max_length=255)),
+                ('calling_aet', models.CharField(max_length=16)),
+                ('ip', models.CharField(max_length=20)),
+                ('port', models.IntegerField()),
+                ('ae_title', models.CharField(max_length=16)),
+                ('state', models.IntegerField(choices=[(0, 'PENDING'), (1, 'SENT')])),
+                ('queued', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.CharField(default='', max_length=255)),
+                ('sent', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pacsoutboxitem',
+            index=models.Index(fields=['state', 'next_attempt'], name='outbox_state_next_attempt'),
+        ),
+        migrations.AddIndex(
+            model_name='pacsoutboxitem',
+            index=models.Index(fields=['accession_number', 'state'], name='outbox_accession_state'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0012_pacsoutboxitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlotJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('accession_number', models.CharField(max_length=20)),
+                ('path', models.CharField(max_length=255)),
+                ('state', models.IntegerField(choices=[(0, 'PENDING'), (1, 'DONE'), (2, 'FAILED')])),
+                ('requested', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(null=True)),
+                ('error', models.CharField(default='', max_length=255)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='plotjob',
+            index=models.Index(fields=['state', 'requested'], name='plotjob_state_requested'),
+        ),
+        migrations.AddIndex(
+            model_name='plotjob',
+            index=models.Index(fields=['accession_number', 'state'], name='plotjob_accession_state'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0013_plotjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='study',
+            name='state',
+            field=models.IntegerField(choices=[(0, 'REGISTERED'), (1, 'CONTROL'), (2, 'DELETED'), (3, 'APPROVING')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_page', '0014_study_approving'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryCacheEntry',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=32)),
+                ('key', models.CharField(max_length=64)),
+                ('patient_id', models.CharField(db_index=True, default='', max_length=20)),
+                ('result', models.TextField()),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('name', 'key')},
+            },
+        ),
+    ]
@@ -4,6 +4,7 @@ from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 
+from .libs import enums
 from .libs import server_config
 
 
@@ -109,6 +110,160 @@ class HandledExaminations(models.Model):
   accession_number = models.CharField(primary_key=True, max_length=20)
   handle_day       = models.DateField(default=timezone.now)
 
+# Last day the RIS worklist was successfully polled for a department,
+# used by ris_thread to only query the date window which can contain new studies
+class RisPollWatermark(models.Model):
+  department = models.OneToOneField(Department, on_delete=models.CASCADE, primary_key=True)
+  last_poll  = models.DateField()
+
+  def __str__(self):
+    return f"{self.department} - {self.last_poll}"
+
+# Index of the studies being worked on, the workflow state of a study is
+# kept here while its files stay in the same directory. See libs/study_store.py
+class Study(models.Model):
+  id               = models.AutoField(primary_key=True)
+  hospital         = models.ForeignKey(Hospital, on_delete=models.CASCADE)
+  accession_number = models.CharField(max_length=20)
+  state            = models.IntegerField(choices=[(state.value, state.name) for state in enums.StudyState])
+  study_date       = models.DateField(null=True)
+  retention_date   = models.DateField(null=True) # The study date, or the date the study was recovered
+  patient_id       = models.CharField(max_length=20, default='', db_index=True)
+  path             = models.CharField(max_length=255) # Directory of the study and its history
+  created          = models.DateTimeField(default=timezone.now)
+  state_changed    = models.DateTimeField(default=timezone.now)
+
+  class Meta:
+    unique_together = ('hospital', 'accession_number')
+    indexes = [
+      models.Index(fields=['hospital', 'state', 'study_date'], name='study_hospital_state_date'),
+      models.Index(fields=['state', 'retention_date'], name='study_state_retention'),
+    ]
+
+  def __str__(self):
+    return f"{self.accession_number} - {enums.StudyState(self.state).name}"
+
+# Index of the studies in the search cache, such that the cache can be
+# cleaned and searched without reading the dicom files. See libs/cache.py
+class SearchCacheEntry(models.Model):
+  accession_number = models.CharField(primary_key=True, max_length=20)
+  study_date       = models.DateField(null=True, db_index=True)
+  inserted         = models.DateTimeField(default=timezone.now)
+  last_accessed    = models.DateTimeField(default=timezone.now, db_index=True)
+  size             = models.BigIntegerField(default=0) # Bytes used by the study directory
+
+  def __str__(self):
+    return self.accession_number
+
+# Counters for sizing the search cache, only the row with id=1 is used
+class SearchCacheStatistics(models.Model):
+  id          = models.AutoField(primary_key=True)
+  hits        = models.BigIntegerField(default=0)
+  misses      = models.BigIntegerField(default=0)
+  evictions   = models.BigIntegerField(default=0) # Studies removed to stay within the byte budget
+  expirations = models.BigIntegerField(default=0) # Studies removed by the GDPR life time
+  since       = models.DateTimeField(default=timezone.now)
+
+# Completed examinations, kept after they have been sent to PACS such that
+# they can be searched without querying PACS. See libs/archive.py
+class ArchivedExamination(models.Model):
+  accession_number     = models.CharField(primary_key=True, max_length=20)
+  patient_id           = models.CharField(max_length=20, db_index=True) # CPR number
+  patient_name         = models.CharField(max_length=200, default='')
+  patient_sex          = models.CharField(max_length=1, default='')
+  patient_birth_date   = models.DateField(null=True)
+  patient_height       = models.FloatField(null=True) # Meters
+  patient_weight       = models.FloatField(null=True) # Kilograms
+  study_date           = models.DateField(null=True, db_index=True)
+  hospital             = models.ForeignKey(Hospital, null=True, on_delete=models.SET_NULL)
+  method               = models.CharField(max_length=200, default='')
+  clearance            = models.FloatField(null=True)
+  normalized_clearance = models.FloatField(null=True)
+  bsa                  = models.FloatField(null=True) # Body surface area, m^2
+  bsa_method           = models.CharField(max_length=200, default='')
+  thinning_factor      = models.FloatField(null=True)
+  standard_count       = models.FloatField(null=True)
+  injection_weight     = models.FloatField(null=True)
+  sample_count         = models.IntegerField(default=0)
+  sop_instance_uid     = models.CharField(max_length=64, default='')
+  archived             = models.DateTimeField(default=timezone.now)
+
+  def __str__(self):
+    return self.accession_number
+
+# Study date ranges whose examinations in PACS are all in the archive, such
+# that searches within them are answered without querying PACS. See libs/search.py
+class SearchCoverage(models.Model):
+  id        = models.AutoField(primary_key=True)
+  date_from = models.DateField()
+  date_to   = models.DateField() # Inclusive
+  synced    = models.DateTimeField(default=timezone.now)
+
+  def __str__(self):
+    return f"{self.date_from} - {self.date_to}"
+
+# Studies approved for PACS, sent by the PACS sender service. The dicom file
+# stays in PACS_QUEUE_DIR until the study is sent. See libs/pacs_outbox.py
+class PacsOutboxItem(models.Model):
+  id               = models.AutoField(primary_key=True)
+  accession_number = models.CharField(max_length=20)
+  patient_id       = models.CharField(max_length=20, default='')
+  path             = models.CharField(max_length=255) # Dicom file to send
+  calling_aet      = models.CharField(max_length=16)
+  ip               = models.CharField(max_length=20)
+  port             = models.IntegerField()
+  ae_title         = models.CharField(max_length=16) # AET of PACS
+  state            = models.IntegerField(choices=[(state.value, state.name) for state in enums.OutboxState])
+  queued           = models.DateTimeField(default=timezone.now) # Changed whenever the file is replaced
+  attempts         = models.IntegerField(default=0)
+  next_attempt     = models.DateTimeField(default=timezone.now)
+  last_error       = models.CharField(max_length=255, default='')
+  sent             = models.DateTimeField(null=True)
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['state', 'next_attempt'], name='outbox_state_next_attempt'),
+      models.Index(fields=['accession_number', 'state'], name='outbox_accession_state'),
+    ]
+
+  def __str__(self):
+    return f"{self.accession_number} - {enums.OutboxState(self.state).name}"
+
+# The plot of a study to be rendered by the plot renderer service, see libs/plot_jobs.py
+class PlotJob(models.Model):
+  id               = models.AutoField(primary_key=True)
+  accession_number = models.CharField(max_length=20)
+  path             = models.CharField(max_length=255) # Dicom file of the study
+  state            = models.IntegerField(choices=[(state.value, state.name) for state in enums.PlotJobState])
+  requested        = models.DateTimeField(default=timezone.now) # Changed whenever the study is calculated again
+  finished         = models.DateTimeField(null=True)
+  error            = models.CharField(max_length=255, default='')
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['state', 'requested'], name='plotjob_state_requested'),
+      models.Index(fields=['accession_number', 'state'], name='plotjob_accession_state'),
+    ]
+
+  def __str__(self):
+    return f"{self.accession_number} - {enums.PlotJobState(self.state).name}"
+
+# Result of a recent query, shared by the web server processes and the PACS
+# sender, which invalidates it when a study is stored. See libs/query_cache.py
+class QueryCacheEntry(models.Model):
+  id         = models.AutoField(primary_key=True)
+  name       = models.CharField(max_length=32) # The cache the entry belongs to
+  key        = models.CharField(max_length=64) # sha256 of the query key
+  patient_id = models.CharField(max_length=20, default='', db_index=True) # Empty if the query isn't on a single patient
+  result     = models.TextField() # json
+  expires    = models.DateTimeField(db_index=True)
+
+  class Meta:
+    unique_together = ('name', 'key')
+
+  def __str__(self):
+    return f"{self.name} - {self.key}"
+
 # So Stuff breaks if there's no ServerConfiguration with an id=1 !IMPORTANT !NOTICE
 # All server configs with an id differtn from 1 is ignored.
 # This is something YOU have to check and ensure
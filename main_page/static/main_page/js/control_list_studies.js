@@ -0,0 +1,83 @@
+// Returns the accession numbers of the selected studies
+let get_selected_studies = function() {
+  return $('.select-study:checked').map(function() {
+    return $(this).val();
+  }).get();
+}
+
+// Only allow approving when studies are selected and a Bam ID is entered
+let update_approve_button = function() {
+  let has_bamid = $('#bulk-bamid').val().trim().length > 0;
+  let has_selection = get_selected_studies().length > 0;
+
+  $('#bulk-approve-btn').prop('disabled', !(has_bamid && has_selection));
+}
+
+// Displays the result of each approved study
+let show_approval_results = function(results) {
+  let container = $('#bulk-approve-results');
+  container.empty();
+
+  for (var i = 0; i < results.length; i++) {
+    let result = results[i];
+    var alert_div = document.createElement('div');
+    alert_div.classList.add('alert');
+
+    if (result.sent) {
+      alert_div.classList.add('alert-success');
+      alert_div.textContent = result.accession_number + ": Sendt til PACS";
+      $('#' + result.accession_number).remove();
+    } else if (result.queued) {
+      alert_div.classList.add('alert-warning');
+      alert_div.textContent = result.accession_number + ": Godkendt, sendes til PACS senere (" + result.error + ")";
+      $('#' + result.accession_number).remove();
+    } else {
+      alert_div.classList.add('alert-danger');
+      alert_div.textContent = result.accession_number + ": Ikke godkendt (" + result.error + ")";
+    }
+
+    container.append(alert_div);
+  }
+}
+
+// Approves the selected studies and sends them to PACS
+let approve_selected_studies = function() {
+  let accession_numbers = get_selected_studies();
+
+  $('#bulk-approve-btn').prop('disabled', true);
+  $('#bulk-approve-loader').show();
+
+  $.post({
+    url: '/api/control/approve',
+    data: {
+      'accession_numbers': accession_numbers,
+      'bamID': $('#bulk-bamid').val()
+    },
+    traditional: true, // Send the accession numbers as repeated parameters
+    success: function(data) {
+      show_approval_results(data.results);
+    },
+    error: function() {
+      console.warn("Failed to approve studies...");
+      show_approval_results(accession_numbers.map(function(accession_number) {
+        return {'accession_number': accession_number, 'queued': false, 'sent': false, 'error': "Serverfejl"};
+      }));
+    },
+    complete: function() {
+      $('#bulk-approve-loader').hide();
+      $('#select-all-studies').prop('checked', false);
+      update_approve_button();
+    }
+  });
+}
+
+$(function() {
+  $('#select-all-studies').on('change', function() {
+    $('.select-study').prop('checked', $(this).prop('checked'));
+    update_approve_button();
+  });
+
+  $('.select-study').on('change', update_approve_button);
+  $('#bulk-bamid').on('input', update_approve_button);
+  $('#bulk-approve-btn').on('click', approve_selected_studies);
+});
@@ -0,0 +1,23 @@
+// Milliseconds between polls of the plot job
+const PLOT_JOB_POLL_INTERVAL = 1000;
+
+// Polls the rendering of the plot, and reloads the page once it's rendered
+let poll_plot_job = function(job_url) {
+  $.get(job_url).done(function(data) {
+    if (data.state == 'PENDING') {
+      setTimeout(function() { poll_plot_job(job_url); }, PLOT_JOB_POLL_INTERVAL);
+    } else {
+      // The page shows the plot, or why it couldn't be rendered
+      window.location.reload();
+    }
+  }).fail(function() {
+    setTimeout(function() { poll_plot_job(job_url); }, PLOT_JOB_POLL_INTERVAL);
+  });
+}
+
+$(document).ready(function() {
+  let job_url = $('#plot-job').data('url');
+  if (job_url) {
+    poll_plot_job(job_url);
+  }
+});
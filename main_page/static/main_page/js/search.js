@@ -66,130 +66,173 @@ let ajax_search = function() {
   disable_search_fields();
   show_loading();
 
-  $.get({
-    url: 'api/search',
-    data: {
-      'name': name,
-      'cpr': cpr,
-      'accession_number': accession_number,
-      'date_from': date_from,
-      'date_to': date_to
-    },
-    success: function(data) {
-      console.debug("Successful search");
-
-      // Insert search results into table
-      search_results = data.search_results;
-
-      for (var i = 0; i < search_results.length; i++) {
-        // Create elements for table entry
-        var trow = document.createElement('tr');
-        trow.setAttribute('id', search_results[i].accession_number);
-
-        var td_name = document.createElement('td');
-        td_name.innerHTML = search_results[i].name;
-        td_name.classList.add("redirect-present");
-
-        var td_cpr = document.createElement('td');
-        td_cpr.innerHTML = search_results[i].cpr;
-        td_cpr.classList.add("redirect-present");
-
-        var td_date = document.createElement('td');
-        td_date.innerHTML = search_results[i].date;
-        td_date.classList.add("redirect-present");
-
-        var td_accession_number = document.createElement('td');
-        td_accession_number.innerHTML = search_results[i].accession_number;
-        td_accession_number.classList.add("redirect-present");
-
-        var td_create_new  = document.createElement('td');
-        var loader_spinner = document.createElement('div');
-        loader_spinner.classList.add('loader');
-        loader_spinner.id = search_results[i].accession_number + "_loader"
-        loader_spinner.style.display ='none'
-        td_create_new.appendChild(loader_spinner);
-        /* - Remove per meeting may 18
-
-        var create_new_btn = document.createElement("button");
-        create_new_btn.type = "button";
-        create_new_btn.classList.add("new-hist-btn");
-        create_new_btn.classList.add("btn");
-        create_new_btn.classList.add("btn-link");
-        var create_new_span = document.createElement("spam");
-        create_new_span.classList.add("oi");
-        create_new_span.classList.add("oi-document"); // Choose which icon to use for the button
-        create_new_span.setAttribute("aria-hidden", "true");
-        create_new_span.setAttribute("title", "Ny undersøgelse fra historisk");
-        
-        create_new_btn.appendChild(create_new_span);
-        */
-
-
-        // Insert table entry into the table
-        trow.appendChild(td_name);
-        trow.appendChild(td_cpr);
-        trow.appendChild(td_date);
-        trow.appendChild(td_accession_number);
-        trow.appendChild(td_create_new);
-        $('#search-table-body').append(trow);
-
-        // Make rows redirect to present_old_study page on click
-        // $('#' + search_results[i].accession_number).on('click', function() {
-        //   document.location = '/present_old_study/' + $(this).attr('id');
-        // });
-        $(".redirect-present").on('click', function() {
-          let accession_number = $(this).parent().attr('id');
-          var loaderID = accession_number + "_loader"
-          $("#"+loaderID).show()
-          document.location = '/present_old_study/' + accession_number;
-        });
-      }
+  send_search({
+    'name': name,
+    'cpr': cpr,
+    'accession_number': accession_number,
+    'date_from': date_from,
+    'date_to': date_to
+  });
+}
 
-      // Make create new buttons send POST request to the page
-      $(".new-hist-btn").on("click", function() {
-        // Get accession number of clicked historical study
-        let hist_accession_number = $(this).parent().parent().children()[3].innerHTML;
-
-        $.post({
-          url: "/search",
-          data: {
-            "hist_accession_number": hist_accession_number
-          },
-          success: function(data) {
-            // Redirect to the new study copy
-            console.debug("Should redirect to: " + data.redirect_url);
-            window.location.href = data.redirect_url;
-          },
-          error: function() {
-            console.debug("Failed to create new study from historical.");
-            $("#newFailedModal").modal("toggle");
-          }
-        });
-      });
+// Inserts search results into the table, skipping studies already in it
+let insert_search_results = function(search_results) {
+  for (var i = 0; i < search_results.length; i++) {
+    if (document.getElementById(search_results[i].accession_number)) {
+      continue;
+    }
+
+    // Create elements for table entry
+    var trow = document.createElement('tr');
+    trow.setAttribute('id', search_results[i].accession_number);
+
+    var td_name = document.createElement('td');
+    td_name.innerHTML = search_results[i].name;
+    td_name.classList.add("redirect-present");
+
+    var td_cpr = document.createElement('td');
+    td_cpr.innerHTML = search_results[i].cpr;
+    td_cpr.classList.add("redirect-present");
+
+    var td_date = document.createElement('td');
+    td_date.innerHTML = search_results[i].date;
+    td_date.classList.add("redirect-present");
+
+    var td_accession_number = document.createElement('td');
+    td_accession_number.innerHTML = search_results[i].accession_number;
+    td_accession_number.classList.add("redirect-present");
+
+    var td_create_new  = document.createElement('td');
+    var loader_spinner = document.createElement('div');
+    loader_spinner.classList.add('loader');
+    loader_spinner.id = search_results[i].accession_number + "_loader"
+    loader_spinner.style.display ='none'
+    td_create_new.appendChild(loader_spinner);
+    /* - Remove per meeting may 18
+
+    var create_new_btn = document.createElement("button");
+    create_new_btn.type = "button";
+    create_new_btn.classList.add("new-hist-btn");
+    create_new_btn.classList.add("btn");
+    create_new_btn.classList.add("btn-link");
+    var create_new_span = document.createElement("spam");
+    create_new_span.classList.add("oi");
+    create_new_span.classList.add("oi-document"); // Choose which icon to use for the button
+    create_new_span.setAttribute("aria-hidden", "true");
+    create_new_span.setAttribute("title", "Ny undersøgelse fra historisk");
+    
+    create_new_btn.appendChild(create_new_span);
+    */
+
+
+    // Insert table entry into the table
+    trow.appendChild(td_name);
+    trow.appendChild(td_cpr);
+    trow.appendChild(td_date);
+    trow.appendChild(td_accession_number);
+    trow.appendChild(td_create_new);
+    $('#search-table-body').append(trow);
+
+    // Make rows redirect to present_old_study page on click
+    // $('#' + search_results[i].accession_number).on('click', function() {
+    //   document.location = '/present_old_study/' + $(this).attr('id');
+    // });
+    $(trow).children(".redirect-present").on('click', function() {
+      let accession_number = $(this).parent().attr('id');
+      var loaderID = accession_number + "_loader"
+      $("#"+loaderID).show()
+      document.location = '/present_old_study/' + accession_number;
+    });
+  }
 
-      hide_loading();
-      enable_search_fields();
-    },
-    error: function(data) {
-      console.debug("Failed search");
-
-      var err_text = "";
-      if (data.statusText == 'timeout') {
-        err_text = "Fejl: Kunne ikke forbinde til PACS (timeout).";
-      } else {
-        err_text = "Fejl: Kunne ikke forbinde til PACS";
+  // Make create new buttons send POST request to the page
+  $(".new-hist-btn").on("click", function() {
+    // Get accession number of clicked historical study
+    let hist_accession_number = $(this).parent().parent().children()[3].innerHTML;
+
+    $.post({
+      url: "/search",
+      data: {
+        "hist_accession_number": hist_accession_number
+      },
+      success: function(data) {
+        // Redirect to the new study copy
+        console.debug("Should redirect to: " + data.redirect_url);
+        window.location.href = data.redirect_url;
+      },
+      error: function() {
+        console.debug("Failed to create new study from historical.");
+        $("#newFailedModal").modal("toggle");
       }
+    });
+  });
+}
+
+// Displays an error message below the search fields
+let show_search_error = function(err_text) {
+  var error_msg = document.createElement('p');
+  error_msg.innerHTML = err_text;
+  error_msg.style.color = 'lightcoral';
+  $('#error-message-container').append(error_msg);
+}
 
-      // Display appropriate error message
-      var error_msg = document.createElement('p');
-      error_msg.innerHTML = err_text;
-      error_msg.style.color = 'lightcoral';
-      $('#error-message-container').append(error_msg);
+// Handles a line of the streamed search response, see api.SearchStreamEndpoint
+let handle_search_line = function(line) {
+  if (line.trim() === "") {
+    return;
+  }
+
+  let message = JSON.parse(line);
+  if (message.search_result) {
+    insert_search_results([message.search_result]);
+  } else if (message.status === 'error') {
+    show_search_error("Fejl: Kunne ikke forbinde til PACS");
+  } else if (message.status === 'limit') {
+    show_search_error("Der er flere resultater end vist, indsnævr søgningen");
+  }
+}
+
+// Sends a GET request with the search parameters, the server streams the
+// results as newline delimited json, and each result is inserted as it arrives
+let send_search = function(search_params) {
+  let url = 'api/search/stream?' + $.param(search_params);
+  let decoder = new TextDecoder();
+  var buffer = "";
+
+  let finish_search = function() {
+    hide_loading();
+    enable_search_fields();
+  }
+
+  fetch(url, {credentials: 'same-origin'}).then(function(response) {
+    if (!response.ok) {
+      throw new Error("Search failed with status: " + response.status);
+    }
+
+    let reader = response.body.getReader();
+    let read_chunk = function() {
+      return reader.read().then(function(chunk) {
+        if (chunk.done) {
+          handle_search_line(buffer);
+          console.debug("Successful search");
+          finish_search();
+          return;
+        }
+
+        buffer += decoder.decode(chunk.value, {stream: true});
+        let lines = buffer.split('\n');
+        buffer = lines.pop(); // The last line may be incomplete
+        lines.forEach(handle_search_line);
+
+        return read_chunk();
+      });
+    }
 
-      hide_loading();
-      enable_search_fields();
-    },
-    timeout: 60000
+    return read_chunk();
+  }).catch(function(error) {
+    console.debug("Failed search: " + error);
+    show_search_error("Fejl: Kunne ikke forbinde til PACS");
+    finish_search();
   });
 }
 
@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+import tempfile
+from pathlib import Path
+from pydicom import Dataset
+
+from main_page.libs import dataset_creator
+from main_page.libs import server_config
+
+"""
+  Fixtures shared by the tests of the libs working on studies on disk
+"""
+
+
+def use_temp_dir(test_case: unittest.TestCase, *config_dirs: str) -> Path:
+  """
+  Creates a temporary directory, which is removed when the test is done
+
+  Args:
+    test_case: the running test
+    config_dirs: names of server_config directories, e.g. 'PACS_QUEUE_DIR',
+                 to point at sub directories of the temporary directory
+                 while the test runs
+
+  Returns:
+    Path to the temporary directory
+  """
+  tmp_dir = tempfile.TemporaryDirectory()
+  test_case.addCleanup(tmp_dir.cleanup)
+
+  for config_dir in config_dirs:
+    dir_patch = mock.patch.object(server_config, config_dir, f"{tmp_dir.name}/{config_dir.lower()}/")
+    dir_patch.start()
+    test_case.addCleanup(dir_patch.stop)
+
+  return Path(tmp_dir.name)
+
+
+def create_study_dataset(
+    accession_number: str='REGH12345678',
+    patient_id: str='1234564321',
+    study_date: str='20190101'
+  ) -> Dataset:
+  """
+  Creates a dataset with the tags every study is saved and indexed by
+  """
+  ds = dataset_creator.create_empty_dataset(accession_number)
+  ds.AccessionNumber = accession_number
+  ds.add_new(0x00100020, 'LO', patient_id)
+  ds.StudyDate = study_date
+
+  return ds
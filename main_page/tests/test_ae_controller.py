@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from main_page.libs import ae_controller
+
+
+class AssociationPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.pool = ae_controller.AssociationPool(idle_timeout=30, max_per_peer=1, borrow_timeout=0.1)
+    self.create_patch = mock.patch.object(self.pool, '_create', side_effect=lambda key, logger: mock.MagicMock())
+    self.create_patch.start()
+
+  def tearDown(self):
+    self.create_patch.stop()
+
+  def borrow(self, aet='PACS'):
+    return self.pool.borrow('GFR', '127.0.0.1', 104, aet, [ ])
+
+  def test_borrow_bounded_per_peer(self):
+    with self.borrow() as first:
+      self.assertIsNotNone(first)
+
+      with self.borrow() as second:
+        self.assertIsNone(second)
+
+      with self.borrow(aet='OTHER') as other:
+        self.assertIsNotNone(other)
+
+  def test_borrow_after_give_back(self):
+    with self.borrow() as first:
+      pass
+
+    with self.borrow() as second:
+      self.assertIs(second, first)
+
+  def test_borrow_after_exception(self):
+    with self.assertRaises(RuntimeError):
+      with self.borrow():
+        raise RuntimeError()
+
+    with self.borrow() as assoc:
+      self.assertIsNotNone(assoc)
+
+  def test_borrow_several_too_many(self):
+    with self.assertRaises(ValueError):
+      with self.pool.borrow_several('GFR', '127.0.0.1', 104, 'PACS', [[ ], [ ]]):
+        pass
+
+  def test_borrow_several_workers_at_limit(self):
+    # As many workers as associations per peer, each needing two associations
+    pool = ae_controller.AssociationPool(idle_timeout=30, max_per_peer=4, borrow_timeout=5)
+    start = threading.Event()
+
+    def work(_):
+      start.wait()
+      with pool.borrow_several('GFR', '127.0.0.1', 104, 'PACS', [['find'], ['move']]) as associations:
+        time.sleep(0.05)
+        return associations is not None
+
+    with mock.patch.object(pool, '_create', side_effect=lambda key, logger: mock.MagicMock()):
+      with ThreadPoolExecutor(max_workers=pool.max_per_peer) as executor:
+        futures = [executor.submit(work, i) for i in range(pool.max_per_peer)]
+        start.set()
+        borrowed = [future.result() for future in futures]
+
+    self.assertEqual(borrowed, [True] * pool.max_per_peer)
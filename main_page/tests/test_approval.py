@@ -0,0 +1,82 @@
+from django.test import TestCase
+from unittest import mock
+
+from main_page.libs import approval
+from main_page.libs import enums
+from main_page import models
+
+
+class ApprovalTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    cls.hospital = models.Hospital.objects.create(name='test_name', short_name='tn')
+    models.ServerConfiguration.objects.create(id=1, AE_title='GFR')
+    models.Study.objects.create(
+      hospital=cls.hospital,
+      accession_number='REGH12345678',
+      state=enums.StudyState.REGISTERED.value,
+      path='/nonexistent/REGH12345678'
+    )
+
+  def get_user(self, pacs):
+    return mock.Mock(department=mock.Mock(hospital=self.hospital, config=mock.Mock(pacs=pacs)))
+
+  def test_approve_no_pacs(self):
+    results = approval.approve(self.get_user(None), ['REGH12345678'], 'abc')
+
+    self.assertEqual(len(results), 1)
+    self.assertFalse(results[0].queued)
+    self.assertTrue(results[0].error)
+
+  @mock.patch('main_page.libs.approval.pacs_outbox.send_batch')
+  def test_approve_not_controlled(self, send_batch):
+    address = models.Address(ae_title='PACS', ip='127.0.0.1', port='104')
+    results = approval.approve(self.get_user(address), ['REGH12345678', 'REGH12345678', 'REGH00000000'], 'abc')
+
+    self.assertEqual([result.accession_number for result in results], ['REGH12345678', 'REGH00000000'])
+    self.assertFalse(any(result.queued for result in results))
+    send_batch.assert_not_called()
+    self.assertTrue(models.Study.objects.filter(accession_number='REGH12345678').exists())
+
+  @mock.patch('main_page.libs.approval.pacs_outbox.send_batch')
+  def test_approve_claimed(self, send_batch):
+    # Another request is approving the study
+    models.Study.objects.filter(accession_number='REGH12345678').update(state=enums.StudyState.APPROVING.value)
+
+    address = models.Address(ae_title='PACS', ip='127.0.0.1', port='104')
+    results = approval.approve(self.get_user(address), ['REGH12345678'], 'abc')
+
+    self.assertFalse(results[0].queued)
+    send_batch.assert_not_called()
+    self.assertFalse(models.HandledExaminations.objects.filter(accession_number='REGH12345678').exists())
+
+  @mock.patch('main_page.libs.approval.pacs_outbox.send_batch')
+  def test_approve_releases_on_failure(self, send_batch):
+    models.Study.objects.filter(accession_number='REGH12345678').update(state=enums.StudyState.CONTROL.value)
+
+    address = models.Address(ae_title='PACS', ip='127.0.0.1', port='104')
+    results = approval.approve(self.get_user(address), ['REGH12345678'], 'abc')
+
+    # The study file doesn't exist, so the study is returned to the control list
+    self.assertEqual(results[0].error, "Unable to save the study")
+    study = models.Study.objects.get(accession_number='REGH12345678')
+    self.assertEqual(study.state, enums.StudyState.CONTROL.value)
+
+  @mock.patch('main_page.libs.approval.cache.evict_to_budget')
+  @mock.patch('main_page.libs.approval.finish_study')
+  @mock.patch('main_page.libs.approval.pacs_outbox.enqueue')
+  @mock.patch('main_page.libs.approval.dicomlib')
+  def test_approve_keeps_batch_in_cache(self, dicomlib, enqueue, finish_study, evict_to_budget):
+    models.Study.objects.filter(accession_number='REGH12345678').update(state=enums.StudyState.CONTROL.value)
+    models.Study.objects.create(
+      hospital=self.hospital,
+      accession_number='REGH87654321',
+      state=enums.StudyState.CONTROL.value,
+      path='/nonexistent/REGH87654321'
+    )
+
+    address = models.Address(ae_title='PACS', ip='127.0.0.1', port='104')
+    results = approval.approve(self.get_user(address), ['REGH12345678', 'REGH87654321'], 'abc', send=False)
+
+    self.assertTrue(all(result.queued for result in results))
+    evict_to_budget.assert_called_once_with(keep=['REGH12345678', 'REGH87654321'])
@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+import datetime
+
+from main_page.libs import archive
+from main_page import models
+from main_page.tests import helpers
+
+
+class ArchiveTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    cls.hospital = models.Hospital.objects.create(name='test_name', short_name='tn')
+
+  def setUp(self):
+    self.ds = helpers.create_study_dataset()
+    self.ds.PatientName = 'Test^Person'
+    self.ds.PatientSize = 1.80
+    self.ds.PatientWeight = 80
+
+  def test_archive_examination(self):
+    archive.archive_examination(self.ds, hospital=self.hospital)
+
+    examination = models.ArchivedExamination.objects.get(accession_number='REGH12345678')
+    self.assertEqual(examination.patient_id, '1234564321')
+    self.assertEqual(examination.study_date, datetime.date(2019, 1, 1))
+    self.assertEqual(examination.hospital, self.hospital)
+    self.assertIsNone(examination.bsa) # No BSA method in the dataset
+
+  def test_archive_examination_keeps_hospital(self):
+    archive.archive_examination(self.ds, hospital=self.hospital)
+    self.ds.PatientWeight = 81
+    archive.archive_examination(self.ds)
+
+    examination = models.ArchivedExamination.objects.get(accession_number='REGH12345678')
+    self.assertEqual(examination.patient_weight, 81)
+    self.assertEqual(examination.hospital, self.hospital)
+
+  def test_uncovered_ranges(self):
+    day = datetime.timedelta(days=1)
+    start = datetime.date(2019, 1, 1)
+    models.SearchCoverage.objects.create(date_from=start + 2 * day, date_to=start + 4 * day)
+
+    self.assertEqual(
+      archive.uncovered_ranges(start, start + 6 * day),
+      [(start, start + day), (start + 5 * day, start + 6 * day)]
+    )
+    self.assertEqual(archive.uncovered_ranges(start + 2 * day, start + 3 * day), [])
+    self.assertEqual(archive.uncovered_ranges(None, start), [(None, start)])
+
+  def test_record_coverage_merges(self):
+    day = datetime.timedelta(days=1)
+    start = datetime.date(2019, 1, 1)
+    archive.record_coverage(start, start + day)
+    archive.record_coverage(start + 2 * day, start + 3 * day)
+
+    coverage = models.SearchCoverage.objects.get()
+    self.assertEqual((coverage.date_from, coverage.date_to), (start, start + 3 * day))
+
+  def test_record_coverage_skips_unsettled_days(self):
+    today = datetime.date.today()
+    archive.record_coverage(today, today)
+
+    self.assertFalse(models.SearchCoverage.objects.exists())
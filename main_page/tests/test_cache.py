@@ -0,0 +1,140 @@
+from django.test import TestCase
+
+import datetime
+from pathlib import Path
+
+from django.utils import timezone
+
+from main_page.libs import cache
+from main_page.libs import dicomlib
+from main_page.libs import server_config
+from main_page.tests import helpers
+from main_page import models
+
+
+class CacheTests(TestCase):
+  def setUp(self):
+    self.tmp_dir = helpers.use_temp_dir(self, 'SEARCH_CACHE_DIR')
+    Path(server_config.SEARCH_CACHE_DIR).mkdir()
+
+  def tearDown(self):
+    dicomlib.dataset_cache.clear()
+
+  def add_study(self, accession_number, study_date='20190101'):
+    study_dir = Path(server_config.SEARCH_CACHE_DIR, accession_number)
+    study_dir.mkdir()
+    ds = helpers.create_study_dataset(accession_number=accession_number, study_date=study_date)
+    dicomlib.save_dicom(Path(study_dir, f'{accession_number}.dcm'), ds)
+
+    return study_dir
+
+  def add_entry(self, accession_number, size, last_accessed):
+    self.add_study(accession_number)
+    models.SearchCacheEntry.objects.create(
+      accession_number=accession_number,
+      size=size,
+      last_accessed=last_accessed
+    )
+
+  def get_statistics(self):
+    return models.SearchCacheStatistics.objects.get_or_create(id=1)[0]
+
+  # --- evict_to_budget ---
+  def add_entries(self):
+    now = timezone.now()
+    for age, accession_number in enumerate(('REGH00000003', 'REGH00000002', 'REGH00000001')):
+      self.add_entry(accession_number, 100, now - datetime.timedelta(hours=age))
+
+  def test_evict_to_budget(self):
+    self.add_entries()
+
+    self.assertEqual(cache.evict_to_budget(max_bytes=150), 2)
+
+    # The least recently retrieved studies are evicted first
+    self.assertEqual(list(models.SearchCacheEntry.objects.values_list('accession_number', flat=True)), ['REGH00000003'])
+    self.assertFalse(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000001').exists())
+    self.assertFalse(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000002').exists())
+    self.assertTrue(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000003').exists())
+    self.assertEqual(self.get_statistics().evictions, 2)
+
+  def test_evict_to_budget_within_budget(self):
+    self.add_entries()
+
+    self.assertEqual(cache.evict_to_budget(max_bytes=300), 0)
+    self.assertEqual(models.SearchCacheEntry.objects.count(), 3)
+    self.assertEqual(self.get_statistics().evictions, 0)
+
+  def test_evict_to_budget_keep(self):
+    self.add_entries()
+
+    self.assertEqual(cache.evict_to_budget(max_bytes=200, keep=['REGH00000001', 'REGH00000002']), 1)
+
+    self.assertEqual(
+      set(models.SearchCacheEntry.objects.values_list('accession_number', flat=True)),
+      {'REGH00000001', 'REGH00000002'}
+    )
+    self.assertFalse(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000003').exists())
+
+  # --- index ---
+  def test_index_study(self):
+    study_dir = self.add_study('REGH12345678')
+
+    cache.index_study('REGH12345678')
+
+    entry = models.SearchCacheEntry.objects.get(accession_number='REGH12345678')
+    self.assertEqual(entry.study_date, datetime.date(2019, 1, 1))
+    self.assertEqual(entry.size, cache.get_study_dir_size(study_dir))
+
+  def test_index_study_keeps_inserted(self):
+    self.add_study('REGH12345678')
+    cache.index_study('REGH12345678')
+    inserted = timezone.now() - datetime.timedelta(days=3)
+    models.SearchCacheEntry.objects.filter(accession_number='REGH12345678').update(inserted=inserted, size=0)
+
+    cache.index_study('REGH12345678')
+
+    entry = models.SearchCacheEntry.objects.get(accession_number='REGH12345678')
+    self.assertEqual(entry.inserted, inserted)
+    self.assertGreater(entry.size, 0)
+
+  def test_clean_cache(self):
+    today = datetime.date.today()
+    for accession_number, study_date in (('REGH00000001', today - datetime.timedelta(days=20)), ('REGH00000002', today)):
+      self.add_study(accession_number, study_date.strftime('%Y%m%d'))
+      cache.index_study(accession_number)
+    # Studies without a study date expire by the time they entered the cache
+    models.SearchCacheEntry.objects.create(
+      accession_number='REGH00000003',
+      inserted=timezone.now() - datetime.timedelta(days=20)
+    )
+
+    cache.clean_cache(14)
+
+    self.assertEqual(list(models.SearchCacheEntry.objects.values_list('accession_number', flat=True)), ['REGH00000002'])
+    self.assertFalse(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000001').exists())
+    self.assertTrue(Path(server_config.SEARCH_CACHE_DIR, 'REGH00000002').exists())
+    self.assertEqual(self.get_statistics().expirations, 2)
+
+  def test_rebuild_index(self):
+    self.add_study('REGH00000001')
+    self.add_study('REGH00000002')
+    cache.index_study('REGH00000002')
+    models.SearchCacheEntry.objects.filter(accession_number='REGH00000002').update(size=0)
+    models.SearchCacheEntry.objects.create(accession_number='REGH00000003')
+
+    self.assertEqual(cache.rebuild_index(), (1, 1))
+
+    self.assertEqual(
+      set(models.SearchCacheEntry.objects.values_list('accession_number', flat=True)),
+      {'REGH00000001', 'REGH00000002'}
+    )
+    # Only the missing studies are indexed
+    self.assertEqual(models.SearchCacheEntry.objects.get(accession_number='REGH00000002').size, 0)
+
+  def test_rebuild_index_all(self):
+    self.add_study('REGH00000001')
+    cache.index_study('REGH00000001')
+    models.SearchCacheEntry.objects.filter(accession_number='REGH00000001').update(size=0)
+
+    self.assertEqual(cache.rebuild_index(reindex_all=True), (1, 0))
+    self.assertGreater(models.SearchCacheEntry.objects.get(accession_number='REGH00000001').size, 0)
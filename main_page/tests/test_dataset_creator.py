@@ -117,7 +117,7 @@ class GenerateRisQueryDatasetTests(unittest.TestCase):
     self.assertEqual(ds[0x00080018].value, '')
     self.assertEqual(ds[0x00080020].value, '')
     self.assertEqual(ds[0x00080050].value, '')
-    self.assertEqual(ds[0x00080052].value, 'STUDY')
+    self.assertEqual(ds[0x00080052].value, 'WORKLIST')
     self.assertEqual(len(ds[0x00081110].value), 0)
     self.assertEqual(ds[0x00100010].value, '')
     self.assertEqual(ds[0x00100020].value, '')
@@ -142,7 +142,7 @@ class GenerateRisQueryDatasetTests(unittest.TestCase):
     self.assertEqual(len(ds[0x00400100].value), 1)
     self.assertEqual(ds[0x00400100][0][0x00080060].value, '')
     self.assertEqual(ds[0x00400100][0][0x00400001].value, ris_calling)
-    self.assertEqual(ds[0x00400100][0][0x00400002].value, datetime.date.today().strftime("%Y%m%d"))
+    self.assertEqual(ds[0x00400100][0][0x00400002].value, '-' + datetime.date.today().strftime("%Y%m%d"))
     self.assertEqual(ds[0x00400100][0][0x00400003].value, '')
     self.assertEqual(ds[0x00400100][0][0x00400007].value, '')
     self.assertEqual(ds[0x00400100][0][0x00400009].value, '')
@@ -166,6 +166,16 @@ class GenerateRisQueryDatasetTests(unittest.TestCase):
 
     self.assertEqual(ds[0x00400100][0][0x00400001].value, '')
 
+  def test_generate_ris_query_dataset_window(self):
+    ds = dataset_creator.generate_ris_query_dataset(
+      'TEST_AET',
+      date_from=datetime.date(2019, 1, 1),
+      date_to=datetime.date(2019, 1, 3)
+    )
+
+    self.assertEqual(ds[0x00400100][0][0x00400002].value, '20190101-20190103')
+    self.assertEqual(ds[0x00400100][0][0x00400002].VR, 'DA')
+
 
 # --- create_search_dataset ---
 class CreateSearchDatasetTests(unittest.TestCase):
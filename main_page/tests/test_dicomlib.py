@@ -2,10 +2,11 @@ from django.test import TestCase
 import unittest
 
 from tempfile import TemporaryFile, NamedTemporaryFile
+from pathlib import Path
 from datetime import datetime
 import numpy as np
 import pydicom
-from pydicom import Dataset, Sequence, uid, values
+from pydicom import Dataset, Sequence, uid, values, filebase, filewriter
 from pydicom._storage_sopclass_uids import SecondaryCaptureImageStorage
 import os
 
@@ -15,6 +16,7 @@ from main_page.libs import dicomlib
 from main_page.libs import server_config
 from main_page.libs.clearance_math import clearance_math
 from main_page import models
+from main_page.tests import helpers
 
 
 def validate_tags(ds, tags):
@@ -86,6 +88,133 @@ class DcmreadWrapperTests(unittest.TestCase):
     self.assertEqual(load_ds[0x00231028].value, thin_fac)
 
 
+# --- dcmread_wrapper with header_only ---
+class HeaderOnlyTests(unittest.TestCase):
+  def test_header_only(self):
+    ds = dataset_creator.create_empty_dataset('REGH12345678')
+    ds.add_new(0x00231001, 'LO', 'Normal')
+    ds.add_new(0x7FE00010, 'OB', b'\x00' * 1024)
+
+    tmp_file = NamedTemporaryFile(delete=False)
+    ds.save_as(tmp_file, write_like_original=False)
+    tmp_file.close()
+
+    load_ds = dicomlib.dcmread_wrapper(tmp_file.name, header_only=True)
+    os.remove(tmp_file.name)
+
+    self.assertNotIn(0x7FE00010, load_ds)
+    self.assertEqual(load_ds[0x00231001].VR, 'LO')
+    self.assertEqual(load_ds[0x00231001].value, 'Normal')
+
+
+# --- dcmread_wrapper with dataset_cache ---
+class DatasetCacheTests(unittest.TestCase):
+  def setUp(self):
+    self.ds = dataset_creator.create_empty_dataset('REGH12345678')
+    self.ds.AccessionNumber = 'REGH12345678'
+    self.ds.add_new(0x00100020, 'LO', '1234564321')
+
+    tmp_file = NamedTemporaryFile(delete=False, suffix='.dcm')
+    tmp_file.close()
+    self.filepath = tmp_file.name
+    dicomlib.save_dicom(self.filepath, self.ds)
+
+  def tearDown(self):
+    dicomlib.dataset_cache.clear()
+    os.remove(self.filepath)
+
+  def test_cached_copies(self):
+    first = dicomlib.dcmread_wrapper(self.filepath, use_cache=True)
+    first.PatientID = 'modified'
+
+    second = dicomlib.dcmread_wrapper(self.filepath, use_cache=True)
+    self.assertEqual(second.PatientID, '1234564321')
+    self.assertIsNot(first, second)
+
+  def test_save_dicom_invalidates(self):
+    dataset = dicomlib.dcmread_wrapper(self.filepath, use_cache=True)
+    dataset.PatientID = '6543214321'
+    dicomlib.save_dicom(self.filepath, dataset)
+
+    self.assertEqual(dicomlib.dcmread_wrapper(self.filepath, use_cache=True).PatientID, '6543214321')
+
+
+# --- study summary tests ---
+class StudySummaryTests(unittest.TestCase):
+  def setUp(self):
+    self.study_dir = Path(helpers.use_temp_dir(self), 'REGH12345678')
+    self.study_dir.mkdir()
+
+    self.ds = helpers.create_study_dataset()
+    self.ds.StudyDescription = 'GFR, Tc-99m-DTPA'
+
+  def tearDown(self):
+    dicomlib.dataset_cache.clear()
+
+  def test_save_dicom_writes_summary(self):
+    dicomlib.save_dicom(Path(self.study_dir, 'REGH12345678.dcm'), self.ds)
+
+    summary = dicomlib.read_study_summary(self.study_dir, 'REGH12345678')
+    self.assertEqual(summary.PatientID, '1234564321')
+    self.assertEqual(summary.StudyDate, '20190101')
+    self.assertEqual(summary.StudyDescription, 'GFR, Tc-99m-DTPA')
+
+  def test_save_dicom_keeps_recovered_date(self):
+    dicomlib.save_dicom(Path(self.study_dir, 'REGH12345678.dcm'), self.ds)
+    dicomlib.update_study_summary(self.study_dir, 'REGH12345678', RecoveredDate='20190201')
+
+    self.ds.StudyDescription = 'GFR, Cr-51-EDTA'
+    dicomlib.save_dicom(Path(self.study_dir, 'REGH12345678.dcm'), self.ds)
+
+    summary = dicomlib.read_study_summary(self.study_dir, 'REGH12345678')
+    self.assertEqual(summary.StudyDescription, 'GFR, Cr-51-EDTA')
+    self.assertEqual(summary.RecoveredDate, '20190201')
+
+  def test_read_missing_summary(self):
+    dicomlib.save_dicom(Path(self.study_dir, 'REGH12345678.dcm'), self.ds)
+    os.remove(dicomlib.get_summary_filepath(self.study_dir, 'REGH12345678'))
+
+    summary = dicomlib.read_study_summary(self.study_dir, 'REGH12345678')
+    self.assertEqual(summary.AccessionNumber, 'REGH12345678')
+    self.assertTrue(dicomlib.get_summary_filepath(self.study_dir, 'REGH12345678').exists())
+
+  def test_read_missing_study(self):
+    with self.assertRaises(FileNotFoundError):
+      dicomlib.read_study_summary(self.study_dir, 'REGH12345678')
+
+
+# --- peek_tags tests ---
+class PeekTagsTests(unittest.TestCase):
+  def setUp(self):
+    self.ds = Dataset()
+    self.ds.AccessionNumber = 'REGH12345678'
+    self.ds.Modality = 'OT'
+    self.ds.add_new(0x00230010, 'LO', 'Clearance Normal')
+    self.ds.add_new(0x00231001, 'LO', 'Normal')
+    self.ds.add_new(0x7FE00010, 'OB', b'\x00' * 16)
+
+  def encode(self, is_implicit_VR):
+    fp = filebase.DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = is_implicit_VR
+    filewriter.write_dataset(fp, self.ds)
+    return fp.getvalue()
+
+  def test_peek_tags(self):
+    for transfer_syntax, is_implicit_VR in ((uid.ImplicitVRLittleEndian, True), (uid.ExplicitVRLittleEndian, False)):
+      peeked = dicomlib.peek_tags(
+        self.encode(is_implicit_VR),
+        transfer_syntax,
+        [0x00080050, 0x00080060, 0x00230010]
+      )
+
+      self.assertEqual(peeked.AccessionNumber, 'REGH12345678')
+      self.assertEqual(peeked.Modality, 'OT')
+      self.assertIn(0x00230010, peeked)
+      self.assertNotIn(0x00231001, peeked)
+      self.assertNotIn(0x7FE00010, peeked)
+
+
 # --- update_tags tests ---
 class UpdateTagsTests(unittest.TestCase):
   def setUp(self):
@@ -796,6 +925,34 @@ class PixelDataTests(unittest.TestCase):
 
     self.assertEqual('PixelData' in self.ds, False)
 
+  def get_plot(self):
+    plot = np.full((1080, 1920, 3), 255, dtype=np.uint8)
+    plot[100:500, 200:900] = (0xFB, 0xA0, 0xA0)
+    plot[600:610, :] = (0, 0, 255)
+    return plot
+
+  def test_add_pixeldata_encodings(self):
+    plot = self.get_plot()
+
+    for encoding in enums.PlotEncoding:
+      with self.subTest(encoding=encoding):
+        ds = Dataset()
+        dicomlib.try_add_pixeldata(ds, plot.tobytes(), encoding=encoding)
+
+        self.assertTrue(np.array_equal(dicomlib.get_plot_pixels(ds), plot))
+        if encoding != enums.PlotEncoding.RGB:
+          self.assertLessEqual(len(ds.PixelData) * 3, plot.nbytes)
+
+  def test_add_pixeldata_replaces_encoding(self):
+    plot = self.get_plot()
+
+    dicomlib.try_add_pixeldata(self.ds, plot.tobytes(), encoding=enums.PlotEncoding.RLE)
+    dicomlib.try_add_pixeldata(self.ds, plot.tobytes(), encoding=enums.PlotEncoding.PALETTE)
+
+    self.assertFalse(dicomlib.is_compressed(self.ds))
+    self.assertEqual(self.ds.PhotometricInterpretation, 'PALETTE COLOR')
+    self.assertTrue(np.array_equal(dicomlib.get_plot_pixels(self.ds), plot))
+
 
 # --- fill_dicom tests ---
 # I.e. integration test of all the above unit tests
@@ -0,0 +1,77 @@
+import unittest
+
+import os
+from pathlib import Path
+
+from main_page.libs import dicomlib
+from main_page.libs import history_store
+from main_page.tests import helpers
+
+
+class HistoryStoreTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = helpers.use_temp_dir(self, 'HISTORY_STORE_DIR')
+
+    self.ds = helpers.create_study_dataset()
+    self.ds.add_new(0x00231014, 'DS', 42.0)
+    self.ds.add_new(0x7FE00010, 'OB', b'\x00' * 1024)
+
+    self.source = Path(self.tmp_dir, 'REGH12345678.dcm')
+    dicomlib.save_dicom(self.source, self.ds)
+
+  def tearDown(self):
+    dicomlib.dataset_cache.clear()
+
+  def test_ingest_strips(self):
+    store_path = history_store.ingest(self.source)
+
+    self.assertFalse(self.source.exists())
+    self.assertEqual(store_path, history_store.get_path('1234564321', 'REGH12345678'))
+
+    stored = dicomlib.dcmread_wrapper(store_path)
+    self.assertEqual(stored.AccessionNumber, 'REGH12345678')
+    self.assertEqual(stored.StudyDate, '20190101')
+    self.assertEqual(stored.normClear, 42.0)
+    self.assertNotIn(0x7FE00010, stored)
+
+  def test_link(self):
+    study_dirs = [Path(self.tmp_dir, 'REGH00000001'), Path(self.tmp_dir, 'REGH00000002')]
+    for study_dir in study_dirs:
+      study_dir.mkdir()
+
+    store_path = history_store.ingest(self.source)
+    self.assertEqual(history_store.link(store_path, study_dirs, 'REGH12345678.dcm'), 2)
+
+    for study_dir in study_dirs:
+      history_file = Path(study_dir, 'REGH12345678.dcm')
+      self.assertTrue(history_file.is_symlink())
+      self.assertEqual(os.readlink(history_file), str(store_path))
+
+  def test_history_summary(self):
+    study_dir = Path(self.tmp_dir, 'REGH00000001')
+    study_dir.mkdir()
+    history_store.link(history_store.ingest(self.source), [study_dir], 'REGH12345678.dcm')
+
+    history_store.write_history_summary(study_dir)
+    # The summary is read without the historic studies
+    os.unlink(Path(study_dir, 'REGH12345678.dcm'))
+
+    history = history_store.read_history_summary(study_dir)
+    self.assertEqual(len(history), 1)
+    self.assertEqual(history[0].AccessionNumber, 'REGH12345678')
+    self.assertEqual(history[0].StudyDate, '20190101')
+    self.assertEqual(history[0].normClear, 42.0)
+
+  def test_history_summary_outdated(self):
+    study_dir = Path(self.tmp_dir, 'REGH00000001')
+    study_dir.mkdir()
+    history_store.link(history_store.ingest(self.source, keep_source=True), [study_dir], 'REGH12345678.dcm')
+    history_store.write_history_summary(study_dir)
+
+    # A newer version of the historic study is stored
+    self.ds.normClear = 43.0
+    dicomlib.save_dicom(self.source, self.ds)
+    history_store.ingest(self.source)
+
+    history = history_store.read_history_summary(study_dir)
+    self.assertEqual(history[0].normClear, 43.0)
@@ -0,0 +1,71 @@
+from django.test import TestCase
+
+import datetime
+
+from django.utils import timezone
+
+from main_page.libs import enums
+from main_page.libs import janitor
+from main_page.libs import server_config
+from main_page import models
+
+
+class JanitorTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    cls.hospital = models.Hospital.objects.create(name='test_name', short_name='tn')
+
+    today = datetime.date.today()
+    studies = (
+      ('REGH00000001', enums.StudyState.REGISTERED, 1),
+      ('REGH00000002', enums.StudyState.REGISTERED, server_config.ACTIVE_STUDY_DAYS + 1),
+      ('REGH00000003', enums.StudyState.REGISTERED, server_config.ACTIVE_STUDY_DAYS + 2),
+      ('REGH00000004', enums.StudyState.DELETED, server_config.DELETED_STUDY_DAYS + 1),
+    )
+    for accession_number, state, age in studies:
+      models.Study.objects.create(
+        hospital=cls.hospital,
+        accession_number=accession_number,
+        state=state.value,
+        retention_date=today - datetime.timedelta(days=age),
+        path=f'/nonexistent/{accession_number}'
+      )
+
+  def get_state(self, accession_number):
+    return enums.StudyState(models.Study.objects.get(accession_number=accession_number).state)
+
+  def test_run(self):
+    report = janitor.run()
+
+    self.assertEqual(report.moved, 2)
+    self.assertEqual(report.purged, 1)
+    self.assertEqual(report.failed, [])
+    self.assertEqual(self.get_state('REGH00000001'), enums.StudyState.REGISTERED)
+    self.assertEqual(self.get_state('REGH00000002'), enums.StudyState.DELETED)
+    self.assertFalse(models.Study.objects.filter(accession_number='REGH00000004').exists())
+
+  def test_run_batch_size(self):
+    report = janitor.run(batch_size=1)
+
+    # The oldest study is moved first, the other is left for the next run
+    self.assertEqual(report.moved, 1)
+    self.assertEqual(report.deferred, 1)
+    self.assertEqual(self.get_state('REGH00000003'), enums.StudyState.DELETED)
+    self.assertEqual(self.get_state('REGH00000002'), enums.StudyState.REGISTERED)
+
+  def test_run_releases_approvals(self):
+    now = timezone.now()
+    for accession_number, claimed in (('REGH00000005', 1), ('REGH00000006', server_config.APPROVAL_CLAIM_TIMEOUT + 1)):
+      models.Study.objects.create(
+        hospital=self.hospital,
+        accession_number=accession_number,
+        state=enums.StudyState.APPROVING.value,
+        state_changed=now - datetime.timedelta(seconds=claimed),
+        path=f'/nonexistent/{accession_number}'
+      )
+
+    report = janitor.run()
+
+    self.assertEqual(report.released, 1)
+    self.assertEqual(self.get_state('REGH00000005'), enums.StudyState.APPROVING)
+    self.assertEqual(self.get_state('REGH00000006'), enums.StudyState.CONTROL)
@@ -0,0 +1,44 @@
+import unittest
+
+from pathlib import Path
+
+from main_page.libs import move_notifier
+from main_page.tests import helpers
+
+
+class MoveWaiterTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = helpers.use_temp_dir(self, 'MOVE_NOTIFY_DIR')
+
+  def test_notify(self):
+    stored_file = Path(self.tmp_dir, 'REGH12345678.dcm')
+
+    with move_notifier.MoveWaiter('REGH12345678') as waiter:
+      self.assertTrue(move_notifier.notify('REGH12345678', waiter.message_id, stored_file))
+      self.assertEqual(waiter.wait(1), stored_file)
+
+    # The socket is removed once the waiter is done
+    self.assertFalse(move_notifier.socket_path('REGH12345678', waiter.message_id).exists())
+
+  def test_notify_no_waiter(self):
+    self.assertFalse(move_notifier.notify('REGH12345678', 1, 'REGH12345678.dcm'))
+
+  def test_wait_timeout(self):
+    with move_notifier.MoveWaiter('REGH12345678') as waiter:
+      self.assertEqual(waiter.wait(0.01), None)
+
+  def test_notify_failure(self):
+    with move_notifier.MoveWaiter('REGH12345678') as waiter:
+      self.assertTrue(move_notifier.notify_failure('REGH12345678', waiter.message_id, 'Disk full'))
+      self.assertEqual(waiter.wait(10), None)
+
+  def test_same_accession_number(self):
+    with move_notifier.MoveWaiter('REGH12345678') as waiter_1:
+      with move_notifier.MoveWaiter('REGH12345678') as waiter_2:
+        self.assertNotEqual(waiter_1.message_id, waiter_2.message_id)
+
+        move_notifier.notify('REGH12345678', waiter_2.message_id, 'second.dcm')
+        move_notifier.notify('REGH12345678', waiter_1.message_id, 'first.dcm')
+
+        self.assertEqual(waiter_1.wait(1), Path('first.dcm'))
+        self.assertEqual(waiter_2.wait(1), Path('second.dcm'))
@@ -0,0 +1,131 @@
+from django.test import TestCase
+from unittest import mock
+
+import datetime
+import numpy as np
+from pathlib import Path
+from pydicom import Dataset, uid
+
+from django.utils import timezone
+
+from main_page.libs import dicomlib
+from main_page.libs import enums
+from main_page.libs import pacs_outbox
+from main_page.libs import query_cache
+from main_page.libs import server_config
+from main_page import models
+from main_page.tests import helpers
+
+
+class PacsOutboxTests(TestCase):
+  def setUp(self):
+    helpers.use_temp_dir(self, 'PACS_QUEUE_DIR')
+
+    self.address = models.Address(ae_title='PACS', ip='127.0.0.1', port='104')
+    self.ds = helpers.create_study_dataset()
+
+  def tearDown(self):
+    pacs_outbox._rejected_syntaxes.clear()
+
+  def get_association(self, *statuses, accepted=(uid.ExplicitVRLittleEndian,)):
+    association = mock.Mock()
+    association.accepted_contexts = [
+      mock.Mock(abstract_syntax=pacs_outbox.SECONDARY_CAPTURE, transfer_syntax=[transfer_syntax])
+      for transfer_syntax in accepted
+    ]
+    responses = [ ]
+    for status_code in statuses:
+      status = Dataset()
+      status.Status = status_code
+      responses.append(status)
+    association.send_c_store.side_effect = responses
+
+    return association
+
+  def test_enqueue_replaces_pending(self):
+    first = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+    second = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+
+    self.assertEqual(first.id, second.id)
+    self.assertEqual(pacs_outbox.pending().count(), 1)
+    self.assertTrue(Path(first.path).exists())
+
+  def test_get_backoff(self):
+    for attempts in range(1, 20):
+      delay = min(server_config.PACS_OUTBOX_BACKOFF_MAX, server_config.PACS_OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+      self.assertTrue(delay / 2 <= pacs_outbox.get_backoff(attempts) <= delay)
+
+  def test_send_batch(self):
+    item = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+    association = self.get_association(0x0000)
+
+    with mock.patch.object(pacs_outbox.ae_controller.association_pool, 'borrow') as borrow:
+      borrow.return_value.__enter__.return_value = association
+      errors = pacs_outbox.send_batch(('GFR', '127.0.0.1', 104, 'PACS'), [models.PacsOutboxItem.objects.get(id=item.id)])
+
+    self.assertEqual(errors, { item.id: '' })
+    self.assertEqual(models.PacsOutboxItem.objects.get(id=item.id).state, enums.OutboxState.SENT.value)
+    self.assertFalse(Path(item.path).exists())
+
+  def test_send_batch_invalidates_search_results(self):
+    item = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+    search_cache = query_cache.QueryResultCache('search', 60, 8)
+    query = mock.Mock(return_value=[ ])
+    search_cache.get('patient', query, patient_id='1234564321')
+    search_cache.get('other patient', query, patient_id='1111111111')
+
+    with mock.patch.object(pacs_outbox.ae_controller.association_pool, 'borrow') as borrow:
+      borrow.return_value.__enter__.return_value = self.get_association(0x0000)
+      pacs_outbox.send_batch(('GFR', '127.0.0.1', 104, 'PACS'), [models.PacsOutboxItem.objects.get(id=item.id)])
+
+    search_cache.get('patient', query, patient_id='1234564321')
+    search_cache.get('other patient', query, patient_id='1111111111')
+    self.assertEqual(query.call_count, 3)
+
+  def test_send_batch_falls_back_on_rejected_syntax(self):
+    peer = ('GFR', '127.0.0.1', 104, 'PACS')
+    item = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+    association = self.get_association(
+      0xC000,
+      0x0000,
+      accepted=(uid.ExplicitVRLittleEndian, uid.DeflatedExplicitVRLittleEndian)
+    )
+
+    with mock.patch.object(pacs_outbox.ae_controller.association_pool, 'borrow') as borrow:
+      borrow.return_value.__enter__.return_value = association
+      errors = pacs_outbox.send_batch(peer, [models.PacsOutboxItem.objects.get(id=item.id)])
+
+    self.assertEqual(errors, { item.id: '' })
+    sent_syntaxes = [call.args[0].file_meta.TransferSyntaxUID for call in association.send_c_store.call_args_list]
+    self.assertEqual(sent_syntaxes, [uid.DeflatedExplicitVRLittleEndian, uid.ExplicitVRLittleEndian])
+    self.assertEqual(pacs_outbox.get_peer_syntaxes(peer, association), [uid.ExplicitVRLittleEndian])
+
+  def test_encode_dataset_decompresses(self):
+    plot = np.full((1080, 1920, 3), 255, dtype=np.uint8)
+    dicomlib.try_add_pixeldata(self.ds, plot.tobytes(), encoding=enums.PlotEncoding.RLE)
+
+    encoded = pacs_outbox.encode_dataset(self.ds, uid.DeflatedExplicitVRLittleEndian)
+
+    self.assertEqual(encoded.file_meta.TransferSyntaxUID, uid.DeflatedExplicitVRLittleEndian)
+    self.assertEqual(encoded.PixelData, plot.tobytes())
+    self.assertEqual(pacs_outbox.encode_dataset(self.ds, uid.RLELossless).PixelData, self.ds.PixelData)
+
+  def test_send_batch_unable_to_associate(self):
+    item = pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+
+    with mock.patch.object(pacs_outbox.ae_controller.association_pool, 'borrow') as borrow:
+      borrow.return_value.__enter__.return_value = None
+      errors = pacs_outbox.send_batch(('GFR', '127.0.0.1', 104, 'PACS'), [models.PacsOutboxItem.objects.get(id=item.id)])
+
+    item = models.PacsOutboxItem.objects.get(id=item.id)
+    self.assertTrue(errors[item.id])
+    self.assertEqual(item.state, enums.OutboxState.PENDING.value)
+    self.assertEqual(item.attempts, 1)
+    self.assertGreater(item.next_attempt, timezone.now())
+
+  def test_get_status(self):
+    pacs_outbox.enqueue(self.ds, 'GFR', self.address)
+
+    status = pacs_outbox.get_status()
+    self.assertEqual(status['depth'], 1)
+    self.assertEqual(status['peers'][0]['ae_title'], 'PACS')
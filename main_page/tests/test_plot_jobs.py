@@ -0,0 +1,75 @@
+from django.test import TestCase
+
+import os
+import numpy as np
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+from main_page.libs import dicomlib
+from main_page.libs import enums
+from main_page.libs import plot_jobs
+from main_page import models
+from main_page.tests import helpers
+
+
+class PlotJobsTests(TestCase):
+  def setUp(self):
+    self.path = Path(helpers.use_temp_dir(self), 'REGH12345678.dcm')
+    dicomlib.save_dicom(self.path, helpers.create_study_dataset())
+
+    self.plot = np.full((1080, 1920, 3), 255, dtype=np.uint8)
+
+  def get_future(self, modified):
+    future = Future()
+    future.set_result((modified, self.plot.tobytes()))
+    return future
+
+  def test_enqueue_requests_again(self):
+    first = plot_jobs.enqueue('REGH12345678', self.path)
+    second = plot_jobs.enqueue('REGH12345678', self.path)
+
+    self.assertEqual(first.id, second.id)
+    self.assertGreater(second.requested, first.requested)
+    self.assertEqual(plot_jobs.pending().count(), 1)
+
+  def test_finish_writes_plot(self):
+    job = plot_jobs.enqueue('REGH12345678', self.path)
+
+    plot_jobs.finish(job, self.get_future(os.stat(self.path).st_mtime_ns))
+
+    self.assertEqual(models.PlotJob.objects.get(id=job.id).state, enums.PlotJobState.DONE.value)
+    dataset = dicomlib.dcmread_wrapper(self.path)
+    self.assertTrue(np.array_equal(dicomlib.get_plot_pixels(dataset), self.plot))
+
+  def test_finish_study_saved_while_rendering(self):
+    job = plot_jobs.enqueue('REGH12345678', self.path)
+
+    plot_jobs.finish(job, self.get_future(os.stat(self.path).st_mtime_ns - 1))
+
+    self.assertEqual(models.PlotJob.objects.get(id=job.id).state, enums.PlotJobState.PENDING.value)
+    self.assertNotIn('PixelData', dicomlib.dcmread_wrapper(self.path))
+
+  def test_write_plot_study_saved_while_writing(self):
+    job = plot_jobs.enqueue('REGH12345678', self.path)
+    modified = os.stat(self.path).st_mtime_ns
+
+    def save_study(dataset, pixel_bytes):
+      os.utime(self.path, ns=(modified + 1, modified + 1))
+
+    with mock.patch.object(plot_jobs.dicomlib, 'try_add_pixeldata', side_effect=save_study):
+      self.assertFalse(plot_jobs.write_plot(job, modified, self.plot.tobytes()))
+
+    self.assertEqual(os.stat(self.path).st_mtime_ns, modified + 1)
+    self.assertEqual(os.listdir(self.path.parent), [self.path.name])
+
+  def test_finish_rendering_failed(self):
+    job = plot_jobs.enqueue('REGH12345678', self.path)
+    future = Future()
+    future.set_exception(ValueError("No ClearTest"))
+
+    plot_jobs.finish(job, future)
+
+    job = models.PlotJob.objects.get(id=job.id)
+    self.assertEqual(job.state, enums.PlotJobState.FAILED.value)
+    self.assertIn("No ClearTest", job.error)
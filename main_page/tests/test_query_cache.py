@@ -0,0 +1,122 @@
+from django.test import TestCase, TransactionTestCase
+from unittest import mock
+
+import datetime
+import threading
+
+from django.db import connection
+from django.utils import timezone
+
+from main_page.libs import query_cache
+from main_page import models
+
+
+class WaitedEvent(threading.Event):
+  """
+  Event telling when someone is waiting for it
+  """
+  def __init__(self):
+    super().__init__()
+    self.waiting = threading.Event()
+
+  def wait(self, timeout=None):
+    self.waiting.set()
+    return super().wait(timeout)
+
+
+class QueryResultCacheTests(TestCase):
+  def setUp(self):
+    self.cache = query_cache.QueryResultCache('test', 60, 2)
+
+  def test_get_cached(self):
+    query = mock.Mock(return_value=[{'cpr': '1234564321'}])
+
+    self.assertEqual(self.cache.get('key', query), [{'cpr': '1234564321'}])
+    self.assertEqual(self.cache.get('key', query), [{'cpr': '1234564321'}])
+    query.assert_called_once()
+
+  def test_get_shared(self):
+    # Another process, e.g. another uwsgi worker, answered the query
+    query = mock.Mock(return_value=[1])
+    query_cache.QueryResultCache('test', 60, 2).get('key', query)
+
+    self.assertEqual(self.cache.get('key', query), [1])
+    query.assert_called_once()
+
+  def test_get_expired(self):
+    query = mock.Mock(return_value=[1])
+    self.cache.get('key', query)
+
+    later = timezone.now() + datetime.timedelta(seconds=61)
+    with mock.patch('main_page.libs.query_cache.timezone.now', return_value=later):
+      self.cache.get('key', query)
+
+    self.assertEqual(query.call_count, 2)
+
+  def test_get_failed_not_cached(self):
+    query = mock.Mock(return_value=None)
+
+    self.assertIsNone(self.cache.get('key', query))
+    self.assertIsNone(self.cache.get('key', query))
+    self.assertEqual(query.call_count, 2)
+
+  def test_invalidate_patient(self):
+    self.cache.max_entries = 8
+    query = mock.Mock(return_value=[1])
+    self.cache.get(('a', '1234564321'), query, patient_id='1234564321')
+    self.cache.get(('a', '1111111111'), query, patient_id='1111111111')
+    self.cache.get(('a', ''), query)
+
+    self.assertEqual(query_cache.invalidate_patient('123456-4321'), 2)
+    self.cache.get(('a', '1234564321'), query, patient_id='1234564321')
+    self.cache.get(('a', '1111111111'), query, patient_id='1111111111')
+    self.cache.get(('a', ''), query)
+    self.assertEqual(query.call_count, 5)
+
+  def test_max_entries(self):
+    query = mock.Mock(return_value=[1])
+    for key in ('a', 'b', 'c', 'a'):
+      self.cache.get(key, query)
+
+    self.assertEqual(query.call_count, 4)
+    self.assertEqual(models.QueryCacheEntry.objects.filter(name='test').count(), 2)
+
+
+class QueryResultCacheCoalescingTests(TransactionTestCase):
+  def setUp(self):
+    self.cache = query_cache.QueryResultCache('test', 60, 2)
+
+  def test_get_coalesced(self):
+    started = threading.Event()
+    release = threading.Event()
+    calls = [ ]
+
+    def query():
+      calls.append(1)
+      started.set()
+      release.wait()
+      return [1]
+
+    def get():
+      try:
+        results.append(self.cache.get('key', query))
+      finally:
+        connection.close()
+
+    results = [ ]
+    leader = threading.Thread(target=get)
+    leader.start()
+    started.wait()
+
+    # The leader is held in the query, until the follower waits for its result
+    flight = self.cache._flights['key']
+    flight.done = WaitedEvent()
+    follower = threading.Thread(target=get)
+    follower.start()
+    self.assertTrue(flight.done.waiting.wait(5))
+    release.set()
+    leader.join()
+    follower.join()
+
+    self.assertEqual(results, [[1], [1]])
+    self.assertEqual(len(calls), 1)
@@ -0,0 +1,103 @@
+from django.test import TestCase, RequestFactory
+from unittest import mock
+
+import datetime
+import json
+
+from main_page.libs import search
+from main_page.views.api import api
+from main_page import models
+
+
+class SearchTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    models.ArchivedExamination.objects.create(
+      accession_number='REGH12345678',
+      patient_id='1234564321',
+      patient_name='Person^Test',
+      study_date=datetime.date(2019, 1, 2)
+    )
+    models.SearchCoverage.objects.create(
+      date_from=datetime.date(2019, 1, 1),
+      date_to=datetime.date(2019, 1, 31)
+    )
+
+  def test_search_local(self):
+    results = search.search_local(name='test', cpr='123456-4321')
+
+    self.assertEqual([result['accession_number'] for result in results], ['REGH12345678'])
+    self.assertEqual(search.search_local(name='other'), [])
+
+  @mock.patch('main_page.libs.search.pacs.search_query_pacs')
+  def test_search_covered(self, search_query_pacs):
+    results, pending = search.search(None, date_from='2019-01-01', date_to='2019-01-31', query_pacs=True)
+
+    search_query_pacs.assert_not_called()
+    self.assertEqual(len(results), 1)
+    self.assertFalse(pending)
+
+  @mock.patch('main_page.libs.search.pacs.search_query_pacs')
+  def test_search_uncovered(self, search_query_pacs):
+    _, pending = search.search(None, date_from='2019-01-01', date_to='2019-02-05')
+    self.assertTrue(pending)
+    search_query_pacs.assert_not_called()
+
+    search_query_pacs.return_value = [
+      { 'accession_number': 'REGH12345678', 'name': '', 'cpr': '', 'date': '' },
+      { 'accession_number': 'REGH87654321', 'name': '', 'cpr': '', 'date': '' },
+    ]
+    results, pending = search.search(None, date_from='2019-01-01', date_to='2019-02-05', query_pacs=True)
+
+    self.assertEqual(search_query_pacs.call_args[1]['date_from'], '20190201')
+    self.assertEqual([result['accession_number'] for result in results], ['REGH12345678', 'REGH87654321'])
+    self.assertFalse(pending)
+    self.assertEqual(models.SearchCoverage.objects.get().date_to, datetime.date(2019, 2, 5))
+
+  @mock.patch('main_page.libs.search.pacs.stream_search_query_pacs')
+  def test_stream_search_limit(self, stream_search_query_pacs):
+    closed = [ ]
+    def pacs_results():
+      try:
+        for accession_number in ('REGH12345678', 'REGH00000001', 'REGH00000002', 'REGH00000003'):
+          yield { 'accession_number': accession_number, 'name': '', 'cpr': '', 'date': '' }
+      finally:
+        closed.append(True)
+
+    stream_search_query_pacs.return_value = pacs_results()
+    results = list(search.stream_search(None, date_from='2019-01-01', date_to='2019-02-05', limit=3))
+
+    self.assertEqual([result['accession_number'] for result in results], ['REGH12345678', 'REGH00000001', 'REGH00000002'])
+    self.assertEqual(closed, [True])
+    # The PACS query was cancelled, so the range isn't covered
+    self.assertEqual(models.SearchCoverage.objects.get().date_to, datetime.date(2019, 1, 31))
+
+
+class SearchStreamEndpointTests(TestCase):
+  def get(self, **params):
+    query = { 'name': '', 'cpr': '', 'accession_number': '', 'date_from': '', 'date_to': '' }
+    query.update(params)
+    request = RequestFactory().get('/api/search_stream', query)
+    request.user = mock.Mock()
+
+    return api.SearchStreamEndpoint.as_view()(request)
+
+  def read_lines(self, response):
+    return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+  @mock.patch('main_page.views.api.api.search.stream_search')
+  def test_limit_invalid(self, stream_search):
+    for limit in ('0', '-1', 'abc'):
+      self.assertEqual(self.get(limit=limit).status_code, 400)
+    stream_search.assert_not_called()
+
+  @mock.patch('main_page.views.api.api.search.stream_search')
+  def test_stream_error(self, stream_search):
+    def results():
+      yield { 'accession_number': 'REGH12345678' }
+      raise OSError('PACS went away')
+    stream_search.return_value = results()
+
+    lines = self.read_lines(self.get(limit='5'))
+
+    self.assertEqual(lines, [{ 'search_result': { 'accession_number': 'REGH12345678' } }, { 'status': 'error' }])
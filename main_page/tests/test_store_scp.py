@@ -0,0 +1,216 @@
+import unittest
+from unittest import mock
+
+import os
+import threading
+import zlib
+import numpy as np
+from io import BytesIO
+from pydicom import Dataset, uid, filebase, filewriter
+from pydicom.dataset import FileMetaDataset
+
+import storeSCPserver
+from main_page.libs import dicomlib
+from main_page.libs import enums
+from main_page.libs import move_notifier
+from main_page.libs import server_config
+from main_page.tests import helpers
+
+
+def get_plot():
+  plot = np.full((1080, 1920, 3), 255, dtype=np.uint8)
+  plot[100:500, 200:900] = (0xFB, 0xA0, 0xA0)
+  return plot
+
+
+def create_received_dataset(transfer_syntax: str):
+  """
+  Creates a study as PACS sends it in a transfer syntax
+
+  Returns:
+    The file meta and the dataset encoded in the transfer syntax
+  """
+  ds = helpers.create_study_dataset()
+  ds.Modality = 'OT'
+  ds.SOPClassUID = storeSCPserver.SECONDARY_CAPTURE
+  ds.SOPInstanceUID = uid.generate_uid()
+  ds.add_new(0x00230010, 'LO', 'Clearance Normal')
+
+  if transfer_syntax == uid.RLELossless:
+    dicomlib.try_add_pixeldata(ds, get_plot().tobytes(), encoding=enums.PlotEncoding.RLE)
+  else:
+    dicomlib.try_add_pixeldata(ds, get_plot().tobytes(), encoding=enums.PlotEncoding.RGB)
+
+  file_meta = FileMetaDataset()
+  file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+  file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+  file_meta.TransferSyntaxUID = transfer_syntax
+  file_meta.ImplementationClassUID = uid.PYDICOM_IMPLEMENTATION_UID
+
+  fp = filebase.DicomBytesIO()
+  fp.is_little_endian = True
+  fp.is_implicit_VR = uid.UID(transfer_syntax).is_implicit_VR
+  filewriter.write_dataset(fp, ds)
+  encoded_dataset = fp.getvalue()
+
+  if transfer_syntax == uid.DeflatedExplicitVRLittleEndian:
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    encoded_dataset = compressor.compress(encoded_dataset) + compressor.flush()
+
+  return file_meta, encoded_dataset
+
+
+class SupportedContextsTests(unittest.TestCase):
+  def test_get_supported_contexts(self):
+    contexts = storeSCPserver.get_supported_contexts()
+
+    secondary_captures = [
+      context for context in contexts
+      if context.abstract_syntax == storeSCPserver.SECONDARY_CAPTURE
+    ]
+    self.assertEqual(len(secondary_captures), 1)
+    self.assertIn(uid.ImplicitVRLittleEndian, secondary_captures[0].transfer_syntax)
+    for transfer_syntax in server_config.PACS_STORE_TRANSFER_SYNTAXES:
+      self.assertEqual(
+        transfer_syntax in secondary_captures[0].transfer_syntax,
+        dicomlib.is_decoder_available(transfer_syntax)
+      )
+
+    self.assertEqual(len(contexts), len(storeSCPserver.StoragePresentationContexts))
+
+  def test_get_supported_contexts_decoder_missing(self):
+    with mock.patch('storeSCPserver.dicomlib.is_decoder_available', return_value=False):
+      contexts = storeSCPserver.get_supported_contexts()
+
+    for context in contexts:
+      self.assertNotIn(uid.RLELossless, context.transfer_syntax)
+
+
+class ReceivedSyntaxTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = helpers.use_temp_dir(self)
+    self.writer = storeSCPserver.StoreWriter(1, 1, 60)
+
+  def test_received_syntaxes(self):
+    for transfer_syntax in (uid.RLELossless, uid.DeflatedExplicitVRLittleEndian, uid.ExplicitVRLittleEndian):
+      with self.subTest(transfer_syntax=transfer_syntax):
+        file_meta, encoded_dataset = create_received_dataset(transfer_syntax)
+
+        peeked = dicomlib.peek_tags(encoded_dataset, transfer_syntax, storeSCPserver.PEEK_TAGS)
+        self.assertEqual(peeked.AccessionNumber, 'REGH12345678')
+        self.assertEqual(peeked.Modality, 'OT')
+        self.assertIn(0x00230010, peeked)
+
+        filepath = str(self.tmp_dir / f"{transfer_syntax}.dcm")
+        self.writer.write(filepath, file_meta, encoded_dataset)
+        ds = dicomlib.dcmread_wrapper(filepath)
+
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, transfer_syntax)
+        self.assertEqual(ds.AccessionNumber, 'REGH12345678')
+        self.assertTrue(np.array_equal(dicomlib.get_plot_pixels(ds), get_plot()))
+
+
+class StoreWriterTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = helpers.use_temp_dir(self)
+    self.writer = storeSCPserver.StoreWriter(1, 1, 60)
+    self.file_meta, self.encoded_dataset = create_received_dataset(uid.ExplicitVRLittleEndian)
+    self.filepath = str(self.tmp_dir / 'REGH12345678.7.dcm')
+
+  def start_writer(self):
+    thread = threading.Thread(target=self.writer._write_loop, daemon=True)
+    thread.start()
+
+  def test_write(self):
+    with mock.patch('storeSCPserver.os.replace', wraps=os.replace) as replace:
+      self.writer.write(self.filepath, self.file_meta, self.encoded_dataset)
+
+    # The file is first written to a temporary file, so no one reads it half written
+    replace.assert_called_once_with(f'{self.filepath}.tmp', self.filepath)
+    self.assertEqual(os.listdir(self.tmp_dir), ['REGH12345678.7.dcm'])
+
+    ds = dicomlib.dcmread_wrapper(self.filepath)
+    self.assertEqual(ds.file_meta.TransferSyntaxUID, uid.ExplicitVRLittleEndian)
+    self.assertEqual(ds.AccessionNumber, 'REGH12345678')
+
+  @mock.patch('storeSCPserver.move_notifier')
+  def test_write_loop_notifies(self, move_notifier):
+    notified = threading.Event()
+    # The requester is notified once the file exists
+    move_notifier.notify.side_effect = lambda *args: notified.set() if os.path.exists(self.filepath) else None
+
+    self.start_writer()
+    self.assertTrue(self.writer.put(self.filepath, self.file_meta, self.encoded_dataset, 'REGH12345678', 7))
+
+    self.assertTrue(notified.wait(5))
+    move_notifier.notify.assert_called_once_with('REGH12345678', 7, self.filepath)
+    move_notifier.notify_failure.assert_not_called()
+
+  @mock.patch('storeSCPserver.move_notifier')
+  def test_write_loop_notifies_failure(self, move_notifier):
+    notified = threading.Event()
+    move_notifier.notify_failure.side_effect = lambda *args: notified.set()
+    filepath = str(self.tmp_dir / 'missing' / 'REGH12345678.7.dcm')
+
+    self.start_writer()
+    self.assertTrue(self.writer.put(filepath, self.file_meta, self.encoded_dataset, 'REGH12345678', 7))
+
+    self.assertTrue(notified.wait(5))
+    self.assertEqual(move_notifier.notify_failure.call_args[0][:2], ('REGH12345678', 7))
+    move_notifier.notify.assert_not_called()
+
+  @mock.patch.object(server_config, 'STORE_SCP_QUEUE_TIMEOUT', 0.01)
+  def test_put_full(self):
+    # The writer isn't started, so the queue of one dataset stays full
+    self.assertTrue(self.writer.put(self.filepath, self.file_meta, self.encoded_dataset, 'REGH12345678', 7))
+    self.assertFalse(self.writer.put(self.filepath, self.file_meta, self.encoded_dataset, 'REGH12345678', 8))
+
+
+class OnCStoreTests(unittest.TestCase):
+  def setUp(self):
+    helpers.use_temp_dir(self, 'SEARCH_DIR')
+    self.file_meta, encoded_dataset = create_received_dataset(uid.ExplicitVRLittleEndian)
+    self.event = self.create_event(encoded_dataset)
+
+    store_writer_patch = mock.patch('storeSCPserver.store_writer')
+    self.store_writer = store_writer_patch.start()
+    self.addCleanup(store_writer_patch.stop)
+
+  def create_event(self, encoded_dataset):
+    event = mock.Mock()
+    event.request.DataSet = BytesIO(encoded_dataset)
+    event.request.MoveOriginatorMessageID = 7
+    event.context.transfer_syntax = uid.ExplicitVRLittleEndian
+    event.file_meta = self.file_meta
+    return event
+
+  def test_on_C_STORE(self):
+    self.store_writer.put.return_value = True
+
+    self.assertEqual(storeSCPserver.on_C_STORE(self.event), 0x0000)
+
+    self.store_writer.put.assert_called_once_with(
+      move_notifier.stored_file_path('REGH12345678', 7),
+      self.file_meta,
+      self.event.request.DataSet.getvalue(),
+      'REGH12345678',
+      7
+    )
+
+  def test_on_C_STORE_queue_full(self):
+    self.store_writer.put.return_value = False
+
+    self.assertEqual(storeSCPserver.on_C_STORE(self.event), 0xA700)
+
+  def test_on_C_STORE_no_accession_number(self):
+    ds = Dataset()
+    ds.Modality = 'OT'
+    fp = filebase.DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    filewriter.write_dataset(fp, ds)
+
+    response = storeSCPserver.on_C_STORE(self.create_event(fp.getvalue()))
+
+    self.assertEqual(response.Status, 0xCAFE)
+    self.store_writer.put.assert_not_called()
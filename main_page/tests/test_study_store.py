@@ -0,0 +1,36 @@
+from django.test import TestCase
+
+from main_page.libs import enums
+from main_page.libs import study_store
+from main_page import models
+
+
+class TransitionTests(TestCase):
+  @classmethod
+  def setUpTestData(cls):
+    cls.hospital = models.Hospital.objects.create(name='test_name', short_name='tn')
+    models.Study.objects.create(
+      hospital=cls.hospital,
+      accession_number='REGH12345678',
+      state=enums.StudyState.REGISTERED.value,
+      path='/nonexistent/REGH12345678'
+    )
+
+  def test_transition(self):
+    self.assertTrue(study_store.transition(
+      'tn', 'REGH12345678', enums.StudyState.REGISTERED, enums.StudyState.CONTROL
+    ))
+
+    self.assertTrue(study_store.studies('tn', enums.StudyState.CONTROL, 'REGH12345678').exists())
+
+  def test_transition_wrong_state(self):
+    self.assertFalse(study_store.transition(
+      'tn', 'REGH12345678', enums.StudyState.DELETED, enums.StudyState.REGISTERED
+    ))
+
+    self.assertTrue(study_store.studies('tn', enums.StudyState.REGISTERED, 'REGH12345678').exists())
+
+  def test_transition_other_hospital(self):
+    self.assertFalse(study_store.transition(
+      'other', 'REGH12345678', enums.StudyState.REGISTERED, enums.StudyState.CONTROL
+    ))
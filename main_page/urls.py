@@ -2,7 +2,7 @@ from django.urls import path
 from django.conf.urls import (handler400, handler403, handler404, handler500)
 
 #Sooo WhY do we not just import api at this point?
-from main_page.views.api.api import UserEndpoint, HospitalEndpoint, DepartmentEndpoint, ConfigEndpoint, HandledExaminationsEndpoint, SambaBackupEndpoint, ProcedureEndpoint, ProcedureMappingsEndpoint, StudyEndpoint, CsvEndpoint, SearchEndpoint, ListEndpoint, AddressEndpoint, ServerConfigurationEndpoint, ChangeDepartmentEndpoint
+from main_page.views.api.api import UserEndpoint, HospitalEndpoint, DepartmentEndpoint, ConfigEndpoint, HandledExaminationsEndpoint, SambaBackupEndpoint, ProcedureEndpoint, ProcedureMappingsEndpoint, StudyEndpoint, CsvEndpoint, SearchEndpoint, SearchStreamEndpoint, ControlApprovalEndpoint, ListEndpoint, AddressEndpoint, ServerConfigurationEndpoint, ChangeDepartmentEndpoint, SearchCacheStatisticsEndpoint, PacsOutboxStatusEndpoint, PlotJobEndpoint
 import main_page.views.views as views
 
 
@@ -38,6 +38,9 @@ urlpatterns = [
   
   # New RESTful api design
   path('api/search', SearchEndpoint.as_view(), name='search_api'),
+  path('api/search/stream', SearchStreamEndpoint.as_view(), name='search_stream_api'),
+  path('api/control/approve', ControlApprovalEndpoint.as_view(), name='control_approval_api'),
+  path('api/plot_job/<int:job_id>', PlotJobEndpoint.as_view(), name='plot_job'),
 
   path('api/user', UserEndpoint.as_view(), name='user'),
   path('api/user/<int:obj_id>', UserEndpoint.as_view(), name='user'),
@@ -62,4 +65,6 @@ urlpatterns = [
   path('api/server_config', ServerConfigurationEndpoint.as_view(), name='server_config'),
   path('api/server_config/<int:obj_id>', ServerConfigurationEndpoint.as_view(), name='server_config'),
   path('api/changeDepartment/<int:dep_id>', ChangeDepartmentEndpoint.as_view(), name="change_department"),
+  path('api/search_cache_statistics', SearchCacheStatisticsEndpoint.as_view(), name="search_cache_statistics"),
+  path('api/pacs_outbox_status', PacsOutboxStatusEndpoint.as_view(), name="pacs_outbox_status"),
 ]
@@ -1,5 +1,5 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import FileResponse, QueryDict, HttpResponseNotFound, JsonResponse, HttpResponse, HttpResponseServerError, HttpResponseBadRequest
+from django.http import FileResponse, StreamingHttpResponse, QueryDict, HttpResponseNotFound, JsonResponse, HttpResponse, HttpResponseServerError, HttpResponseBadRequest
 from django.views.generic import View
 from django.core.handlers.wsgi import WSGIRequest
 
@@ -14,9 +14,14 @@ import json
 
 from typing import Type
 
-from main_page.libs.query_wrappers import pacs_query_wrapper as pacs
 from main_page.libs import samba_handler
+from main_page.libs import cache
 from main_page.libs import dicomlib
+from main_page.libs import enums
+from main_page.libs import study_store
+from main_page.libs import search
+from main_page.libs import pacs_outbox
+from main_page.libs import approval
 from main_page.libs import server_config
 from main_page.libs.dirmanager import try_mkdir
 from main_page.libs.status_codes import *
@@ -156,6 +161,28 @@ class ServerConfigurationEndpoint(AdminRequiredMixin, LoginRequiredMixin, RESTEn
     'AE_title'
   ]
 
+class SearchCacheStatisticsEndpoint(AdminRequiredMixin, LoginRequiredMixin, View):
+  def get(self, request):
+    return JsonResponse(cache.get_statistics())
+
+class PacsOutboxStatusEndpoint(AdminRequiredMixin, LoginRequiredMixin, View):
+  def get(self, request):
+    return JsonResponse(pacs_outbox.get_status())
+
+class PlotJobEndpoint(LoginRequiredMixin, View):
+  def get(self, request, job_id):
+    try:
+      job = models.PlotJob.objects.get(id=job_id)
+    except models.PlotJob.DoesNotExist:
+      return HttpResponseNotFound()
+
+    return JsonResponse({
+      'id'              : job.id,
+      'accession_number': job.accession_number,
+      'state'           : enums.PlotJobState(job.state).name,
+      'error'           : job.error,
+    })
+
 class ProcedureMappingsEndpoint(LoginRequiredMixin, RESTEndpoint):
   model = models.Config.accepted_procedures.through # Retreive the underlying relation model
 
@@ -266,11 +293,9 @@ class StudyEndpoint(LoginRequiredMixin, View):
       accession_number: accession number of study to recover
 
     Remark:
-      Places a file named server_config.RECOVERED_FILENAME containing a time-
-      stamp of when the study was recovered. This file is used when checking
-      for auto deletion of studies under list_studies, as to not have
-      recovered files be instantly deleted if their StudyDate has already
-      passed the days threshold.
+      The days a recovered study is kept are counted from the recovery date,
+      as to not have recovered studies be instantly deleted if their StudyDate
+      has already passed the days threshold, see study_store.recover.
     """
     hospital_shortname = request.user.department.hospital.short_name
 
@@ -280,44 +305,13 @@ class StudyEndpoint(LoginRequiredMixin, View):
 
     resp = JsonResponse({ })
 
-    # Attempt to create directory of active studies
-    active_studies_dir = Path(
-      server_config.FIND_RESPONS_DIR,
-      hospital_shortname
-    )
-
-    try_mkdir(str(active_studies_dir), mk_parents=True)
-
-    # Create src and dst paths, then perform move
-    move_src = Path(
-      server_config.DELETED_STUDIES_DIR,
-      hospital_shortname,
-      accession_number
-    )
-
-    move_dst = Path(
-      active_studies_dir,
-      accession_number
-    )
-
-    try:
-      shutil.move(str(move_src), str(move_dst))
-
-      # Create recovery file
-      recover_filepath = Path(
-        move_dst,
-        server_config.RECOVERED_FILENAME
-      )
-
-      with open(recover_filepath, 'w') as fp:
-        fp.write(datetime.now().strftime('%Y%m%d'))
-
+    if study_store.recover(hospital_shortname, accession_number):
       logger.info(
         f"Successfully recovered study w/ accession number: {accession_number}"
       )
-    except (FileNotFoundError, FileExistsError):
+    else:
       logger.error(
-        f"Unable to find dicom object for study to recover: '{move_src}'"
+        f"Unable to find deleted study to recover: '{accession_number}'"
       )
       resp.status_code = HTTP_STATUS_BAD_REQUEST
 
@@ -343,21 +337,7 @@ class StudyEndpoint(LoginRequiredMixin, View):
     if "purge" in request_body:
       if request_body["purge"] == "true":
         # HANDLE COMPLETE PURGE (DELETE STUDY FROM THE SYSTEM)
-        deletion_dir = Path(
-          server_config.DELETED_STUDIES_DIR,
-          user_hosp,
-          accession_number
-        )
-
-        try:
-          # This check if here to prevent anyone from sending a request
-          # containing an accession_number with e.g. "/", that could possibly
-          # remove the / directory of the server
-          if '.' in accession_number or '/' in accession_number:
-            raise FileNotFoundError()
-
-          shutil.rmtree(deletion_dir)
-        except FileNotFoundError:
+        if not study_store.remove(user_hosp, accession_number, enums.StudyState.DELETED):
           resp.status_code = HTTP_STATUS_NO_CONTENT
     else:
       # HANDLE MOVE TO TRASH
@@ -366,33 +346,16 @@ class StudyEndpoint(LoginRequiredMixin, View):
         f"with accession number: {accession_number}"
       )
 
-      # Create deleted studies directory if doesn't exist
-      deletion_dir = Path(
-        server_config.DELETED_STUDIES_DIR,
-        user_hosp
-      )
-      try_mkdir(str(deletion_dir), mk_parents=True)
-
-      # Get src and dst, then move attempt to move
-      move_src = Path(
-        server_config.FIND_RESPONS_DIR,
+      moved = study_store.transition(
         user_hosp,
-        accession_number
+        accession_number,
+        enums.StudyState.REGISTERED,
+        enums.StudyState.DELETED
       )
 
-      move_dst = Path(
-        deletion_dir,
-        accession_number
-      )
-
-      try:
-        shutil.move(str(move_src), str(move_dst))
-
+      if moved:
         logger.info(f"Successfully moved study to trash can: {accession_number}")
-      except (FileNotFoundError, FileExistsError):
-        logger.error(
-          f"Unable to find dicom object for study to move to trash: '{move_src}'"
-        )
+      else:
         resp.status_code = HTTP_STATUS_NO_CONTENT
 
     return resp
@@ -414,18 +377,18 @@ class ListEndpoint(AdminRequiredMixin, LoginRequiredMixin, View):
       pass
 
     if hospital_shortname:
-      del_dir = ""
+      state = None
 
       if 'list_studies' in request_body:
-        del_dir = Path(server_config.FIND_RESPONS_DIR, hospital_shortname)
+        state = enums.StudyState.REGISTERED
       elif 'deleted_studies' in request_body:
-        del_dir = Path(server_config.DELETED_STUDIES_DIR, hospital_shortname)
+        state = enums.StudyState.DELETED
 
-      try:
-        shutil.rmtree(del_dir)
+      if state is not None:
+        accession_numbers = study_store.studies(hospital_shortname, state).values_list('accession_number', flat=True)
+        for accession_number in list(accession_numbers):
+          study_store.remove(hospital_shortname, accession_number, state)
         context['action'] = 'success'
-      except (FileNotFoundError, NotADirectoryError):
-        pass
 
     return JsonResponse(context)
 
@@ -448,7 +411,7 @@ class CsvEndpoint(LoginRequiredMixin, View):
     dataset_file_path = f'{server_config.FIND_RESPONS_DIR}{hospital_sn}/{accession_number}/{accession_number}.dcm'
 
     try:
-      dataset = dicomlib.dcmread_wrapper(dataset_file_path)
+      dataset = dicomlib.dcmread_wrapper(dataset_file_path, use_cache=True)
     except: # Unable to find dicom object
       logger.info(f"Unable to export study to csv for accession number: {accession_number}")
       return HttpResponseNotFound()
@@ -505,28 +468,99 @@ class SearchEndpoint(LoginRequiredMixin, View):
 
     logger.info(f'search_date_from:{search_date_from}, search_date_to:{search_date_to}')
 
-    search_results = pacs.search_query_pacs(
+    # Answer from the archive, PACS is only queried when the client asks for the rest
+    search_response = search.search(
       request.user.department.config,
-      logger,
       name=search_name,
       cpr=search_cpr,
       accession_number=search_accession_number,
       date_from=search_date_from,
       date_to=search_date_to,
+      query_pacs=request.GET.get('pacs') == 'true',
     )
 
-    logger.info(f'search_date_from:{search_date_from}, search_date_to:{search_date_to}')
-
-    # If None as search_results, we got an error
-    if isinstance(search_results, type(None)):
+    # If None as search_response, we got an error
+    if isinstance(search_response, type(None)):
       return HttpResponseServerError()
 
+    search_results, pending = search_response
+
     data = {
-      'search_results': search_results
+      'search_results': search_results,
+      'pending': pending,
     }
 
     return JsonResponse(data)
 
+class SearchStreamEndpoint(LoginRequiredMixin, View):
+  """
+  Handles search requests api, streaming the results as they are found
+
+  The response is newline delimited json, a line with a search result for
+  each result, i.e. {"search_result": {...}}, followed by a line with the
+  status of the search: {"status": "complete" | "limit" | "error"}
+  """
+  def get(self, request):
+    try:
+      limit = min(int(request.GET.get('limit', server_config.SEARCH_STREAM_MAX_RESULTS)), server_config.SEARCH_STREAM_MAX_RESULTS)
+    except ValueError:
+      return HttpResponseBadRequest()
+
+    if limit < 1:
+      return HttpResponseBadRequest()
+
+    search_results = search.stream_search(
+      request.user.department.config,
+      name=request.GET['name'],
+      cpr=request.GET['cpr'],
+      accession_number=request.GET['accession_number'],
+      date_from=request.GET['date_from'],
+      date_to=request.GET['date_to'],
+      limit=limit,
+    )
+
+    def stream():
+      # Closed when the client disconnects, which cancels the PACS query
+      count = 0
+      status = 'complete'
+      try:
+        for search_result in search_results:
+          count += 1
+          yield json.dumps({'search_result': search_result}) + '\n'
+        if count >= limit:
+          status = 'limit'
+      except Exception as e:
+        # The response has already started, so the error is reported in the status line
+        logger.error(f'Failed to stream search results, got exception {e}')
+        status = 'error'
+      finally:
+        search_results.close()
+
+      yield json.dumps({'status': status}) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+class ControlApprovalEndpoint(LoginRequiredMixin, View):
+  """
+  Approves several studies of the control list and sends them to PACS
+
+  The request holds the accession numbers of the studies, 'accession_numbers',
+  and the BAM ID of the approving user, 'bamID'. The response holds the result
+  of each study, see approval.ApprovalResult
+  """
+  def post(self, request):
+    accession_numbers = request.POST.getlist('accession_numbers')
+    bamid = request.POST.get('bamID', '').strip()
+
+    if not accession_numbers or not bamid:
+      return HttpResponseBadRequest()
+
+    results = approval.approve(request.user, accession_numbers, bamid)
+
+    return JsonResponse({
+      'results': [result.to_dict() for result in results]
+    })
+
 class ChangeDepartmentEndpoint(LoginRequiredMixin, View):
   def put(self, request, dep_id):
     target_department = models.Department.objects.get(id=dep_id)
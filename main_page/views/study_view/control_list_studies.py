@@ -23,6 +23,7 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
 from main_page.libs import enums
 from main_page import models
 from main_page import log_util
@@ -38,11 +39,8 @@ class ControlListView(LoginRequiredMixin, TemplateView):
     """  
     current_hospital = request.user.department.hospital.short_name
 
-    hospital_dir = f'{server_config.CONTROL_STUDIES_DIR}{current_hospital}/'
-    try_mkdir(hospital_dir, mk_parents=True)
-    datasets = dicomio.get_studies(hospital_dir)
+    datasets = study_store.list_studies(current_hospital, enums.StudyState.CONTROL)
 
-    datasets = ris.sort_datasets_by_date(datasets)
     #Note that failed dataset should not be able to come here, so we do not need to check if they have failed
     datasets , _ = ris.extract_list_info(datasets)
 
@@ -14,7 +14,6 @@ import datetime
 import logging
 import PIL
 import glob
-import numpy as np
 from pydicom import Dataset
 from pandas import DataFrame
 from typing import Type, List, Tuple, Union, Generator, Dict
@@ -28,6 +27,8 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
+from main_page.libs import approval
 from main_page.libs import enums
 from main_page.forms import base_forms
 from main_page import models
@@ -73,43 +74,24 @@ class ControlView(LoginRequiredMixin, TemplateView):
   def post(self, request, AccessionNumber):
     post_req = request.POST
     hopital_sn = request.user.department.hospital.short_name
-    dir_path = Path(server_config.CONTROL_STUDIES_DIR,hopital_sn, AccessionNumber)
+    dir_path = study_store.get_study_dir(hopital_sn, AccessionNumber)
     file_path = Path(dir_path,f'{AccessionNumber}.dcm')
 
     if post_req['control'] == 'Afvis og rediger':
-      fill_study_dir = Path(server_config.FIND_RESPONS_DIR, hopital_sn, AccessionNumber)
-      if fill_study_dir.exists():
-        shutil.rmtree(fill_study_dir)
-      shutil.move(str(dir_path), str(fill_study_dir))
+      study_store.transition(
+        hopital_sn,
+        AccessionNumber,
+        enums.StudyState.CONTROL,
+        enums.StudyState.REGISTERED
+      )
 
       return redirect('main_page:fill_study', accession_number = AccessionNumber)
     elif post_req['control'] == 'Godkend og send til PACS':
-      file_path   = Path(dir_path,f'{AccessionNumber}.dcm')
-      image_path  = Path(server_config.IMG_RESPONS_DIR,hopital_sn,f"{AccessionNumber}.png")
-
-      dataset = dicomlib.dcmread_wrapper(file_path)
-      bamid = post_req['bamID'].lower().swapcase()
-
-      dicomlib.fill_dicom(dataset, bamid=bamid)
-      dicomlib.save_dicom(file_path, dataset)
-
-      # Send information to PACS
-      success_rate, error_message = pacs.store_dicom_pacs(dataset, request.user)
-      logger.info(f"User:{request.user.username} has stored {AccessionNumber} in PACS")
-      if success_rate:
-        # move the directroy with file + history to cache
-        try:
-          cache_path = Path(server_config.SEARCH_CACHE_DIR, AccessionNumber)
-          shutil.move(str(dir_path), str(cache_path))
-        except OSError as error:
-          logger.error(f'Could not remove directory: {dir_path}')
-        # Store the RIS number in the HandleExaminations table
-        HE = models.HandledExaminations(accession_number=AccessionNumber)
-        HE.save()
-      else:
-        # Try again?
+      # The PACS sender service sends the study, see pacs_outbox
+      result, = approval.approve(request.user, [AccessionNumber], post_req['bamID'], send=False)
+      if not result.queued:
         # Redirect to informative site, telling the user that the connection to PACS is down
-        logger.warn(f'Failed to store {AccessionNumber} in pacs, because:{error_message}')
+        logger.warn(f'Failed to store {AccessionNumber} in pacs, because:{result.error}')
     else:
       logger.error(f'Invalid Post request for control Study {AccessionNumber}')
 
@@ -119,18 +101,16 @@ class ControlView(LoginRequiredMixin, TemplateView):
     hospital   = request.user.department.hospital.short_name
     hopital_sn = request.user.department.hospital.short_name
 
-    filepath = f'{server_config.CONTROL_STUDIES_DIR}{hopital_sn}/{AccessionNumber}/{AccessionNumber}.dcm'
-    dataset = dicomlib.dcmread_wrapper(filepath)
+    filepath = Path(study_store.get_study_dir(hopital_sn, AccessionNumber), f'{AccessionNumber}.dcm')
+    dataset = dicomlib.dcmread_wrapper(filepath, use_cache=True)
     plot_path_full =f'{server_config.IMG_RESPONS_DIR}{hospital}/{AccessionNumber}.png'
     if not os.path.exists(plot_path_full):
       img_resp_dir = f"{server_config.IMG_RESPONS_DIR}{hospital}/"
       try_mkdir(img_resp_dir)
 
-      pixel_arr = np.frombuffer(dataset.PixelData, dtype=np.uint8)
-      pixel_arr = np.reshape(pixel_arr, (1920, 1080, 3))
-      pixel_arr = np.reshape(pixel_arr, (1080, 1920, 3))
+      pixel_arr = dicomlib.get_plot_pixels(dataset)
 
-      if pixel_arr.shape[0] != 0:
+      if pixel_arr is not None:
         Im = PIL.Image.fromarray(pixel_arr)
         Im.save(f'{img_resp_dir}{AccessionNumber}.png')
 
@@ -23,6 +23,7 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
 from main_page.libs import enums
 from main_page import models
 
@@ -35,30 +36,21 @@ class DeletedStudiesView(LoginRequiredMixin, TemplateView):
   """
   Displays any deleted studies.
 
-  A study will only remain deleted for 21 days after which it is permanetly
-  deleted from the server's system
+  A study will only remain deleted for server_config.DELETED_STUDY_DAYS days
+  after which it is permanetly deleted from the server's system by the janitor,
+  see libs/janitor.py
   """
   template_name = "main_page/deleted_studies.html"
 
   def get(self, request: Type[WSGIRequest]) -> HttpResponse:
     hospital_shortname = request.user.department.hospital.short_name
 
-    # Fetch all deleted studies
-    deleted_studies = ris.get_studies(
-      f"{server_config.DELETED_STUDIES_DIR}{hospital_shortname}"
-    )
-
-    # Permantly delete any old studies
-    deleted_studies, _ = ris.check_if_old(
-      deleted_studies,
+    # Fetch all deleted studies, by descending date
+    deleted_studies = study_store.list_studies(
       hospital_shortname,
-      ris.permanent_delete,
-      threshold=21
+      enums.StudyState.DELETED
     )
 
-    # Sort by descending date
-    deleted_studies = ris.sort_datasets_by_date(deleted_studies)
-
     # Extract required booking information
     deleted_studies, _ = ris.extract_list_info(deleted_studies)
 
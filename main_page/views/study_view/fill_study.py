@@ -36,6 +36,7 @@ from main_page.libs import formatting
 from main_page.libs import dicomlib
 from main_page.libs import dicomio
 from main_page.libs import enums
+from main_page.libs import plot_jobs
 from main_page.forms import base_forms
 from main_page import models
 from main_page.libs.clearance_math import clearance_math
@@ -465,7 +466,7 @@ class FillStudyView(LoginRequiredMixin, TemplateView):
       f"{accession_number}.dcm"
     )
 
-    dataset = dicomlib.dcmread_wrapper(obj_filepath)
+    dataset = dicomlib.dcmread_wrapper(obj_filepath, use_cache=True)
 
     # Get previous information for the study
     previous_samples = self.get_previous_samples(dataset)
@@ -476,7 +477,7 @@ class FillStudyView(LoginRequiredMixin, TemplateView):
     # Initialize forms - concat forms into the context
 
     # Get History
-    historic_studies = [study.split('/')[-1].split('.')[0] for study in glob.glob(f'{hospital_dir}/{accession_number}/*') if server_config.RECOVERED_FILENAME not in study]
+    historic_studies = [study.split('/')[-1].split('.')[0] for study in glob.glob(f'{hospital_dir}/{accession_number}/*.dcm')]
     historic_studies = list(filter(lambda study: not(study == accession_number), historic_studies))
     historic_studies = ", ".join(historic_studies)
 
@@ -625,19 +626,27 @@ class FillStudyView(LoginRequiredMixin, TemplateView):
 
       )
 
-      pixel_data = plotting.generate_plot_from_dataset(dataset)
-
-      # Insert plot (as byte string) into dicom object
-      dicomlib.fill_dicom(
-        dataset,
-        pixeldata      = pixel_data
-      )
+      if server_config.PLOT_RENDER_ASYNC:
+        # The plot is rendered by the plot renderer service once the study is saved,
+        # until then the present page waits for it, instead of showing the old plot
+        if 'PixelData' in dataset:
+          del dataset.PixelData
+      else:
+        pixel_data = plotting.generate_plot_from_dataset(dataset)
+
+        # Insert plot (as byte string) into dicom object
+        dicomlib.fill_dicom(
+          dataset,
+          pixeldata      = pixel_data
+        )
     # end "calculate" if
 
     # Save the filled out dataset
     dicomlib.save_dicom(dataset_filepath, dataset)
     # Redirect to correct site based on which action was performed
     if "calculate" in request.POST:
+      if server_config.PLOT_RENDER_ASYNC:
+        plot_jobs.enqueue(accession_number, dataset_filepath)
       return redirect('main_page:present_study', accession_number=accession_number)
     else:
       return redirect('main_page:list_studies')
@@ -23,6 +23,7 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
 from main_page.libs import enums
 from main_page import models
 from main_page import log_util
@@ -46,33 +47,25 @@ class ListStudiesView(LoginRequiredMixin, TemplateView):
       curr_department = UDA.department
     hospital_shortname = curr_department.hospital.short_name
 
-    registered_datasets = ris.get_studies(
-      f"{server_config.FIND_RESPONS_DIR}{hospital_shortname}"
-    )
-
-    # Move 7 day old studies to deleted_studies
-    registered_studies, failed_old = ris.check_if_old(
-      registered_datasets, 
+    # Fetch by descending date, old studies are moved to deleted_studies by the
+    # janitor, see libs/janitor.py
+    registered_datasets = study_store.list_studies(
       hospital_shortname,
-      ris.move_to_deleted
+      enums.StudyState.REGISTERED
     )
-    
+
     # Filter out datasets based on procedure blacklist
     procedure_blacklist = [
       x.type_name for x in curr_department.config.accepted_procedures.all()
     ]
 
     registered_datasets = ris.procedure_filter(
-      registered_studies,
+      registered_datasets,
       procedure_blacklist
     )
 
-    # Sort by descending date
-    registered_datasets = ris.sort_datasets_by_date(registered_datasets)
-
     # Extract required booking information
     registered_studies, failed_studies = ris.extract_list_info(registered_datasets)
-    failed_studies += failed_old
     
     # Report on failed datasets
     failed_accession_nr = [ ]
@@ -112,15 +105,12 @@ class ListStudiesView(LoginRequiredMixin, TemplateView):
     curr_department = request.user.department
     hospital_shortname = curr_department.hospital.short_name
 
-    registered_datasets = ris.get_studies(
-      f"{server_config.FIND_RESPONS_DIR}{hospital_shortname}"
-    )
-      
-    _, _ = ris.check_if_old(
-      registered_datasets, 
-      hospital_shortname,
-      ris.move_to_deleted,
-      threshold=0
-    )
+    for study in study_store.expired(hospital_shortname, enums.StudyState.REGISTERED, 0):
+      study_store.transition(
+        hospital_shortname,
+        study.accession_number,
+        enums.StudyState.REGISTERED,
+        enums.StudyState.DELETED
+      )
 
     return redirect("main_page:list_studies")
@@ -23,6 +23,7 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
 from main_page.libs import enums
 from main_page.libs import ae_controller
 from main_page.forms import base_forms
@@ -52,14 +53,18 @@ def handle_find(dataset, *args, **kwargs ):
     raise Exception('handlefind requires a study_directory as a kwarg')
 
   accession_number = dataset.AccessionNumber
-  ae_controller.send_move(
+  target_file = ae_controller.move_and_wait(
     pacs_move_association,
     serverConfig.AE_title,
     dataset,
-    handle_move,
+    logger=logger
+  )
+  handle_move(
+    dataset,
     logger=logger,
     study_directory=study_directory,
-    accession_number=accession_number
+    accession_number=accession_number,
+    target_file=target_file
   )
 
 
@@ -70,16 +75,19 @@ def handle_move(dataset, *args, **kwargs):
     study_directory = kwargs['study_directory']
   else:
     raise Exception('handlefind requires a study_directory as a kwarg')
-  if 'hospital_sn' in kwargs:
-    hospital_sn = kwargs['hospital_sn']
+  if 'target_file' in kwargs:
+    target_file = kwargs['target_file']
   else:
-    raise Exception('handlefind requires a hospital_sn as a kwargs')
+    raise Exception('handlefind requires a target_file as a kwargs')
   if 'accession_number' in kwargs:
     accession_number = kwargs['accession_number']
 
-  target_file = f"{server_config.SEARCH_DIR}{accession_number}.dcm"
+  if target_file is None:
+    logger.error(f"Could not move {accession_number} from PACS")
+    return
+
   destination = f"{study_directory}{accession_number}.dcm"
-  shutil.move(target_file, destination)
+  shutil.move(str(target_file), destination)
 
 
 class NewStudyView(LoginRequiredMixin, TemplateView):
@@ -126,7 +134,7 @@ class NewStudyView(LoginRequiredMixin, TemplateView):
       study_date = datetime.datetime.strptime(study_date, '%d-%m-%Y').strftime('%Y%m%d')
 
       hospital_sn = request.user.department.hospital.short_name
-      study_directory = f'{server_config.FIND_RESPONS_DIR}{hospital_sn}/{accession_number}/'
+      study_directory = f'{study_store.get_study_dir(hospital_sn, accession_number)}/'
       try_mkdir(study_directory, mk_parents=True)
 
       dataset = dataset_creator.get_blank(
@@ -141,6 +149,7 @@ class NewStudyView(LoginRequiredMixin, TemplateView):
         f'{study_directory}{accession_number}.dcm',
         dataset
       )
+      study_store.register(hospital_sn, accession_number)
 
       # redirect to fill_study/ris_nr
       return redirect('main_page:fill_study', accession_number=accession_number)
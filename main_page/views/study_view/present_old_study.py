@@ -13,7 +13,6 @@ import logging
 import PIL
 import glob
 import pydicom
-import numpy as np
 from pathlib import Path
 from typing import Type, List, Tuple, Union, Generator, Dict
 from pandas import DataFrame
@@ -27,6 +26,8 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import history_store
+from main_page.libs import study_store
 from main_page.libs import enums
 from main_page.libs import cache
 from main_page.libs.clearance_math import clearance_math
@@ -180,11 +181,9 @@ class PresentOldStudyView(LoginRequiredMixin, TemplateView):
     elif 'ImageComments' in dataset:
       study_data += [('Kommentar', dataset.ImageComments)]
 
-    if 'PixelData' in dataset:
+    pixel_arr = dicomlib.get_plot_pixels(dataset)
+    if pixel_arr is not None:
       # Reads DICOM conformant image to PIL displayable image
-      pixel_arr = np.frombuffer(dataset.PixelData, dtype=np.uint8)
-      pixel_arr = np.reshape(pixel_arr, (1080, 1920, 3))
-
       Im = PIL.Image.fromarray(pixel_arr, mode="RGB")
       Im.save(f'{img_resp_dir}{accession_number}.png')
 
@@ -243,10 +242,9 @@ class PresentOldStudyView(LoginRequiredMixin, TemplateView):
     logger.info(f"Recreating {accession_number}")
     current_user = request.user
     hospital_sn  = current_user.department.hospital.short_name
-    active_studies_dir = f'{server_config.FIND_RESPONS_DIR}{hospital_sn}'
-    try_mkdir(active_studies_dir)
     #Retrives Dicom object
-    destination_path = Path(active_studies_dir, accession_number)
+    destination_path = study_store.get_study_dir(hospital_sn, accession_number)
+    try_mkdir(destination_path.parent, mk_parents=True)
     #Remove duplicate
     if destination_path.exists():
       shutil.rmtree(destination_path)
@@ -262,12 +260,17 @@ class PresentOldStudyView(LoginRequiredMixin, TemplateView):
       #New UID maybe, could build it into Series Number function
       )
     dicomlib.save_dicom(f'{str(destination_path)}/{dataset.AccessionNumber}.dcm', dataset)
+    study_store.register(hospital_sn, accession_number)
     #Retrives History
     if 'clearancehistory' in dataset:
       for study in dataset.clearancehistory:
         history_path = Path(destination_path, f'{study.AccessionNumber}.dcm')
         if not(history_path.exists()):
-          _ , path_to_dataset = pacs.get_study(current_user, study.AccessionNumber)
-          shutil.move(str(path_to_dataset), str(history_path))
+          history_dataset, path_to_dataset = pacs.get_study(current_user, study.AccessionNumber)
+          if history_dataset is None:
+            logger.error(f'Could not retrieve historic study {study.AccessionNumber}')
+            continue
+          history_store.link(history_store.ingest(path_to_dataset), [destination_path], history_path.name)
+      history_store.write_history_summary(destination_path)
 
     return redirect('main_page:fill_study', accession_number = accession_number)
@@ -6,7 +6,6 @@ from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.core.handlers.wsgi import WSGIRequest
 
-import numpy as np
 from pathlib import Path
 import shutil
 import os
@@ -25,7 +24,9 @@ from main_page.libs import server_config
 from main_page.libs import samba_handler
 from main_page.libs import formatting
 from main_page.libs import dicomlib
+from main_page.libs import study_store
 from main_page.libs import enums
+from main_page.libs import plot_jobs
 from main_page import models
 
 # Custom type
@@ -54,7 +55,7 @@ class PresentStudyView(LoginRequiredMixin, TemplateView):
       hospital,
       accession_number,
       f"{accession_number}.dcm"
-    ))
+    ), use_cache=True)
 
     # Determine whether QA plot should be displayable - i.e. the study has multiple
     # test values
@@ -66,11 +67,8 @@ class PresentStudyView(LoginRequiredMixin, TemplateView):
     img_resp_dir = f"{server_config.IMG_RESPONS_DIR}{hospital}/"
     try_mkdir(img_resp_dir)
 
-    pixel_data = dataset.get("PixelData")
-    if pixel_data:
-      pixel_data = np.frombuffer(dataset.PixelData, dtype=np.uint8)
-      pixel_data = np.reshape(pixel_data, (1080, 1920, 3)) # Reshape to presentable shape
-
+    pixel_data = dicomlib.get_plot_pixels(dataset)
+    if pixel_data is not None:
       img = PIL.Image.fromarray(pixel_data)
       img.save(Path(
         img_resp_dir,
@@ -79,6 +77,11 @@ class PresentStudyView(LoginRequiredMixin, TemplateView):
 
     plot_path = f"main_page/images/{hospital}/{accession_number}.png" 
 
+    # The plot is being rendered by the plot renderer service, see FillStudyView
+    plot_job = plot_jobs.get_latest(accession_number)
+    if plot_job and plot_job.state == enums.PlotJobState.DONE.value:
+      plot_job = None
+
     context = {
       'title'     : server_config.SERVER_NAME,
       'version'   : server_config.SERVER_VERSION,
@@ -87,6 +90,8 @@ class PresentStudyView(LoginRequiredMixin, TemplateView):
       'accession_number': accession_number,
       'image_path': plot_path,
       'show_QA_button': show_QA_button,
+      'plot_job': plot_job,
+      'plot_job_failed': plot_job is not None and plot_job.state == enums.PlotJobState.FAILED.value,
     }
 
     return render(request, self.template_name, context=context)
@@ -95,14 +100,12 @@ class PresentStudyView(LoginRequiredMixin, TemplateView):
     # Send information to PACS
     hosp_sn = request.user.department.hospital.short_name
 
-    control_dir = f"{server_config.CONTROL_STUDIES_DIR}{hosp_sn}/{accession_number}/"
-    obj_dir     = f"{server_config.FIND_RESPONS_DIR}{hosp_sn}/{accession_number}/"
-    
-    # Remove the file + history
-    try:
-      shutil.move(obj_dir, control_dir)
-      logger.debug(f"Successfully moved {obj_dir} to {control_dir}")
-    except OSError as error:
-      logger.error(f'Could not remove directory: {obj_dir} to {control_dir}')
-  
+    # Send the study to control
+    study_store.transition(
+      hosp_sn,
+      accession_number,
+      enums.StudyState.REGISTERED,
+      enums.StudyState.CONTROL
+    )
+
     return redirect('main_page:list_studies')
\ No newline at end of file
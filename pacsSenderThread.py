@@ -0,0 +1,19 @@
+import logging
+import os
+import django
+
+# Init Django, note this is needed before you import django such as models.
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'clairvoyance.settings')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'clairvoyance.settings'
+    django.setup()
+
+from main_page.libs import pacs_outbox
+
+# Create a logger just for the PACS sender
+logger = logging.getLogger("PacsSender")
+
+
+if __name__ == "__main__":
+  logger.info("Starting PACS sender service")
+  pacs_outbox.run()
@@ -0,0 +1,19 @@
+import logging
+import os
+import django
+
+# Init Django, note this is needed before you import django such as models.
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'clairvoyance.settings')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'clairvoyance.settings'
+    django.setup()
+
+from main_page.libs import plot_jobs
+
+# Create a logger just for the plot renderer
+logger = logging.getLogger("PlotRenderer")
+
+
+if __name__ == "__main__":
+  logger.info("Starting plot renderer service")
+  plot_jobs.run()
@@ -9,22 +9,31 @@ if __name__ == "__main__":
     django.setup()
 
 
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from datetime import date, timedelta
 from pathlib import Path
 from pydicom import Dataset
+from pynetdicom.association import Association
 
 import random
 import shutil
+import threading
 import time
 
-from typing import Dict, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.db import connection
 
 from main_page.libs import cache
 from main_page.libs import dicomlib
+from main_page.libs import history_store
+from main_page.libs import janitor
+from main_page.libs import study_store
 from main_page.libs import server_config
 from main_page.libs import ae_controller
 from main_page.libs import dataset_creator
-from main_page.models import ServerConfiguration, Department, HandledExaminations, Hospital
+from main_page.models import ServerConfiguration, Department, HandledExaminations, Hospital, RisPollWatermark
 from main_page.libs.dirmanager import try_mkdir
 from main_page.libs.status_codes import DATASET_AVAILABLE, TRANSFER_COMPLETE
 
@@ -41,7 +50,31 @@ class RisFetcher():
     self.get_history = get_history
     self.delay_min = server_config.SLEEP_DELAY_MIN
     self.delay_max = server_config.SLEEP_DELAY_MAX
-    self.failed_datasets: Dict[str,Tuple[Dataset,Path]] = {}
+    self.workers = self.get_worker_count()
+    # Historic studies retrieved in the current cycle, shared between the workers
+    self.history_lock = threading.Lock()
+    self.history_files: Dict[str, Path] = {}
+
+  def get_worker_count(self) -> int:
+    """Gets the number of departments to poll concurrently
+
+    Each worker borrows two associations to PACS, see associate, so at most
+    half of ASSOCIATION_POOL_MAX_PER_PEER workers can poll departments sharing
+    a PACS at once. More workers would wait for each other, and be skipped
+    once the pool times out, so the worker count is capped at that.
+
+    Returns:
+        int: RIS_FETCHER_WORKERS, capped at half of ASSOCIATION_POOL_MAX_PER_PEER
+    """
+    max_workers = max(server_config.ASSOCIATION_POOL_MAX_PER_PEER // 2, 1)
+    if server_config.RIS_FETCHER_WORKERS > max_workers:
+      logger.error(
+        f"RIS_FETCHER_WORKERS ({server_config.RIS_FETCHER_WORKERS}) exceeds half of "
+        f"ASSOCIATION_POOL_MAX_PER_PEER ({server_config.ASSOCIATION_POOL_MAX_PER_PEER}), using {max_workers} workers"
+      )
+      return max_workers
+
+    return server_config.RIS_FETCHER_WORKERS
 
   def delete_old_handled_studies(self):
     """
@@ -115,108 +148,161 @@ class RisFetcher():
       valid_dataset = False
     return valid_dataset
 
-  def associate(self, department: Department):
-    """Creates the associations nessesary for sending a find query
+  @contextmanager
+  def associate(self, department: Department) -> Iterator[Optional[Tuple[Association, Association, Association]]]:
+    """Borrows the associations nessesary for sending a find query from the association pool
 
     Args:
-        department (Department): _description_
+        department (Department): The department to create associations for
 
-    Returns:
-        bool : If the connection were successful or not
+    Yields:
+        Tuple of the RIS find, PACS find and PACS move associations, or None
+        if any of the connections failed. The associations are handed back
+        to the pool when the with-block exits.
     """
-    self.ris_assoc = ae_controller.establish_assoc(
-      ae_controller.create_find_AE_worklist(department.config.ris_calling),
-      department.config.ris.ip,
-      department.config.ris.port,
-      department.config.ris.ae_title,
-      logger
-    )
-
-    self.pacs_find_assoc = ae_controller.establish_assoc(
-      ae_controller.create_find_AE_study(self.sc.AE_title),
-      department.config.storage.ip,
-      department.config.storage.port,
-      department.config.storage.ae_title,
-      logger
-    )
-    self.pacs_move_assoc = ae_controller.establish_assoc(
-      ae_controller.create_move_AE(self.sc.AE_title),
-      department.config.storage.ip,
-      department.config.storage.port,
-      department.config.storage.ae_title,
-      logger
-    )
-    # Validate connections
-    fully_connected = True
-    if self.ris_assoc is None or not self.ris_assoc.is_established:
-      fully_connected = False
-    if self.pacs_find_assoc is None or not self.pacs_find_assoc.is_established:
-      fully_connected = False
-    if self.pacs_move_assoc is None or not self.pacs_move_assoc.is_established:
-      fully_connected = False
-    if not fully_connected:
-      if self.ris_assoc != None and self.ris_assoc.is_established: # If this connected release the connection
-        self.ris_assoc.release()
-      if self.pacs_find_assoc != None and self.pacs_find_assoc.is_established:
-        self.pacs_find_assoc.release()
-      if self.pacs_move_assoc != None and self.pacs_move_assoc.is_established:
-        self.pacs_move_assoc.release()
-
-    return fully_connected
-
-  def move_dataset(self, historic_dataset : Dataset, dataset_dir : Path):
-    target_file = Path(f"{server_config.SEARCH_DIR}{historic_dataset.AccessionNumber}.dcm")
-    destination = dataset_dir / f"{historic_dataset.AccessionNumber}.dcm"
-
-    if target_file.exists():
-      shutil.move(target_file, destination)
-    else:
-      logger.error(f"Historic dataset not found for Accession Number: {historic_dataset.AccessionNumber}")
-
-  def get_historic_dataset(self, historic_dataset : Dataset, dataset_dir : Path):
-    response = self.pacs_move_assoc.send_c_move(historic_dataset, self.sc.AE_title, StudyRootQueryRetrieveInformationModelMove)
-    for status, identifier in response:
-      if 'Status' in status:
-        if status.Status == DATASET_AVAILABLE:
-          pass
-        elif status.Status == TRANSFER_COMPLETE:
-          self.move_dataset(historic_dataset, dataset_dir)
-        else:
-          self.log_dicom_message_error('Query Historic ', status, historic_dataset)
+    with ExitStack() as stack:
+      ris_assoc = stack.enter_context(ae_controller.association_pool.borrow(
+        department.config.ris_calling,
+        department.config.ris.ip,
+        department.config.ris.port,
+        department.config.ris.ae_title,
+        [ModalityWorklistInformationFind],
+        logger
+      ))
+
+      # The PACS associations are borrowed together, such that workers
+      # holding one of them can't block each other waiting for the other
+      pacs_assocs = stack.enter_context(ae_controller.association_pool.borrow_several(
+        self.sc.AE_title,
+        department.config.storage.ip,
+        department.config.storage.port,
+        department.config.storage.ae_title,
+        [[StudyRootQueryRetrieveInformationModelFind], [StudyRootQueryRetrieveInformationModelMove]],
+        logger
+      ))
+
+      # Validate connections
+      if ris_assoc is None or pacs_assocs is None:
+        yield None
       else:
-        logger.error(f'Dataset does not have status attribute\n Status:\n{status}')
+        pacs_find_assoc, pacs_move_assoc = pacs_assocs
+        yield (ris_assoc, pacs_find_assoc, pacs_move_assoc)
+
+  def get_historic_dataset(self, historic_dataset : Dataset, dataset_dirs : List[Path], pacs_move_assoc: Association) -> None:
+    accession_number = historic_dataset.AccessionNumber
 
+    # Another study in this cycle might have needed the same historic study
+    with self.history_lock:
+      stored_file = self.history_files.get(accession_number)
 
-  def fetch_history(self, dataset: Dataset, dataset_dir : Path) -> None:
-    history_queryDataset = dataset_creator.create_search_dataset('',dataset.PatientID, '','', '')
-    response = self.pacs_find_assoc.send_c_find(history_queryDataset, StudyRootQueryRetrieveInformationModelFind)
-    logger.debug("Fetching history")
+    if stored_file is None or not stored_file.exists():
+      target_file = ae_controller.move_and_wait(pacs_move_assoc, self.sc.AE_title, historic_dataset, logger=logger)
+      if target_file is None:
+        logger.error(f"Historic dataset not found for Accession Number: {accession_number}")
+        return
+
+      stored_file = history_store.ingest(target_file)
+      with self.history_lock:
+        self.history_files[accession_number] = stored_file
+
+    history_store.link(stored_file, dataset_dirs, f"{accession_number}.dcm")
+
+  def find_history(self, patient_id : str, pacs_find_assoc: Association) -> List[Dataset]:
+    """Finds the historic clearance studies of a patient
+
+    Args:
+        patient_id (str): CPR number of the patient
+        pacs_find_assoc (Association): Association to PACS for the find query
+
+    Returns:
+        List[Dataset]: Identifiers of the historic studies, ready for a C-MOVE
+    """
+    history_queryDataset = dataset_creator.create_search_dataset('', patient_id, '','', '')
+    response = pacs_find_assoc.send_c_find(history_queryDataset, StudyRootQueryRetrieveInformationModelFind)
+    historic_datasets = []
     for status, historic_dataset in response:
       if 'Status' in status:
         if status.Status == DATASET_AVAILABLE:
           if 'SeriesDescription' in historic_dataset and historic_dataset.SeriesDescription.startswith('Clearance'):
-            self.get_historic_dataset(historic_dataset, dataset_dir)
+            historic_datasets.append(historic_dataset)
         elif status.Status == TRANSFER_COMPLETE:
           pass
         else:
           self.log_dicom_message_error('Query Historic ', status, history_queryDataset)
-
       else:
-        logger.error(f"Failed finding historic dataset with Accession Number: {dataset.AccessionNumber}")
+        logger.error(f"Failed finding historic datasets for patient: {patient_id}")
+
+    return historic_datasets
+
+  def fetch_history(self,
+      pending_history: Dict[str, List[Path]],
+      pacs_find_assoc: Association,
+      pacs_move_assoc: Association
+    ) -> Dict[str, List[Path]]:
+    """Retrieves the history of all new studies in a poll
+
+    All patients are looked up first, afterwards every historic study is
+    moved once, stored in the history store and linked into each study
+    directory of the patient. This way a patient with several bookings only
+    costs a single find query, and a historic study already retrieved this
+    cycle isn't moved again. Finally the history of each study is summarised,
+    see history_store.write_history_summary.
 
+    Args:
+        pending_history (Dict[str, List[Path]]): Study directories needing history, by PatientID
+        pacs_find_assoc (Association): Association to PACS for the find queries
+        pacs_move_assoc (Association): Association to PACS for the move queries
+
+    Returns:
+        Dict[str, List[Path]]: The part of pending_history which failed, and should be retried
+    """
+    failed_history: Dict[str, List[Path]] = {}
 
-  def handle_ris_dataset(self, dataset : Dataset, department : Department) -> None:
+    logger.debug(f"Fetching history for {len(pending_history)} patients")
+    historic_studies: Dict[str, Tuple[Dataset, str]] = {}
+    for patient_id, dataset_dirs in pending_history.items():
+      try:
+        for historic_dataset in self.find_history(patient_id, pacs_find_assoc):
+          historic_studies[historic_dataset.AccessionNumber] = (historic_dataset, patient_id)
+      except Exception as e:
+        logger.error(f"Failed to find history for {dataset_dirs}, got exception {e}")
+        failed_history[patient_id] = dataset_dirs
+
+    for historic_dataset, patient_id in historic_studies.values():
+      if patient_id in failed_history:
+        continue
+      try:
+        self.get_historic_dataset(historic_dataset, pending_history[patient_id], pacs_move_assoc)
+      except Exception as e:
+        logger.error(f"Failed to retrieve historic study {historic_dataset.AccessionNumber}, got exception {e}")
+        failed_history[patient_id] = pending_history[patient_id]
+
+    # Summarise the history once it's complete, such that calculating a study doesn't read it
+    for patient_id, dataset_dirs in pending_history.items():
+      if patient_id in failed_history:
+        continue
+      for dataset_dir in dataset_dirs:
+        if dataset_dir.exists():
+          history_store.write_history_summary(dataset_dir)
+
+    return failed_history
+
+  def handle_ris_dataset(self,
+      dataset : Dataset,
+      department : Department,
+      pending_history: Dict[str, List[Path]]
+    ) -> None:
     if not self.validate_dataset(dataset):
       logger.error(f"Invalid Dataset:{dataset}")
       return
 
-    dataset_dir = Path(f"{server_config.FIND_RESPONS_DIR}{department.hospital.short_name}/{dataset.AccessionNumber}/")
-    delete_dir = Path(f"{server_config.DELETED_STUDIES_DIR}{department.hospital.short_name}/{dataset.AccessionNumber}/")
+    hospital_shortname = department.hospital.short_name
+    dataset_dir = study_store.get_study_dir(hospital_shortname, dataset.AccessionNumber)
 
-    if dataset.AccessionNumber in self.handled_examinations or dataset_dir.exists() or delete_dir.exists():
-      logger.debug(f"Handled examinations: {self.handled_examinations}")
-      logger.debug(f"Path: {dataset_dir} - exists: {dataset_dir.exists()}")
-      logger.debug(f"Path: {delete_dir} - exists: {delete_dir.exists()}")
+    # Studies in any state are skipped, registered, in control or deleted
+    if dataset.AccessionNumber in self.handled_examinations or dataset_dir.exists() \
+        or study_store.studies(hospital_shortname, accession_number=dataset.AccessionNumber).exists():
+      logger.debug(f"Skipping known study: {dataset.AccessionNumber}")
       return
 
     dataset_dir.mkdir(parents=True, exist_ok=True)
@@ -227,13 +313,10 @@ class RisFetcher():
       logger.error(f"Failed to save dicom file at {file_path}, got exception {e}")
       shutil.rmtree(dataset_dir)
       return
+    study_store.register(hospital_shortname, dataset.AccessionNumber)
 
-    if self.get_history: # Fetches the history of datasets
-      try:
-        self.fetch_history(dataset, dataset_dir)
-      except:
-        logger.error(f"Failed to fetch history from {dataset.AccessionNumber}")
-        self.failed_datasets[dataset.AccessionNumber] = (dataset, dataset_dir)
+    if self.get_history: # The history is fetched once the entire response is handled
+      pending_history.setdefault(dataset.PatientID, []).append(dataset_dir)
     else:
       logger.info("Skipping fetching history")
 
@@ -242,64 +325,156 @@ class RisFetcher():
     logger.error(f"Response Message {message_response}")
     logger.error(f"query message {query_dataset}")
 
+  def get_query_start(self, department: Department) -> Optional[date]:
+    """Finds the first date RIS should be queried from for a department
+
+    Args:
+        department (Department): The department to be polled
+
+    Returns:
+        The date of the last successful poll minus the look back, or None if
+        the department have never been polled, i.e. the query is open ended.
+
+    Remark:
+        The look back catches studies which are booked in RIS after their
+        scheduled date have already been polled.
+    """
+    try:
+      watermark = RisPollWatermark.objects.get(department=department)
+    except RisPollWatermark.DoesNotExist:
+      return None
+
+    return watermark.last_poll - timedelta(days=server_config.RIS_LOOKBACK_DAYS)
+
+  def poll_department(self, department: Department) -> None:
+    """Queries RIS for a single department and fetches history for new studies
+
+    This is the unit of work of the worker pool, so everything that belongs
+    to a department, its borrowed associations and its pending history
+    retrievals, is local to this call.
+
+    Args:
+        department (Department): The department to poll
+    """
+    # Validate Config
+    if not self.validate_department(department): # Logging happens inside of Validate Department
+      return
+
+    pending_history: Dict[str, List[Path]] = {}
+    failed_history: Dict[str, List[Path]] = {}
+
+    # Create associations
+    with self.associate(department) as associations:
+      if associations is None:
+        logger.error(f"Skipping {department}, unable to borrow associations to its RIS and PACS")
+        return
+      ris_assoc, pacs_find_assoc, pacs_move_assoc = associations
+
+      # Do the pull request, only for the window which can contain new studies
+      poll_date = date.today()
+      query_dataset = dataset_creator.generate_ris_query_dataset(
+        department.config.ris_calling,
+        date_from=self.get_query_start(department),
+        date_to=poll_date
+      )
+
+      query_completed = False
+      response = ris_assoc.send_c_find(query_dataset, ModalityWorklistInformationFind)
+      for status, dataset in response:
+        if 'Status' in status:
+          if status.Status == DATASET_AVAILABLE:
+            self.handle_ris_dataset(dataset, department, pending_history)
+          elif status.Status == TRANSFER_COMPLETE:
+            logger.debug(f"Handled response to {department}")
+            query_completed = True # The Transfer is compelete and the associations can be handed back.
+          else:
+            self.log_dicom_message_error('Query RIS', status, query_dataset)
+
+      if pending_history:
+        failed_history = self.fetch_history(pending_history, pacs_find_assoc, pacs_move_assoc)
+
+    # Only move the watermark if RIS answered the entire query, otherwise the window is retried next cycle
+    if query_completed:
+      RisPollWatermark.objects.update_or_create(
+        department=department,
+        defaults={'last_poll': poll_date}
+      )
+
+    # Retry with fresh associations, the pool probes the old ones before they are reused
+    attempts = 0
+    while failed_history and attempts < 3:
+      time.sleep(1)
+      with self.associate(department) as associations:
+        if associations is not None:
+          _, pacs_find_assoc, pacs_move_assoc = associations
+          failed_history = self.fetch_history(failed_history, pacs_find_assoc, pacs_move_assoc)
+      attempts += 1
+
+    for dataset_dirs in failed_history.values():
+      logger.error(f"Failed to retrieve history for {dataset_dirs}")
+
+  def poll_department_worker(self, department: Department) -> None:
+    """Runs poll_department inside a worker thread
+
+    Failures are contained to the department, such that one misbehaving
+    department doesn't stop the remaining departments from being polled.
+
+    Args:
+        department (Department): The department to poll
+    """
+    try:
+      self.poll_department(department)
+    except Exception as e:
+      logger.error(f"Failed to poll {department}, got exception {e}")
+    finally:
+      # Django opens a database connection per thread, which must be closed by the thread
+      connection.close()
+
+  def import_old_studies(self) -> None:
+    """Indexes the studies saved before the study index, see study_store.rebuild_index
+
+    Remark:
+        This must be done before the first poll, as the open ended query of a
+        department without a watermark would otherwise register the studies
+        in the old directories again.
+    """
+    indexed, removed = study_store.rebuild_index()
+    logger.info(f"Indexed {indexed} studies, removed {removed} rows of missing studies")
+
   def run(self) -> None:
     date_last_iteration = date.today().day - 1
+    self.import_old_studies()
     while True:
       logger.info("Starting RIS Fetcher service")
       # Get Data from database to do a fetch from ris
       self.sc = ServerConfiguration.objects.get(pk=1)
       self.handled_examinations = { he.accession_number : he.handle_day
         for he in HandledExaminations.objects.all() }
-
-      for department in Department.objects.all():
-        # Validate Config
-        if not self.validate_department(department): # Logging happens inside of Validate Department
-          continue
-
-        # Create associations
-        if not self.associate(department): # This function set self.ris_assoc, self.pacs_find_assoc, self.pacs_move_assoc
-          continue
-        # Do the pull request
-        query_dataset = dataset_creator.generate_ris_query_dataset(department.config.ris_calling)
-
-        response = self.ris_assoc.send_c_find(query_dataset, ModalityWorklistInformationFind)
-        for status, dataset in response:
-          if 'Status' in status:
-            if status.Status == DATASET_AVAILABLE:
-              self.handle_ris_dataset(dataset, department)
-            elif status.Status == TRANSFER_COMPLETE:
-              logger.debug(f"Handled response to {department}")
-              pass # The Transfer is compelete and the association can not be closed.
-            else:
-              self.log_dicom_message_error('Query RIS', status, query_dataset)
-
-        for dataset, dataset_dir in self.failed_datasets.values():
-          attempts = 0
-          while attempts < 3:
-            if self.associate(department):
-              try:
-                self.fetch_history(dataset, dataset_dir)
-                break
-              except:
-                logger.error(f"Failed to retrieve history for {dataset.AccessionNumber}")
-                time.sleep(1)
-            attempts += 1
-
-        self.failed_datasets = {}
-
-        # Free connections
-        if self.ris_assoc is not None:
-          self.ris_assoc.release()
-        if self.pacs_find_assoc is not None:
-          self.pacs_find_assoc.release()
-        if self.pacs_move_assoc is not None:
-          self.pacs_move_assoc.release()
-      #End of Department for loop
+      with self.history_lock:
+        self.history_files = {}
+
+      # Each department is polled by its own worker, so the cycle only takes as
+      # long as the slowest department rather than the sum of all of them.
+      cycle_start = time.monotonic()
+      departments = list(Department.objects.all())
+      with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="RisWorker") as executor:
+        futures = [executor.submit(self.poll_department_worker, department) for department in departments]
+        for future in as_completed(futures):
+          future.result()
+      logger.info(f"Polled {len(departments)} departments in {time.monotonic() - cycle_start:.2f} sec.")
+      #End of Department polling
+
+      # Age and purge studies, such that the study lists don't have to
+      try:
+        janitor.run()
+      except Exception as e:
+        logger.error(f"Janitor failed, got exception {e}")
 
       today = date.today().day #mabye just save the entire object. But muh bytes
       if today != date_last_iteration:
         #logger.info('Cleaning Cache and Image directory')
         cache.clean_cache(14)
+        history_store.collect_garbage()
         self.delete_old_images()
         self.delete_old_handled_studies()
       date_last_iteration = today
@@ -36,7 +36,7 @@ done
 omit_str="./venv/*,./main_page/migrations/*,./manage.py,*__init__.py,./key.py,./main_page/libs/server_config.py,./clairvoyance/*,main_page/tests*"
 base_test_cmd="coverage run --source='.' --omit='"
 
-tests="main_page.tests.test_dataset_creator main_page.tests.test_formatting main_page.tests.test_clearance_math main_page.tests.test_dicomlib"
+tests="main_page.tests.test_dataset_creator main_page.tests.test_formatting main_page.tests.test_clearance_math main_page.tests.test_dicomlib main_page.tests.test_move_notifier main_page.tests.test_janitor main_page.tests.test_study_store main_page.tests.test_history_store main_page.tests.test_archive main_page.tests.test_search main_page.tests.test_query_cache main_page.tests.test_pacs_outbox main_page.tests.test_approval main_page.tests.test_plot_jobs main_page.tests.test_ae_controller main_page.tests.test_store_scp main_page.tests.test_cache"
 selenium_tests="main_page.tests.test_fill_study"
 verbose=""
 verbose_enabled=1
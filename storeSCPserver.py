@@ -3,6 +3,8 @@ from django.core.exceptions import ObjectDoesNotExist
 
 import os
 import logging
+import queue
+import threading
 import time
 
 
@@ -13,40 +15,201 @@ if __name__ == "__main__":
 
 
 from pydicom import Dataset
-from pynetdicom import AE, StoragePresentationContexts, evt
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, StoragePresentationContexts, build_context, evt
 
 from config import server_log_file_path
 
 from main_page.models import ServerConfiguration
 from main_page.libs import server_config
 from main_page.libs import dicomlib
+from main_page.libs import move_notifier
 
 logger = logging.getLogger(__name__)
 
 
 
 
+class StoreWriter():
+  """
+    Write-behind pipeline for received datasets
+
+    The C-STORE handler only puts the encoded dataset on a bounded queue and
+    returns, a pool of writer threads writes the bytes to disk as received,
+    i.e. without decoding and encoding the dataset again. This way a burst of
+    C-STOREs from a C-MOVE isn't slowed down by the disk.
+
+    Remark:
+      Since the file is written after the C-STORE response is sent, the
+      requester of a C-MOVE is notified by the writer, once the file exists
+      or the write failed.
+  """
+  def __init__(self, workers: int, max_queue_size: int, report_interval: float):
+    self.queue = queue.Queue(maxsize=max_queue_size)
+    self.workers = workers
+    self.report_interval = report_interval
+
+    self._stats_lock = threading.Lock()
+    self._written = 0
+    self._failed = 0
+    self._write_time = 0.0
+    self._max_write_time = 0.0
+    self._max_latency = 0.0
+
+  def start(self):
+    for i in range(self.workers):
+      threading.Thread(target=self._write_loop, name=f"StoreWriter-{i}", daemon=True).start()
+    threading.Thread(target=self._report_loop, name="StoreWriterReport", daemon=True).start()
+
+  def put(self, filepath, file_meta, encoded_dataset: bytes, accession_number: str, message_id) -> bool:
+    """
+      Queues a dataset for writing
+
+      Returns:
+        False if the queue stayed full for STORE_SCP_QUEUE_TIMEOUT seconds
+    """
+    try:
+      self.queue.put(
+        (filepath, file_meta, encoded_dataset, accession_number, message_id, time.monotonic()),
+        timeout=server_config.STORE_SCP_QUEUE_TIMEOUT
+      )
+    except queue.Full:
+      return False
+    return True
+
+  def write(self, filepath, file_meta, encoded_dataset: bytes) -> None:
+    # Write to a temporary file first, so no one reads a partially written file
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, 'wb') as fp:
+      fp.write(b'\x00' * 128)
+      fp.write(b'DICM')
+      write_file_meta_info(fp, file_meta, enforce_standard=True)
+      fp.write(encoded_dataset)
+    os.replace(tmp_filepath, filepath)
+
+  def _write_loop(self):
+    while True:
+      filepath, file_meta, encoded_dataset, accession_number, message_id, queued_at = self.queue.get()
+      write_start = time.monotonic()
+      try:
+        self.write(filepath, file_meta, encoded_dataset)
+      except Exception as e:
+        logger.error(f'Failed to write {filepath}, got exception {e}')
+        with self._stats_lock:
+          self._failed += 1
+        if message_id is not None:
+          move_notifier.notify_failure(accession_number, message_id, f'Failed to write {filepath}, got exception {e}')
+        continue
+      finally:
+        self.queue.task_done()
+
+      if message_id is not None:
+        move_notifier.notify(accession_number, message_id, filepath)
+
+      done = time.monotonic()
+      with self._stats_lock:
+        self._written += 1
+        self._write_time += done - write_start
+        self._max_write_time = max(self._max_write_time, done - write_start)
+        self._max_latency = max(self._max_latency, done - queued_at)
+
+  def _report_loop(self):
+    while True:
+      time.sleep(self.report_interval)
+      with self._stats_lock:
+        written, failed = self._written, self._failed
+        average_write_time = self._write_time / written if written else 0.0
+        max_write_time, max_latency = self._max_write_time, self._max_latency
+        self._written = self._failed = 0
+        self._write_time = self._max_write_time = self._max_latency = 0.0
+
+      if written or failed or self.queue.qsize():
+        logger.info(
+          f'Store writer: queue depth {self.queue.qsize()}/{self.queue.maxsize}, '
+          f'wrote {written} files ({failed} failed), '
+          f'write time avg {average_write_time * 1000:.1f} ms max {max_write_time * 1000:.1f} ms, '
+          f'max latency from C-STORE {max_latency * 1000:.1f} ms'
+        )
+
+
+store_writer = StoreWriter(
+  server_config.STORE_SCP_WRITERS,
+  server_config.STORE_SCP_QUEUE_SIZE,
+  server_config.STORE_SCP_REPORT_INTERVAL
+)
+
+
+# Studies are received as secondary captures
+SECONDARY_CAPTURE = '1.2.840.10008.5.1.4.1.1.7'
+
+def get_supported_contexts():
+  """
+    Returns:
+      The storage presentation contexts of pynetdicom, where the secondary
+      capture context also accepts the transfer syntaxes studies are sent to
+      PACS in, see PACS_STORE_TRANSFER_SYNTAXES, such that studies are
+      retrieved as they were stored
+
+    Remark:
+      Compressed transfer syntaxes pydicom can't decompress are left out, as
+      the plot of a retrieved study couldn't be shown, see dicomlib.get_plot_pixels
+  """
+  contexts = []
+  for context in StoragePresentationContexts:
+    if context.abstract_syntax == SECONDARY_CAPTURE:
+      transfer_syntaxes = list(context.transfer_syntax)
+      for transfer_syntax in server_config.PACS_STORE_TRANSFER_SYNTAXES:
+        if transfer_syntax not in transfer_syntaxes and dicomlib.is_decoder_available(transfer_syntax):
+          transfer_syntaxes.append(transfer_syntax)
+      context = build_context(SECONDARY_CAPTURE, transfer_syntaxes)
+    contexts.append(context)
+
+  return contexts
+
 def logEvent(event):
     logger.info(event)
 
+# Tags needed to decide if a received dataset should be stored
+PEEK_TAGS = [
+  0x00080050, # AccessionNumber
+  0x00080060, # Modality
+  0x00230010, # Private creator of the GFR tags
+]
+
 def on_C_STORE(event):
     logger.info('Recieved C-Store Event')
+    # Only the tags needed are read from the encoded dataset, the full dataset
+    # is first decoded, when a view opens the file
+    encoded_dataset = event.request.DataSet.getvalue()
     try:
-      retrieved_dataset           = event.dataset
-      retrieved_dataset.file_meta = event.file_meta
+      retrieved_dataset = dicomlib.peek_tags(
+        encoded_dataset,
+        event.context.transfer_syntax,
+        PEEK_TAGS
+      )
     except:
       return_dataset = Dataset()
       return_dataset.Status = 0xC123
       return_dataset.add_new(0x00000902, 'LO', 'Could not load retrieve Dataset')
 
       return return_dataset
-    #logger.info(f'Dataset:\n {retrieved_dataset}')
 
     if 'AccessionNumber' in retrieved_dataset:
-      if 0x00230010 in retrieved_dataset and retrieved_dataset.Modality == 'OT':
-        filename = f'{retrieved_dataset.AccessionNumber}.dcm'
-        fullpath = server_config.SEARCH_DIR + filename
-        dicomlib.save_dicom(fullpath, retrieved_dataset)
+      if 0x00230010 in retrieved_dataset and retrieved_dataset.get('Modality') == 'OT':
+        # Datasets from a C-MOVE are saved to a file unique to the move, and the requester is notified
+        message_id = event.request.MoveOriginatorMessageID
+        fullpath = move_notifier.stored_file_path(retrieved_dataset.AccessionNumber, message_id)
+        # The encoded dataset is written as received, in the transfer syntax of the presentation context
+        queued = store_writer.put(
+          fullpath,
+          event.file_meta,
+          encoded_dataset,
+          retrieved_dataset.AccessionNumber,
+          message_id
+        )
+        if not queued:
+          logger.error(f'Store writer queue is full, refusing {retrieved_dataset.AccessionNumber}')
+          return 0xA700 # Out of resources
 
       return 0x0000
 
@@ -88,9 +251,10 @@ if __name__ == "__main__":
     except ObjectDoesNotExist:
         logger.info("Server is not yet configured - Exiting1")
         exit(1)
+    store_writer.start()
     while True:
         server = AE(ae_title=sc.AE_title)
-        server.supported_contexts = StoragePresentationContexts
+        server.supported_contexts = get_supported_contexts()
 
         server.start_server(('', 104), evt_handlers=event_handlers)
         logger.error("Server Died!")